@@ -0,0 +1,392 @@
+"""
+このファイルではディレクトリ内の全てのwordファイルを一括で校閲します。
+各文書の入力ファイルのハッシュ、状態(queued, running, done, failed)、出力先、処理時間をジャーナルに記録します。
+--resume を付けて再実行すると、校閲済みの文書を飛ばし、失敗した文書だけを再試行します。
+再試行は1つの文書につき --max-retries 回までとします。
+
+--workers を指定した場合は複数のプロセスで並列に校閲します。
+大きな文書が最後に残って他のプロセスが待つことのないよう、事前に各文書の処理時間を見積もり、
+見積もりの大きい文書から順に、空いたプロセスへ1件ずつ割り当てます。
+--large-mb を指定した場合は、document.xml がその大きさ以上の文書を専用のプロセスで処理します。
+最後に見積もりと実際の処理時間を表示します。
+各文書の処理ごとの所要時間と最大メモリ使用量は性能の記録(perf_history.py)にも追記します。
+
+--deadline、--max-memory-mb を指定した場合は、文書ごとに時間とメモリの上限を設けます(budget.py)。
+上限を超えた文書は処理を打ち切り、--on-budget の指定に応じて完了した処理の結果を出力するか、文書を変更せずに記録だけを残します。
+1つの文書が処理を長時間占有して、後続の文書が待たされることはありません。
+--deadline を指定した場合は常にワーカープロセスで校閲し、1つの段落の処理が終わらないなどの理由で
+期限から DEADLINE_GRACE 秒を過ぎても結果を返さない文書は、親プロセスがワーカーを停止して失敗として記録します。
+同じプロセスプールで実行中だった他の文書は、新しいプロセスプールで最初から校閲し直します。
+"""
+import argparse
+import hashlib
+import os
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack
+from proofread import proofread
+from journal import BatchJournal, DEFAULT_JOURNAL, QUEUED, RUNNING, DONE, FAILED, replay_journal
+from perf_history import PerfHistory, DEFAULT_HISTORY, DocumentMemory
+from preflight import count_paragraphs
+from budget import Budget, PARTIAL, ACTIONS
+from remake_wordfile_from_xml import DEFAULT_LEVEL
+
+# 1つの文書を実行する回数の既定の上限
+MAX_RETRIES = 3
+
+# 処理時間の見積もりの係数（段落1つあたりの秒数、document.xml の1MBあたりの秒数）
+SECONDS_PER_PARAGRAPH = 0.0001
+SECONDS_PER_MB = 0.5
+
+# 期限(--deadline)を過ぎてから、結果を返さないワーカーを停止するまでに待つ時間(秒)
+DEADLINE_GRACE = 10.0
+
+
+def list_docx_files(data_dir):
+    """
+    ディレクトリ内のwordファイルのパスを名前順に返す。Wordの一時ファイル(~$で始まるもの)は除く。
+    """
+    return [os.path.join(data_dir, name) for name in sorted(os.listdir(data_dir))
+            if name.endswith(".docx") and not name.startswith("~$")]
+
+
+def file_hash(data):
+    """
+    入力ファイルの内容のハッシュ(SHA-256)を返す。
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+def estimate_cost(docx_file, scale=1.0):
+    """
+    文書の処理時間を見積もる。
+    zipのディレクトリに記録された document.xml の展開後の大きさと、段落の開始タグの数から求める。
+    scale には過去の実績から求めた補正係数を指定する。
+    読み取れない文書は見積もりを0とする（校閲時に失敗として記録される）。
+    """
+    try:
+        with zipfile.ZipFile(docx_file, "r") as zip_ref:
+            xml_bytes = zip_ref.getinfo("word/document.xml").file_size
+            document_xml = zip_ref.read("word/document.xml")
+    except (OSError, KeyError, zipfile.BadZipFile):
+        return {"xml_bytes": 0, "paragraphs": 0, "predicted": 0.0}
+
+    paragraphs = count_paragraphs(document_xml)
+    predicted = (paragraphs * SECONDS_PER_PARAGRAPH + xml_bytes / 1024 ** 2 * SECONDS_PER_MB) * scale
+    return {"xml_bytes": xml_bytes, "paragraphs": paragraphs, "predicted": predicted}
+
+
+def calibrate(documents):
+    """
+    ジャーナルに記録された校閲済みの文書の見積もりと実際の処理時間から、見積もりの補正係数を求める。
+    実績がない場合は1.0を返す。時間やメモリの上限を超えて打ち切った文書は実績に含めない。
+    """
+    completed = [document for document in documents.values()
+                 if document["state"] == DONE and document.get("predicted") and not document.get("budget")]
+    predicted = sum(document["predicted"] for document in completed)
+    elapsed = sum(document["elapsed"] for document in completed)
+    return elapsed / predicted if predicted > 0 and elapsed > 0 else 1.0
+
+
+def output_path(output_dir, docx_file):
+    """
+    校閲後のwordファイルの出力先を返す。
+    """
+    core_filename = os.path.splitext(os.path.basename(docx_file))[0]
+    return os.path.join(output_dir, f"【校閲ずみ】{core_filename}.docx")
+
+
+def write_atomically(path, data):
+    """
+    一時ファイルに書き出してから置き換えることで、書き込み途中のファイルが残らないようにする。
+    """
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_path, path)
+
+
+def should_skip(document, max_retries):
+    """
+    再開時にジャーナルの記録から文書を飛ばすかどうかを判定し、理由を返す。飛ばさない場合は None を返す。
+    """
+    if document is None:
+        return None
+    if document["state"] == DONE and (document.get("output") is None or os.path.exists(document["output"])):
+        return "校閲済み"
+    if document["state"] in (RUNNING, FAILED) and document["attempts"] >= max_retries:
+        return f"{document['attempts']}回失敗したため再試行しません"
+    return None
+
+
+def proofread_file(args):
+    """
+    1つの文書を校閲し、修正箇所があれば出力先に書き出す（ワーカープロセスでも実行される）。
+    処理結果を辞書で返す。失敗した場合は error に内容を設定する。
+    timings には処理ごとの所要時間、peak_kb にはこの文書の処理で増えたメモリの最大量(KB)、
+    peak_scope にはその範囲を設定する（perf_history.DocumentMemory を参照）。
+    budget_settings (Budget の引数の辞書) を指定した場合は時間とメモリの上限を設け、超えた場合は budget に内容を設定する。
+    compress_level には校閲後のwordファイルの圧縮レベルを指定する（proofread() を参照）。
+    """
+    docx_file, input_hash, output_dir, include_nested, splice, budget_settings, compress_level = args
+    start = time.perf_counter()
+    memory = DocumentMemory()
+    result = {"output": None, "changes": 0, "error": None, "timings": {}, "budget": None}
+    try:
+        with open(docx_file, "rb") as file:
+            data = file.read()
+        if file_hash(data) != input_hash:
+            raise RuntimeError("処理中に入力ファイルが変更されました")
+        budget = Budget(**budget_settings) if budget_settings is not None else None
+        output, report = proofread(data, include_nested=include_nested, splice=splice, budget=budget,
+                                   compress_level=compress_level)
+        result["changes"] = report["changes"]
+        result["budget"] = report["budget"]
+        result["timings"] = report["timings"]
+        if not report["clean"]:
+            result["output"] = output_path(output_dir, docx_file)
+            write_atomically(result["output"], output)
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["elapsed"] = time.perf_counter() - start
+    result["peak_kb"], result["peak_scope"] = memory.peak()
+    return result
+
+
+def stop_pool(pool):
+    """
+    プロセスプールのワーカーを停止する。実行中の処理の終了は待たない。
+    """
+    # ProcessPoolExecutor にはワーカーを停止する公開の手段がないため、内部で保持しているプロセスを直接終了させる
+    # 内部の属性が見つからない場合は停止できないため、終了を待たずにプロセスプールを手放す
+    processes = getattr(pool, "_processes", None) or {}
+    for process in list(processes.values()):
+        process.terminate()
+    pool.shutdown(wait=bool(processes), cancel_futures=True)
+
+
+def format_cost_report(costs, makespan):
+    """
+    文書ごとの見積もりと実際の処理時間を表示用の文字列にして返す。
+    """
+    lines = ["見積もりと実際の処理時間:"]
+    for cost in costs:
+        ratio = cost["elapsed"] / cost["predicted"] if cost["predicted"] else 0.0
+        lines.append(f"  {cost['source']}: 段落数 {cost['paragraphs']}, document.xml {cost['xml_bytes'] / 1024 ** 2:.1f}MB, "
+                     f"見積もり {cost['predicted']:.2f}秒, 実際 {cost['elapsed']:.2f}秒 (実際/見積もり {ratio:.2f})")
+    predicted = sum(cost["predicted"] for cost in costs)
+    elapsed = sum(cost["elapsed"] for cost in costs)
+    lines.append(f"  合計: 見積もり {predicted:.2f}秒, 実際 {elapsed:.2f}秒, 全体の所要時間 {makespan:.2f}秒")
+    return "\n".join(lines)
+
+
+def run_batch(data_dir="data", output_dir="output", journal_path=None, resume=False, max_retries=MAX_RETRIES,
+              include_nested=False, workers=None, large_bytes=None, history_path=DEFAULT_HISTORY, splice=False,
+              deadline=None, max_memory_mb=None, on_budget=PARTIAL, compress_level=DEFAULT_LEVEL):
+    """
+    data_dir 内の全てのwordファイルを校閲し、校閲後のファイルを output_dir に出力する。
+    resume=True の場合はジャーナルの記録をもとに、校閲済みの文書と再試行の上限に達した文書を飛ばす。
+    workers を指定した場合はそのプロセス数で並列に校閲し、見積もりの大きい文書から順に割り当てる。
+    large_bytes を指定した場合は、document.xml がその大きさ以上の文書を専用のプロセスで校閲する。
+    splice=True の場合は変更した段落だけを元の document.xml に差し込む（proofread() を参照）。
+    deadline (秒)、max_memory_mb を指定した場合は文書ごとに時間とメモリの上限を設け、
+    超えた場合は on_budget に応じて完了した処理の結果を出力する(partial)か、文書を変更しない(report_only)。
+    deadline を指定した場合は workers によらずワーカープロセスで校閲し、期限から DEADLINE_GRACE 秒を過ぎても
+    結果を返さない文書はワーカーを停止して失敗として記録する。
+    history_path を指定した場合は、校閲した文書ごとの性能を記録する。None の場合は記録しない。
+    compress_level には校閲後のwordファイルの圧縮レベル(1〜9)を指定する。0 の場合は圧縮せずに格納する。
+    状態ごとの文書数と、文書ごとの見積もり・実際の処理時間を返す。
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    journal_path = journal_path or os.path.join(output_dir, DEFAULT_JOURNAL)
+    documents = replay_journal(journal_path)
+    scale = calibrate(documents)
+    summary = {"done": 0, "failed": 0, "skipped": 0, "over_budget": 0, "costs": []}
+    budget_settings = None
+    if deadline is not None or max_memory_mb is not None:
+        budget_settings = {"seconds": deadline, "memory_mb": max_memory_mb, "action": on_budget}
+    batch_start = time.perf_counter()
+
+    with ExitStack() as resources:
+        journal = resources.enter_context(BatchJournal(journal_path))
+        history = resources.enter_context(PerfHistory(history_path)) if history_path is not None else None
+
+        # 処理する文書を決めて処理時間を見積もり、先にジャーナルへ登録する
+        queue = []
+        for docx_file in list_docx_files(data_dir):
+            with open(docx_file, "rb") as file:
+                input_hash = file_hash(file.read())
+            document = documents.get((docx_file, input_hash))
+            reason = should_skip(document, max_retries) if resume else None
+            if reason:
+                print(f"{docx_file} を飛ばしました（{reason}）。")
+                summary["skipped"] += 1
+                continue
+            estimate = estimate_cost(docx_file, scale)
+            journal.record(docx_file, input_hash, QUEUED, **estimate)
+            queue.append({"source": docx_file, "hash": input_hash,
+                          "attempt": (document["attempts"] if document else 0) + 1, **estimate})
+
+        # 見積もりの大きい文書から順に処理する
+        queue.sort(key=lambda entry: entry["predicted"], reverse=True)
+
+        # 大きな文書は専用のプロセスで処理する
+        large_queue = []
+        if workers and workers > 1 and large_bytes is not None:
+            large_queue = [entry for entry in queue if entry["xml_bytes"] >= large_bytes]
+            queue = [entry for entry in queue if entry["xml_bytes"] < large_bytes]
+
+        total = len(queue) + len(large_queue)
+        finished = 0
+
+        def start(entry):
+            # 他の文書の停止に巻き込まれて校閲し直す文書は、実行した回数に数えないよう記録し直さない
+            if not entry.pop("requeued", False):
+                journal.record(entry["source"], entry["hash"], RUNNING, attempt=entry["attempt"])
+            return (entry["source"], entry["hash"], output_dir, include_nested, splice, budget_settings, compress_level)
+
+        def finish(entry, result):
+            nonlocal finished
+            finished += 1
+            fields = {"attempt": entry["attempt"], "elapsed": result["elapsed"], "predicted": entry["predicted"]}
+            if result["error"] is not None:
+                journal.record(entry["source"], entry["hash"], FAILED, error=result["error"], **fields)
+                print(f"[{finished}/{total}] {entry['source']} の校閲に失敗しました: {result['error']}")
+                summary["failed"] += 1
+                return
+            journal.record(entry["source"], entry["hash"], DONE, output=result["output"],
+                           changes=result["changes"], budget=result["budget"], **fields)
+            if result["budget"] is not None:
+                summary["over_budget"] += 1
+                if result["output"] is None:
+                    note = f"文書は変更しませんでした（見つかった修正箇所 {result['changes']} 件）"
+                else:
+                    note = f"完了した処理の結果を {result['output']} に出力しました"
+                print(f"[{finished}/{total}] {entry['source']}: {result['budget']['message']}。{note}。")
+            elif result["output"] is None:
+                print(f"[{finished}/{total}] {entry['source']} に修正箇所はありませんでした。")
+            else:
+                print(f"[{finished}/{total}] 校閲後のファイルを {result['output']} に出力しました。")
+            summary["done"] += 1
+            if history is not None:
+                history.record("batch", entry["source"], entry["xml_bytes"], entry["paragraphs"], result["changes"],
+                               result["timings"], peak_kb=result["peak_kb"], peak_scope=result["peak_scope"])
+            summary["costs"].append({"source": entry["source"], "paragraphs": entry["paragraphs"],
+                                     "xml_bytes": entry["xml_bytes"], "predicted": entry["predicted"],
+                                     "elapsed": result["elapsed"]})
+
+        if (not workers or workers <= 1) and deadline is None:
+            for entry in queue:
+                finish(entry, proofread_file(start(entry)))
+        else:
+            # [プロセスプール, 待ち行列, 同時に実行する数] の組。停止したプロセスプールは作り直す
+            lanes = []
+            if large_queue:
+                lanes.append([ProcessPoolExecutor(max_workers=1), large_queue, 1])
+            general_workers = max(1, (workers or 1) - len(lanes))
+            lanes.append([ProcessPoolExecutor(max_workers=general_workers), queue, general_workers])
+
+            # 空いたプロセスにだけ次の文書を割り当てることで、割り当ての順序を見積もりの大きい順に保つ
+            # 実行中の文書ごとに (文書, 組, 開始時刻) を保持する
+            running = {}
+
+            def dispatch(lane):
+                pool, lane_queue, capacity = lane
+                while lane_queue and sum(1 for item in running.values() if item[1] is lane) < capacity:
+                    entry = lane_queue.pop(0)
+                    running[pool.submit(proofread_file, start(entry))] = (entry, lane, time.monotonic())
+
+            def restart(lane):
+                # ワーカーを停止してプロセスプールを作り直し、実行中だった文書は待ち行列の先頭に戻す
+                stop_pool(lane[0])
+                for future, (entry, other_lane, _) in list(running.items()):
+                    if other_lane is lane:
+                        del running[future]
+                        entry["requeued"] = True
+                        lane[1].insert(0, entry)
+                lane[0] = ProcessPoolExecutor(max_workers=lane[2])
+
+            try:
+                for lane in lanes:
+                    dispatch(lane)
+                while running:
+                    timeout = None
+                    if deadline is not None:
+                        oldest = min(started for _, _, started in running.values())
+                        timeout = max(oldest + deadline + DEADLINE_GRACE - time.monotonic(), 0)
+                    completed, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                    broken = []
+                    for future in completed:
+                        entry, lane, started = running.pop(future)
+                        try:
+                            result = future.result()
+                        except BrokenProcessPool as e:
+                            # ワーカープロセスが異常終了した（メモリ不足で強制終了された場合など）
+                            result = {"error": f"ワーカープロセスが異常終了しました: {e}",
+                                      "elapsed": time.monotonic() - started}
+                            if lane not in broken:
+                                broken.append(lane)
+                        finish(entry, result)
+
+                    # 期限を過ぎても結果を返さない文書は、ワーカーを停止して失敗として記録する
+                    if deadline is not None:
+                        now = time.monotonic()
+                        for future, (entry, lane, started) in list(running.items()):
+                            if future in running and now - started > deadline + DEADLINE_GRACE:
+                                del running[future]
+                                finish(entry, {"error": f"期限を{DEADLINE_GRACE:.0f}秒過ぎても応答がないため停止しました",
+                                               "elapsed": now - started})
+                                restart(lane)
+
+                    for lane in broken:
+                        restart(lane)
+                    for lane in lanes:
+                        dispatch(lane)
+            finally:
+                for pool, _, _ in lanes:
+                    pool.shutdown(wait=True)
+
+    makespan = time.perf_counter() - batch_start
+    print(f"校閲済み {summary['done']} 件、失敗 {summary['failed']} 件、飛ばした文書 {summary['skipped']} 件")
+    if summary["over_budget"]:
+        print(f"時間またはメモリの上限を超えた文書 {summary['over_budget']} 件（校閲済みの件数に含みます）")
+    if summary["costs"]:
+        print(format_cost_report(summary["costs"], makespan))
+    summary["makespan"] = makespan
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ディレクトリ内の全てのwordファイルを一括で校閲します。")
+    parser.add_argument("data_dir", nargs="?", default="data", help="校閲対象のwordファイルがあるディレクトリ")
+    parser.add_argument("--output-dir", default="output", help="校閲後のファイルの出力先")
+    parser.add_argument("--journal", help=f"ジャーナルのパス（既定は出力先の {DEFAULT_JOURNAL}）")
+    parser.add_argument("--resume", action="store_true", help="ジャーナルをもとに校閲済みの文書を飛ばし、失敗した文書を再試行する")
+    parser.add_argument("--max-retries", type=int, default=MAX_RETRIES, help="1つの文書を実行する回数の上限")
+    parser.add_argument("--include-nested", action="store_true", help="表や図、テキストボックスの中の段落も校閲する")
+    parser.add_argument("--splice", action="store_true",
+                        help="変更した段落だけを元の document.xml に差し込み、それ以外の段落は元の内容のまま残す")
+    parser.add_argument("--workers", type=int, help="指定したプロセス数で並列に校閲する")
+    parser.add_argument("--large-mb", type=float,
+                        help="document.xml がこの大きさ(MB)以上の文書を専用のプロセスで校閲する（--workers と併用）")
+    parser.add_argument("--deadline", type=float, help="1つの文書の校閲にかける時間の上限(秒)。期限を過ぎても応答がないワーカーは停止する")
+    parser.add_argument("--max-memory-mb", type=float, help="1つの文書の校閲中に増えた使用メモリの上限(MB)")
+    parser.add_argument("--on-budget", choices=ACTIONS, default=PARTIAL,
+                        help="上限を超えた場合に、完了した処理の結果を出力する(partial)か、文書を変更しない(report_only)か")
+    parser.add_argument("--compress-level", type=int, choices=range(10), default=DEFAULT_LEVEL, metavar="0-9",
+                        help="校閲後のwordファイルの圧縮レベル（0は圧縮せずに格納する）")
+    parser.add_argument("--history", default=DEFAULT_HISTORY,
+                        help="処理ごとの所要時間などを記録する性能の記録(SQLite)のパス（perf_history.py で集計できる）")
+    parser.add_argument("--no-history", action="store_true", help="性能の記録を行わない")
+    args = parser.parse_args()
+
+    run_batch(args.data_dir, output_dir=args.output_dir, journal_path=args.journal, resume=args.resume,
+              max_retries=args.max_retries, include_nested=args.include_nested, workers=args.workers,
+              large_bytes=int(args.large_mb * 1024 ** 2) if args.large_mb is not None else None,
+              history_path=None if args.no_history else args.history, splice=args.splice,
+              deadline=args.deadline, max_memory_mb=args.max_memory_mb, on_budget=args.on_budget,
+              compress_level=args.compress_level)
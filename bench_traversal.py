@@ -0,0 +1,99 @@
+"""
+このファイルでは段落の中の要素の取得にかかる時間を、従来の子孫の検索(".//w:t" など)と
+traversal.py の子要素をたどる方法とで比較します。
+各処理が段落ごとに行う取得（ラン、<w:t>、テキスト、<w:rPr>と<w:highlight>、<w:pPr>と<w:ind>、図の有無）について、
+<w:t>要素を結合した後の文書で1段落あたりの所要時間と速度の比を表示します。
+
+    python bench_traversal.py data/sample.docx --repeat 5
+"""
+import argparse
+import timeit
+from lxml import etree as ET
+from make_xml_from_wordfile import get_docx_file, read_document_xml, combine_runs_in_xml
+from traversal import (ns, body_paragraphs, first_child, paragraph_runs, paragraph_texts, paragraph_text,
+                       paragraph_has_drawing, W_RPR, W_HIGHLIGHT, W_PPR, W_IND)
+
+
+def legacy_run_properties(paragraph):
+    runs = paragraph.findall(".//w:r", namespaces=ns)
+    return [(rPr, rPr.find(".//w:highlight", namespaces=ns) if rPr is not None else None)
+            for rPr in (run.find(".//w:rPr", namespaces=ns) for run in runs)]
+
+
+def run_properties(paragraph):
+    return [(rPr, first_child(rPr, W_HIGHLIGHT) if rPr is not None else None)
+            for rPr in (first_child(run, W_RPR) for run in paragraph_runs(paragraph))]
+
+
+def legacy_indent(paragraph):
+    pPr = paragraph.find(".//w:pPr", namespaces=ns)
+    return pPr.find(".//w:ind", namespaces=ns) if pPr is not None else None
+
+
+def indent(paragraph):
+    pPr = first_child(paragraph, W_PPR)
+    return first_child(pPr, W_IND) if pPr is not None else None
+
+
+# 比較する取得の名前と、(従来の方法, traversal.py の方法)
+QUERIES = {
+    "runs": (lambda paragraph: paragraph.findall(".//w:r", namespaces=ns), paragraph_runs),
+    "texts": (lambda paragraph: paragraph.findall(".//w:t", namespaces=ns), paragraph_texts),
+    "text": (lambda paragraph: "".join([t.text for t in paragraph.findall(".//w:t", namespaces=ns) if t.text]),
+             paragraph_text),
+    "rPr/highlight": (legacy_run_properties, run_properties),
+    "pPr/ind": (legacy_indent, indent),
+    "drawing": (lambda paragraph: paragraph.find(".//w:drawing", namespaces=ns) is not None, paragraph_has_drawing),
+}
+
+
+def measure_query(query, paragraphs, repeat):
+    """
+    全ての段落に query を適用する時間を repeat 回計り、最短の時間(秒)を返す。
+    """
+    return min(timeit.repeat(lambda: [query(paragraph) for paragraph in paragraphs], number=1, repeat=repeat))
+
+
+def benchmark(docx_file, repeat=5, include_nested=False):
+    """
+    wordファイルの段落について取得ごとの所要時間を計り、
+    (段落数, [(名前, 従来の1段落あたりの秒数, 新しい方法の1段落あたりの秒数), ...]) を返す。
+    """
+    with open(docx_file, "rb") as f:
+        xml_content = combine_runs_in_xml(read_document_xml(f.read()), include_nested=include_nested)
+    root = ET.fromstring(xml_content.encode('utf-8'))
+    paragraphs = body_paragraphs(root, include_nested)
+    count = max(len(paragraphs), 1)
+    results = []
+    for name, (legacy, current) in QUERIES.items():
+        results.append((name, measure_query(legacy, paragraphs, repeat) / count,
+                        measure_query(current, paragraphs, repeat) / count))
+    return len(paragraphs), results
+
+
+def format_benchmark(paragraph_count, results):
+    """
+    benchmark() の結果を表示用の文字列にして返す。
+    """
+    lines = [f"段落数 {paragraph_count}（1段落あたりの所要時間、マイクロ秒）",
+             f"  {'取得':<14}{'従来':>10}{'新しい方法':>12}{'速度の比':>10}"]
+    legacy_total = current_total = 0.0
+    for name, legacy, current in results:
+        legacy_total += legacy
+        current_total += current
+        lines.append(f"  {name:<14}{legacy * 1e6:>10.2f}{current * 1e6:>12.2f}{legacy / current:>9.2f}x")
+    lines.append(f"  {'合計':<14}{legacy_total * 1e6:>10.2f}{current_total * 1e6:>12.2f}"
+                 f"{legacy_total / current_total:>9.2f}x")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="段落の中の要素の取得にかかる時間を、従来の子孫の検索と比較します。")
+    parser.add_argument("docx", nargs="?", help="計測に使用するwordファイル（既定は data ディレクトリ内のファイル）")
+    parser.add_argument("--repeat", type=int, default=5, help="計測を繰り返す回数（最短の時間を使用する）")
+    parser.add_argument("--include-nested", action="store_true", help="表や図、テキストボックスの中の段落も計測に含める")
+    args = parser.parse_args()
+
+    docx_file = args.docx or get_docx_file("data")
+    if docx_file is not None:
+        print(format_benchmark(*benchmark(docx_file, repeat=args.repeat, include_nested=args.include_nested)))
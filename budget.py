@@ -0,0 +1,175 @@
+"""
+このファイルでは1つの文書の校閲にかける時間とメモリの上限(予算)を扱います。
+各処理は一定の段落数ごとに進捗コールバックを呼び出すため、そのたびに経過時間と使用メモリを確認し、
+上限を超えていれば BudgetExceeded を送出して処理を打ち切ります。
+メインスレッドで実行している場合は期限にタイマー(SIGALRM)を設定し、期限を過ぎたことを記録します。
+タイマーは記録するだけで処理を中断しないため、文書のツリーを変更している途中で打ち切ることはありません。
+記録は段落の区切りごとに確認し、期限を過ぎていれば次の段落に進む前に打ち切ります。
+1つの段落の処理が終わらない場合は打ち切れないため、batch.py では親プロセスの側でも期限を監視します。
+使用メモリは文書の校閲を始めた時点からの増加量を上限と比べます。
+
+メモリの確保に失敗した場合(MemoryError)は、処理の途中で中断されたものとして扱います。
+この場合は打ち切った処理の結果を破棄し、最後に完了した処理の結果まで戻します（proofread.run_stages() を参照）。
+
+上限を超えた場合の動作は次のどちらかを選べます。
+- partial     -- 完了した処理の結果を出力する（打ち切った処理は、それまでの段落だけが修正される）
+- report_only -- 文書は変更せず、それまでに見つかった修正箇所をレポートにだけ残す
+"""
+import contextlib
+import os
+import signal
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# 上限を超えた場合の動作
+PARTIAL = "partial"
+REPORT_ONLY = "report_only"
+ACTIONS = (PARTIAL, REPORT_ONLY)
+
+# 上限を超えた項目
+TIME = "time"
+MEMORY = "memory"
+
+
+class BudgetExceeded(Exception):
+    """
+    文書の校閲が時間またはメモリの上限を超えた。
+    """
+
+    def __init__(self, reason, stage, interrupted=False):
+        self.reason = reason
+        self.stage = stage
+        # 段落の区切り以外で中断した場合はTrue（打ち切った処理の結果は使用できない）
+        self.interrupted = interrupted
+        limit = "時間" if reason == TIME else "メモリ"
+        super().__init__(f"{stage or '校閲'} の処理中に{limit}の上限を超えました")
+
+
+def current_memory_mb():
+    """
+    このプロセスの現在の使用メモリ(MB)を返す。
+    /proc を読めない環境では最大使用量を返し、それも取得できない場合は None を返す。
+    """
+    try:
+        with open("/proc/self/statm", "rb") as file:
+            resident_pages = int(file.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except (OSError, ValueError, IndexError):
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS ではバイト単位で返される
+    return peak / 1024 ** 2 if os.uname().sysname == "Darwin" else peak / 1024
+
+
+class Budget:
+    """
+    1つの文書の校閲にかける時間(秒)とメモリ(MB)の上限。
+    文書ごとに新しく作成し、最初の start() または enforce() の時点から時間と使用メモリの増加量を計る。
+    """
+
+    def __init__(self, seconds=None, memory_mb=None, action=PARTIAL):
+        if action not in ACTIONS:
+            raise ValueError(f"上限を超えた場合の動作には {', '.join(ACTIONS)} のいずれかを指定してください: '{action}'")
+        self.seconds = seconds
+        self.memory_mb = memory_mb
+        self.action = action
+        self.deadline = None
+        self.baseline_mb = None
+        self.expired = False
+        self.stage = None
+        self.exceeded = None
+
+    def start(self):
+        """
+        時間と使用メモリの計測を開始する。既に開始している場合は何もしない。
+        使用メモリはこの時点の値を基準とし、同じプロセスで先に処理した文書の分を含めない。
+        """
+        if self.deadline is None and self.seconds is not None:
+            self.deadline = time.monotonic() + self.seconds
+        if self.baseline_mb is None and self.memory_mb is not None:
+            self.baseline_mb = current_memory_mb() or 0.0
+
+    def check(self, stage=None):
+        """
+        経過時間と使用メモリを確認し、上限を超えていれば BudgetExceeded を送出する。
+        """
+        if stage is not None:
+            self.stage = stage
+        if self.expired or (self.deadline is not None and time.monotonic() > self.deadline):
+            self.fail(TIME)
+        if self.memory_mb is not None:
+            memory = current_memory_mb()
+            if memory is not None and memory - self.baseline_mb > self.memory_mb:
+                self.fail(MEMORY)
+
+    def fail(self, reason, interrupted=False):
+        self.exceeded = BudgetExceeded(reason, self.stage, interrupted)
+        raise self.exceeded
+
+    def watch(self, progress=None):
+        """
+        進捗が通知されるたびに上限を確認する進捗コールバックを返す。progress を指定した場合はそれにも通知する。
+        通知しない段落でも、段落の区切りごとにタイマーが期限を記録していないかを確認する（progress.report_progress() を参照）。
+        """
+        def callback(stage, done, total):
+            self.check(stage)
+            if progress is not None:
+                progress(stage, done, total)
+
+        def tick(stage):
+            if self.expired:
+                self.check(stage)
+
+        callback.tick = tick
+        return callback
+
+    @contextlib.contextmanager
+    def enforce(self):
+        """
+        with ブロックの間、上限を監視する。
+        メインスレッドで実行している場合は、期限を過ぎたことを記録するタイマーを設定する。
+        メモリの確保に失敗した場合(MemoryError)もメモリの上限を超えたものとして扱い、処理の途中で中断されたことを記録する。
+        """
+        self.start()
+        self.check()
+        use_alarm = (self.deadline is not None and hasattr(signal, "setitimer")
+                     and threading.current_thread() is threading.main_thread())
+        if use_alarm:
+            previous_handler = signal.signal(signal.SIGALRM, self.alarm)
+            signal.setitimer(signal.ITIMER_REAL, max(self.deadline - time.monotonic(), 0.001))
+        try:
+            yield self
+        except MemoryError:
+            self.fail(MEMORY, interrupted=True)
+        finally:
+            if use_alarm:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                signal.signal(signal.SIGALRM, previous_handler)
+
+    def alarm(self, signum, frame):
+        # 処理中のツリーを壊さないよう、ここでは例外を送出せずに記録だけを行う
+        self.expired = True
+
+    def describe(self):
+        """
+        上限を超えた場合の内容をレポート用の辞書にして返す。超えていない場合は None を返す。
+        """
+        if self.exceeded is None:
+            return None
+        return {"reason": self.exceeded.reason, "stage": self.exceeded.stage, "action": self.action,
+                "seconds": self.seconds, "memory_mb": self.memory_mb, "interrupted": self.exceeded.interrupted,
+                "message": str(self.exceeded)}
+
+
+def enforce(budget):
+    """
+    budget が指定されていれば上限を監視するコンテキストマネージャを、なければ何もしないものを返す。
+    """
+    return budget.enforce() if budget is not None else contextlib.nullcontext()
@@ -0,0 +1,33 @@
+"""
+このファイルでは文書に対する変更の有無を記録します。
+各処理は値が実際に変わった場合にだけ文書を変更し、そのたびに ChangeTracker に記録します。
+変更が1つもなければ、XMLの再出力やwordファイルの再構築を省略できます。
+変更した要素も記録するため、変更のあった段落だけを出力し直すこともできます（splice.py）。
+"""
+
+
+class ChangeTracker:
+    """
+    文書に加えた変更の数を数え、変更した要素を記録する。
+    """
+
+    def __init__(self):
+        self.changes = 0
+        self.elements = []
+
+    def mark(self, element=None):
+        self.changes += 1
+        if element is not None:
+            self.elements.append(element)
+
+    @property
+    def dirty(self):
+        return self.changes > 0
+
+
+def mark_changed(tracker, element=None):
+    """
+    tracker が指定されていれば変更を1件記録する。element には変更した要素を指定する。
+    """
+    if tracker is not None:
+        tracker.mark(element)
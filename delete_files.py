@@ -1,55 +1,31 @@
 """
-実行時に作成したファイルを全て削除します。
+実行時に作成したファイルを削除します。
+各ジョブの作業ディレクトリに記録された作成物だけを削除するため、dataディレクトリの入力ファイルは削除しません。
 """
+import argparse
 import os
-import shutil
+from workspace import JobWorkspace, DEFAULT_ROOT, TMPFS_ROOT, cleanup_all, enforce_retention
 
-def delete_files_and_directories():
-    # 削除対象のディレクトリとファイル
-    directories = ['xml', 'xml_new']
-    files = ['bracket_completion_log.txt', 'indentation_log.txt','indentation_log_level_1_to_4.txt','indentation_log_level_5_to_9.txt']
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ジョブの作業ディレクトリを削除します。")
+    parser.add_argument("--workspace-root", default=DEFAULT_ROOT, help="ジョブの作業ディレクトリがあるディレクトリ")
+    parser.add_argument("--tmpfs", action="store_true", help=f"tmpfs ({TMPFS_ROOT}) 上のジョブを対象にする")
+    parser.add_argument("--job", help="指定したジョブIDのジョブだけを削除する")
+    parser.add_argument("--keep-jobs", type=int, help="最近使用したジョブを指定した数だけ残して削除する")
+    parser.add_argument("--keep-gb", type=float, help="合計サイズが指定した値(GB)以下になるまで古いジョブを削除する")
+    args = parser.parse_args()
 
-    # ディレクトリの削除
-    for directory in directories:
-        if os.path.exists(directory):
-            shutil.rmtree(directory)
-            print(f"ディレクトリ '{directory}' を削除しました。")
-        else:
-            print(f"ディレクトリ '{directory}' は存在しません。")
+    root = TMPFS_ROOT if args.tmpfs else args.workspace_root
 
-    # ファイルの削除
-    for file in files:
-        if os.path.exists(file):
-            os.remove(file)
-            print(f"ファイル '{file}' を削除しました。")
+    if args.job:
+        workspace = JobWorkspace.open(os.path.join(root, args.job))
+        if workspace is None:
+            print(f"ジョブ '{args.job}' は存在しません。")
         else:
-            print(f"ファイル '{file}' は存在しません。")
-
-    # 出力ファイルの削除
-    output_docx = f"【校閲ずみ】{core_filename}.docx"
-    if os.path.exists(output_docx):
-        os.remove(output_docx)
-        print(f"ファイル '{output_docx}' を削除しました。")
-    else:
-        print(f"ファイル '{output_docx}' は存在しません。")
-
-    # dataディレクトリ内のファイルを削除
-    data_directory = 'data'
-    if os.path.exists(data_directory):
-        for filename in os.listdir(data_directory):
-            file_path = os.path.join(data_directory, filename)
-            if os.path.isfile(file_path):
-                os.remove(file_path)
-                print(f"dataディレクトリ内のファイル '{file_path}' を削除しました。")
-            else:
-                print(f"'{file_path}' はファイルではないため、削除されませんでした。")
+            workspace.cleanup()
+            print(f"ジョブ '{args.job}' を削除しました。")
+    elif args.keep_jobs is not None or args.keep_gb is not None:
+        enforce_retention(root, max_jobs=args.keep_jobs,
+                          max_bytes=int(args.keep_gb * 1024 ** 3) if args.keep_gb is not None else None)
     else:
-        print(f"ディレクトリ '{data_directory}' は存在しません。")
-
-# パスの設定
-from make_xml_from_wordfile import get_docx_file
-file_path = get_docx_file("data")
-core_filename = os.path.splitext(os.path.basename(file_path))[0]
-
-# 関数の呼び出し
-delete_files_and_directories()
\ No newline at end of file
+        cleanup_all(root)
@@ -0,0 +1,90 @@
+"""
+このファイルでは一括処理(バッチ)の進捗を記録するジャーナルを管理します。
+ジャーナルは1行に1件のJSONを追記していくファイル(JSONL)で、書き込みのたびにディスクへ同期します。
+途中でプロセスが停止しても、それまでに記録した内容は失われません。
+再開時はジャーナルを先頭から読み直し、文書ごとの最新の状態を求めます。
+"""
+import json
+import os
+import time
+
+# ジャーナルの既定のファイル名
+DEFAULT_JOURNAL = "batch_journal.jsonl"
+
+# 文書の状態
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class BatchJournal:
+    """
+    追記専用のジャーナル。record() で記録した内容はすぐにディスクへ同期される。
+    """
+
+    def __init__(self, path=DEFAULT_JOURNAL):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(path, "a", encoding="utf-8")
+        # 書き込み途中で停止した最後の行があれば、次の記録と混ざらないように改行で区切る
+        if not ends_with_newline(path):
+            self.file.write("\n")
+
+    def record(self, source, input_hash, state, **fields):
+        """
+        文書の状態を1件記録する。fields には出力先や処理時間などを指定できる。
+        """
+        entry = {"time": time.time(), "source": source, "hash": input_hash, "state": state}
+        entry.update(fields)
+        self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def ends_with_newline(path):
+    """
+    ファイルが空か、改行で終わっている場合にTrueを返す。
+    """
+    with open(path, "rb") as file:
+        file.seek(0, os.SEEK_END)
+        if file.tell() == 0:
+            return True
+        file.seek(-1, os.SEEK_END)
+        return file.read(1) == b"\n"
+
+
+def replay_journal(path=DEFAULT_JOURNAL):
+    """
+    ジャーナルを読み直し、{(入力ファイルのパス, ハッシュ): 最新の状態} を返す。
+    最新の状態には state、attempts(実行を開始した回数)と、最後に記録された出力先などの値が含まれる。
+    書き込み途中で停止した最後の行など、読み取れない行は無視する。
+    """
+    documents = {}
+    if not os.path.isfile(path):
+        return documents
+
+    # 書き込み途中で停止した行はマルチバイト文字の途中で切れている場合があるため、1行ずつデコードする
+    with open(path, "rb") as file:
+        for line in file:
+            try:
+                entry = json.loads(line.decode("utf-8"))
+            except (UnicodeDecodeError, json.JSONDecodeError):
+                continue
+            key = (entry["source"], entry["hash"])
+            document = documents.setdefault(key, {"attempts": 0})
+            if entry["state"] == RUNNING:
+                document["attempts"] += 1
+            document.update((name, value) for name, value in entry.items() if name not in ("source", "hash"))
+    return documents
@@ -1,80 +1,186 @@
 # docx_processing.py から関数をインポート
-from make_xml_from_wordfile import get_docx_file, extract_docx_to_xml
-from retuouch_indent_number import process_brackets_in_xml
-from update_indent_number import process_xml_level_1_to_4, process_xml_level_5_to_9
-from update_indent_level import update_indent_level
-from remake_wordfile_from_xml import create_docx
+from make_xml_from_wordfile import get_docx_file, extract_docx_to_xml, read_document_xml
+from remake_wordfile_from_xml import create_docx, DEFAULT_LEVEL
+from proofread import run_stages
+from section_parallel import run_stages_in_sections
+from progress import TerminalProgressBar, measure
+from workspace import JobWorkspace, DEFAULT_ROOT, TMPFS_ROOT, enforce_retention
+from preflight import scan_document_xml
+from text_cache import DEFAULT_CACHE_SIZE, set_cache_size, format_cache_stats
+from scope import Scope
+from perf_history import DEFAULT_HISTORY, record_run
+import argparse
 import os
 
 
-# .docx ファイルのパス取得
-docx_file = get_docx_file("data")  # ディレクトリを指定
-
-# XMLへ変換
-extract_docx_to_xml(docx_file, "xml/")
-extract_docx_to_xml(docx_file, "xml_new/")  # 別ディレクトリへの変換
-
-
-"""
-項目番号の形式に誤りがあった場合に修正する処理
-"""
-# 対象のxmlファイルを開く
-xml_file_path = 'xml_new/word/document.xml'
-with open(xml_file_path, "r", encoding="utf-8") as file:
-    xml_content = file.read()
-
-# XML解析と補完処理の実行
-updated_xml, log_brackets = process_brackets_in_xml(xml_content)
-
-# 修正されたXMLを保存(中間保存)
-with open(xml_file_path, "w", encoding="utf-8") as file:
-    file.write(updated_xml)
-
-# ログの出力（補完処理部分のみ）
-log_file_path = "bracket_completion_log.txt"
-with open(log_file_path, "w", encoding="utf-8") as file:
-    for entry in log_brackets:
-        file.write(entry + "\n")
-
-"""
-項目番号の連番に誤りがあった場合に修正する処理
-"""
-# 対象のxmlファイルを開く
-xml_file_path = 'xml_new/word/document.xml'
-with open(xml_file_path, "r", encoding="utf-8") as file:
-    xml_content = file.read()
-
-# レベル1〜4のXML解析の実行
-updated_xml_1_to_4, log_1_to_4 = process_xml_level_1_to_4(xml_content)
-
-# レベル5〜9のXML解析の実行
-updated_xml_5_to_9, log_5_to_9 = process_xml_level_5_to_9(updated_xml_1_to_4)
-
-# 修正されたXMLを保存(中間保存)
-with open(xml_file_path, "w", encoding="utf-8") as file:
-    file.write(updated_xml_5_to_9)
-
-"""
-インデントレベルを修正する処理
-"""
-# 対象のxmlファイルを開く
-xml_file_path = 'xml_new/word/document.xml'
-with open(xml_file_path, "r", encoding="utf-8") as file:
-    xml_content = file.read()
-
-# XML解析の実行
-updated_xml, log_level = update_indent_level(xml_content)
-
-# 修正されたXMLを保存
-with open(xml_file_path, "w", encoding="utf-8") as file:
-    file.write(updated_xml)
-
-# ログの出力
-log_file_path = "indentation_log.txt"
-with open(log_file_path, "w", encoding="utf-8") as file:
-    file.write("\n".join(log_level))
-
-# 校閲後のXMLファイルをWordファイルに再構成
-core_filename = os.path.splitext(os.path.basename(docx_file))[0]
-output_docx = f"【校閲ずみ】{core_filename}.docx"
-create_docx("xml_new", output_docx)
\ No newline at end of file
+def write_logs(report, workspace):
+    """
+    レポートの内容を従来のログファイルとしてジョブの作業ディレクトリに書き出す。
+    """
+    # ログの出力（補完処理部分のみ）
+    with open(workspace.path("bracket_completion_log.txt"), "w", encoding="utf-8") as file:
+        for entry in report["brackets"]:
+            file.write(entry + "\n")
+
+    # 連番修正の処理経過の出力
+    with open(workspace.path("indentation_log_level_1_to_4.txt"), "w", encoding="utf-8") as file:
+        file.write(report["trace_1_to_4"])
+    with open(workspace.path("indentation_log_level_5_to_9.txt"), "w", encoding="utf-8") as file:
+        file.write(report["trace_5_to_9"])
+
+    # インデント修正のログの出力
+    with open(workspace.path("indentation_log.txt"), "w", encoding="utf-8") as file:
+        file.write("\n".join(report["indent"]))
+
+
+def main(data_dir="data", workspace_root=DEFAULT_ROOT, progress=None, workers=None,
+         keep_jobs=None, keep_bytes=None, scope=None, include_nested=False, history=DEFAULT_HISTORY, splice=False,
+         compress_level=DEFAULT_LEVEL):
+    """
+    data_dir 内のwordファイルを校閲し、校閲後のwordファイルのパスを返す。
+    修正箇所がなかった場合はwordファイルを作成せず、None を返す。
+    事前の走査で修正箇所がないと判定できた場合は、作業ディレクトリの作成とXMLへの展開も行わない。
+    展開したXML、ログ、校閲後のwordファイルはジョブごとの作業ディレクトリ(workspace_root/<ジョブID>/)に出力する。
+    progress には (処理名, 処理済み段落数, 全段落数) を受け取るコールバックを指定できる。
+    workers を指定した場合は文書をレベル1の項目番号ごとの区間に分割し、そのプロセス数で並列に校閲する。
+    keep_jobs, keep_bytes を指定した場合は、保持するジョブ数・合計サイズを超えた古いジョブを削除する。
+    scope (Scope) を指定した場合は範囲内の段落だけを校閲し、範囲外の段落は元の document.xml のまま残す（splice.py を参照）。
+    include_nested=True の場合は表や図、テキストボックスの中の段落も校閲する。
+    splice=True の場合は変更した段落だけを元の document.xml に差し込み、それ以外の段落は元の内容のまま残す。
+    workers を指定して区間に分割した場合は差し込みを行えないため、splice=True と workers は併用できない（ValueError を送出する）。
+    history には処理ごとの所要時間などを記録する性能の記録(SQLite)のパスを指定する。None の場合は記録しない。
+    compress_level には校閲後のwordファイルの圧縮レベル(1〜9)を指定する。0 の場合は圧縮せずに格納する。
+    """
+    if splice and workers:
+        raise ValueError("区間に分割して並列に校閲する場合は、変更した段落の差し込み(splice)を行えません")
+
+    # .docx ファイルのパス取得
+    docx_file = get_docx_file(data_dir)  # ディレクトリを指定
+    if docx_file is None:
+        return None
+
+    # 事前の走査で必要な処理を判定し、修正箇所がなければ以降の処理を全て省略する
+    timings = {}
+    with measure(timings, "preflight"):
+        with open(docx_file, "rb") as file:
+            document_xml = read_document_xml(file.read())
+        stages = scan_document_xml(document_xml, include_nested=include_nested)
+    if not stages:
+        print(f"{docx_file} に修正箇所はありませんでした。")
+        record_run(history, "main", docx_file, document_xml, 0, timings)
+        return None
+
+    # ジョブの作業ディレクトリを作成
+    workspace = JobWorkspace.create(workspace_root, source=docx_file)
+    xml_dir = workspace.path("xml")
+    xml_new_dir = workspace.path("xml_new")
+
+    # XMLへ変換
+    with measure(timings, "extract"):
+        extract_docx_to_xml(docx_file, xml_dir)
+    with measure(timings, "combine"):
+        extract_docx_to_xml(docx_file, xml_new_dir, progress=progress, include_nested=include_nested)  # 別ディレクトリへの変換
+
+    # 対象のxmlファイルを開く
+    xml_file_path = os.path.join(xml_new_dir, "word", "document.xml")
+    with open(xml_file_path, "r", encoding="utf-8") as file:
+        xml_content = file.read()
+
+    # 項目番号の形式修正、連番修正、インデント修正を実行
+    try:
+        if workers:
+            updated_xml, report = run_stages_in_sections(xml_content, workers=workers, progress=progress,
+                                                         stages=stages, scope=scope, include_nested=include_nested,
+                                                         base_xml=document_xml if scope is not None else None)
+        else:
+            updated_xml, report = run_stages(xml_content, progress=progress, stages=stages, scope=scope,
+                                             include_nested=include_nested,
+                                             base_xml=document_xml if splice or scope is not None else None)
+    except ValueError as e:
+        # 指定された範囲が文書内に見つからない場合
+        print(e)
+        return None
+
+    timings.update(report["timings"])
+
+    # ログの出力
+    write_logs(report, workspace)
+
+    # 修正箇所がなければ、XMLの保存とWordファイルの再構成を省略する
+    if report["clean"]:
+        print(f"{docx_file} に修正箇所はありませんでした。")
+        record_run(history, "main", docx_file, document_xml, 0, timings)
+        workspace.touch()
+        enforce_retention(workspace_root, max_jobs=keep_jobs, max_bytes=keep_bytes, keep=(workspace.job_id,))
+        return None
+
+    # 修正されたXMLを保存
+    with open(xml_file_path, "w", encoding="utf-8") as file:
+        file.write(updated_xml)
+
+    # 校閲後のXMLファイルをWordファイルに再構成
+    core_filename = os.path.splitext(os.path.basename(docx_file))[0]
+    output_docx = workspace.path(f"【校閲ずみ】{core_filename}.docx")
+    with measure(timings, "rebuild"):
+        create_docx(xml_new_dir, output_docx, template=docx_file, level=compress_level)
+    print(f"校閲後のファイルを {output_docx} に出力しました。")
+    record_run(history, "main", docx_file, document_xml, report["changes"], timings)
+
+    # ジョブの最後に使用した時刻を更新し、保持数・合計サイズを超えた古いジョブを削除
+    workspace.touch()
+    enforce_retention(workspace_root, max_jobs=keep_jobs, max_bytes=keep_bytes, keep=(workspace.job_id,))
+
+    return output_docx
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="wordファイルの項目番号とインデントを校閲します。")
+    parser.add_argument("--progress", action="store_true", help="進捗バーと残り時間の見込みを表示する")
+    parser.add_argument("--workers", type=int, help="文書を区間に分割し、指定したプロセス数で並列に校閲する")
+    parser.add_argument("--workspace-root", default=DEFAULT_ROOT, help="ジョブの作業ディレクトリを作成するディレクトリ")
+    parser.add_argument("--tmpfs", action="store_true", help=f"ジョブの作業ディレクトリを tmpfs ({TMPFS_ROOT}) に作成する")
+    parser.add_argument("--keep-jobs", type=int, help="保持するジョブ数の上限")
+    parser.add_argument("--keep-gb", type=float, help="保持するジョブの合計サイズの上限(GB)")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE,
+                        help="段落のテキストごとの処理結果を保持するキャッシュの最大件数（0でキャッシュしない）")
+    parser.add_argument("--cache-stats", action="store_true", help="終了時にキャッシュのヒット数・ミス数を表示する")
+    parser.add_argument("--include-nested", action="store_true",
+                        help="表や図、テキストボックスの中の段落も校閲する（既定では校閲しない）")
+    parser.add_argument("--splice", action="store_true",
+                        help="変更した段落だけを元の document.xml に差し込み、それ以外の段落は元の内容のまま残す"
+                             "（--workers とは併用できない）")
+    parser.add_argument("--history", default=DEFAULT_HISTORY,
+                        help="処理ごとの所要時間などを記録する性能の記録(SQLite)のパス（perf_history.py で集計できる）")
+    parser.add_argument("--compress-level", type=int, choices=range(10), default=DEFAULT_LEVEL, metavar="0-9",
+                        help="校閲後のwordファイルの圧縮レベル（0は圧縮せずに格納する）")
+    parser.add_argument("--no-history", action="store_true", help="性能の記録を行わない")
+    scope_group = parser.add_mutually_exclusive_group()
+    scope_group.add_argument("--section", help="校閲する範囲を項目番号で指定する（例: 7、7.2、7:9）")
+    scope_group.add_argument("--paragraphs", help="校閲する範囲を段落の番号(0から数える)で指定する（例: 120:340）")
+    args = parser.parse_args()
+
+    # 区間に分割して並列に校閲した場合は、文書全体を出力し直すため差し込みを行えない
+    if args.splice and args.workers:
+        parser.error("--splice と --workers は併用できません")
+
+    scope = None
+    if args.section or args.paragraphs:
+        try:
+            scope = Scope(section=args.section, paragraphs=args.paragraphs)
+        except ValueError as e:
+            parser.error(str(e))
+
+    set_cache_size(args.cache_size)
+    main(workspace_root=TMPFS_ROOT if args.tmpfs else args.workspace_root,
+         progress=TerminalProgressBar() if args.progress else None,
+         workers=args.workers,
+         keep_jobs=args.keep_jobs,
+         keep_bytes=int(args.keep_gb * 1024 ** 3) if args.keep_gb is not None else None,
+         scope=scope,
+         include_nested=args.include_nested,
+         history=None if args.no_history else args.history,
+         splice=args.splice,
+         compress_level=args.compress_level)
+
+    if args.cache_stats:
+        print(format_cache_stats())
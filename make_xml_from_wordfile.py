@@ -4,9 +4,12 @@
 この方法では図表内のテキストを取得できないが、処理対象となる項目番号は図表内には存在しないため図表内の情報は取得せずそのまま保持する形をとっている。
 ただし、図表が存在しているか否かの検知は行う。
 """
+import io
 import zipfile
 import os
 from lxml import etree as ET
+from progress import report_progress
+from traversal import body_paragraphs, first_child, run_has_drawing, run_has_page_break, W_R, W_T, W_TAB
 
 def get_docx_file(data_dir):
     """
@@ -20,9 +23,11 @@ def get_docx_file(data_dir):
     
     return os.path.join(data_dir, docx_files[0])
 
-def extract_docx_to_xml(docx_file, output_dir):
+def extract_docx_to_xml(docx_file, output_dir, progress=None, include_nested=False):
     """
     wordファイルをxmlファイルに変換する
+    progress を指定した場合は一定の段落数ごとに進捗を通知する
+    include_nested=True の場合は表や図、テキストボックスの中の段落も結合の対象にする
     """
     if docx_file is None:
         print("有効な.docxファイルが指定されていません")
@@ -43,36 +48,58 @@ def extract_docx_to_xml(docx_file, output_dir):
     if not os.path.exists(document_xml_path):
         print("document.xml が見つかりませんでした")
         return
+
+    with open(document_xml_path, 'rb') as f:
+        xml_str = combine_runs_in_xml(f.read(), progress=progress, include_nested=include_nested)
+
+    # XML文字列をファイルに書き出し
+    with open(document_xml_path, 'w', encoding='utf-8') as f:
+        f.write(xml_str)
     
+    print(f"{document_xml_path} を更新しました。")
+
+def read_document_xml(docx_bytes):
+    """
+    メモリ上のwordファイル(バイト列)から word/document.xml の内容をバイト列で取得する
+    """
+    with zipfile.ZipFile(io.BytesIO(docx_bytes), 'r') as zip_ref:
+        return zip_ref.read("word/document.xml")
+
+def combine_runs_in_xml(xml_bytes, progress=None, include_nested=False):
+    """
+    document.xml の内容(バイト列)を受け取り、結合可能な<w:t>要素を結合したXML文字列を返す
+    progress を指定した場合は一定の段落数ごとに進捗を通知する
+    include_nested=True の場合は表や図、テキストボックスの中の段落も結合の対象にする
+    """
     # XML を解析
     parser = ET.XMLParser(ns_clean=True, recover=True)
-    tree = ET.parse(document_xml_path, parser)
+    tree = ET.fromstring(xml_bytes, parser).getroottree()
     root = tree.getroot()
-    namespace = {'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'}
     
     # <w:p> 内の <w:r> 要素を処理、図表関連の要素は無視する
-    for paragraph in root.findall('.//w:p', namespaces=namespace):
-        runs = paragraph.findall('w:r', namespaces=namespace)
+    paragraphs = body_paragraphs(root, include_nested)
+    total = len(paragraphs)
+    for index, paragraph in enumerate(paragraphs, 1):
+        report_progress(progress, "extract", index, total)
+        runs = list(paragraph.iterchildren(W_R))
         new_runs = []
         combined_text = ''
         first_r = None
 
         for r in runs:
-            t_element = r.find('w:t', namespaces=namespace)
+            t_element = first_child(r, W_T)
 
             # 図表関連の要素をスキップして保持
-            if r.find('.//w:drawing', namespaces=namespace) is not None or \
-               r.find('.//w:pict', namespaces=namespace) is not None:
+            if run_has_drawing(r):
                 new_runs.append(r)
                 continue
 
             # <w:br w:type="page"> や <w:tab> をそのまま保持
-            if r.find('w:tab', namespaces=namespace) is not None or \
-               r.find('.//w:br[@w:type="page"]', namespaces=namespace) is not None:
+            if first_child(r, W_TAB) is not None or run_has_page_break(r):
                 
                 # これまでのテキストを保存
                 if combined_text and first_r is not None:
-                    first_t_element = first_r.find('w:t', namespaces=namespace)
+                    first_t_element = first_child(first_r, W_T)
                     if first_t_element is None:
                         first_t_element = ET.SubElement(first_r, 'w:t')
                     first_t_element.text = combined_text
@@ -92,7 +119,7 @@ def extract_docx_to_xml(docx_file, output_dir):
 
         # 最後に残ったテキストを保存
         if combined_text and first_r is not None:
-            first_t_element = first_r.find('w:t', namespaces=namespace)
+            first_t_element = first_child(first_r, W_T)
             if first_t_element is None:
                 first_t_element = ET.SubElement(first_r, 'w:t')
             first_t_element.text = combined_text
@@ -109,13 +136,7 @@ def extract_docx_to_xml(docx_file, output_dir):
     xml_bytes = ET.tostring(tree, encoding='utf-8', xml_declaration=True)
     
     # バイナリ形式で名前空間プレフィックスを'ns0'から'w'に置き換え
-    xml_str = xml_bytes.decode('utf-8').replace('ns0:', 'w:')
-    
-    # XML文字列をファイルに書き出し
-    with open(document_xml_path, 'w', encoding='utf-8') as f:
-        f.write(xml_str)
-    
-    print(f"{document_xml_path} を更新しました。")
+    return xml_bytes.decode('utf-8').replace('ns0:', 'w:')
 
 
 if __name__ == "__main__":
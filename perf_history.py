@@ -0,0 +1,304 @@
+"""
+このファイルでは校閲の実行ごとの性能の記録(履歴)を管理します。
+履歴はSQLiteのファイルに保存し、実行のたびに文書の大きさ、段落数、処理ごとの所要時間、修正の数、
+最大メモリ使用量を1件追記します。最大メモリ使用量には、文書ごとの増加量かプロセス全体の値かを併せて記録します。
+コマンドラインから実行すると、処理ごとの所要時間のパーセンタイルと、期間ごとの推移を表示します。
+
+    python perf_history.py --history perf_history.sqlite3 --period week
+"""
+import argparse
+import os
+import sqlite3
+import time
+from preflight import count_paragraphs
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# 履歴の既定のファイル名
+DEFAULT_HISTORY = "perf_history.sqlite3"
+
+# 表示するパーセンタイル
+PERCENTILES = (50, 90, 99)
+
+# 推移を集計する期間の単位と、時刻を期間の名前にする書式
+PERIODS = {"day": "%Y-%m-%d", "week": "%G-W%V", "month": "%Y-%m"}
+
+# 処理全体の所要時間を表す名前
+TOTAL = "total"
+
+# 最大メモリ使用量の範囲
+# document -- 文書の処理を開始した時点からの増加量の最大値（プロセスの最大使用量をリセットできる環境のみ）
+# process  -- プロセス全体の最大使用量（同じプロセスで先に処理した文書の分も含まれる）
+DOCUMENT_PEAK = "document"
+PROCESS_PEAK = "process"
+PEAK_LABELS = {DOCUMENT_PEAK: "文書ごとの増加量の最大", PROCESS_PEAK: "プロセス全体の最大"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    command TEXT NOT NULL,
+    source TEXT NOT NULL,
+    xml_bytes INTEGER NOT NULL,
+    paragraphs INTEGER NOT NULL,
+    changes INTEGER NOT NULL,
+    peak_kb INTEGER,
+    total REAL NOT NULL,
+    peak_scope TEXT
+);
+CREATE TABLE IF NOT EXISTS stage_timings (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    stage TEXT NOT NULL,
+    seconds REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS stage_timings_run ON stage_timings(run_id);
+"""
+
+
+def read_status_kb(field):
+    """
+    /proc/self/status の field (VmRSS, VmHWM など) の値(KB)を返す。読めない環境では None を返す。
+    """
+    try:
+        with open("/proc/self/status", "r", encoding="ascii") as file:
+            for line in file:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def reset_peak_memory():
+    """
+    このプロセスの最大メモリ使用量(VmHWM)を現在の使用量にリセットする。リセットできた場合はTrueを返す（Linuxのみ）。
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_memory_kb():
+    """
+    このプロセスの最大メモリ使用量(KB)を返す。取得できない環境では None を返す。
+    reset_peak_memory() でリセットした場合は、リセット以降の最大使用量を返す。
+    """
+    peak = read_status_kb("VmHWM")
+    if peak is not None:
+        return peak
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS ではバイト単位で返される
+    return peak // 1024 if os.uname().sysname == "Darwin" else peak
+
+
+class DocumentMemory:
+    """
+    1つの文書の処理で増えたメモリの最大量を計る。文書の処理を開始する直前に作成する。
+    プールのワーカーなど複数の文書を処理するプロセスでは、プロセス全体の最大使用量は先に処理した
+    大きな文書の値のまま下がらないため、開始時に最大使用量をリセットし、開始時の使用量からの増加量を求める。
+    リセットできない環境ではプロセス全体の最大使用量を返す。
+    """
+
+    def __init__(self):
+        self.baseline = read_status_kb("VmRSS") if reset_peak_memory() else None
+
+    def peak(self):
+        """
+        (最大メモリ使用量(KB), 範囲) を返す。範囲は DOCUMENT_PEAK または PROCESS_PEAK。
+        """
+        peak = peak_memory_kb()
+        if self.baseline is not None and peak is not None:
+            return max(peak - self.baseline, 0), DOCUMENT_PEAK
+        return peak, PROCESS_PEAK
+
+
+class PerfHistory:
+    """
+    性能の履歴を保存するSQLiteのデータベース。
+    """
+
+    def __init__(self, path=DEFAULT_HISTORY):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.executescript(SCHEMA)
+        # 最大メモリ使用量の範囲を記録する前に作成された履歴には列を追加する（既存の記録はプロセス全体の値）
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(runs)")]
+        if "peak_scope" not in columns:
+            with self.connection:
+                self.connection.execute("ALTER TABLE runs ADD COLUMN peak_scope TEXT")
+                self.connection.execute("UPDATE runs SET peak_scope = ?", (PROCESS_PEAK,))
+
+    def record(self, command, source, xml_bytes, paragraphs, changes, timings, peak_kb=None, peak_scope=PROCESS_PEAK):
+        """
+        1回の実行の記録を追加する。timings は {処理名: 所要時間(秒)} の辞書。
+        peak_scope には peak_kb の範囲(DOCUMENT_PEAK または PROCESS_PEAK)を指定する。
+        """
+        with self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO runs (time, command, source, xml_bytes, paragraphs, changes, peak_kb, total, peak_scope)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), command, source, xml_bytes, paragraphs, changes, peak_kb, sum(timings.values()),
+                 peak_scope))
+            self.connection.executemany(
+                "INSERT INTO stage_timings (run_id, stage, seconds) VALUES (?, ?, ?)",
+                [(cursor.lastrowid, stage, seconds) for stage, seconds in timings.items()])
+
+    def samples(self, since=None, source=None):
+        """
+        処理ごとの所要時間を {処理名: [(時刻, 秒, 段落数), ...]} の形で返す。
+        処理全体の所要時間は TOTAL の名前で含まれる。
+        since (UNIX時刻) を指定した場合はそれ以降の実行だけ、source を指定した場合はパスにその文字列を含む文書だけを返す。
+        """
+        where, parameters = filter_clause(since, source)
+        samples = {}
+        for run_time, total, paragraphs in self.connection.execute(
+                f"SELECT time, total, paragraphs FROM runs{where} ORDER BY time", parameters):
+            samples.setdefault(TOTAL, []).append((run_time, total, paragraphs))
+        for stage, run_time, seconds, paragraphs in self.connection.execute(
+                "SELECT stage_timings.stage, runs.time, stage_timings.seconds, runs.paragraphs"
+                f" FROM stage_timings JOIN runs ON runs.id = stage_timings.run_id{where} ORDER BY runs.time",
+                parameters):
+            samples.setdefault(stage, []).append((run_time, seconds, paragraphs))
+        return samples
+
+    def summary(self, since=None, source=None):
+        """
+        実行回数、文書の大きさ・段落数・修正の数の合計と、最大メモリ使用量の範囲ごとの最大値
+        (peak_kb: {範囲: KB}) を辞書で返す。
+        """
+        where, parameters = filter_clause(since, source)
+        row = self.connection.execute(
+            f"SELECT COUNT(*), SUM(xml_bytes), SUM(paragraphs), SUM(changes) FROM runs{where}",
+            parameters).fetchone()
+        summary = dict(zip(("runs", "xml_bytes", "paragraphs", "changes"), row))
+        summary["peak_kb"] = {
+            scope: peak for scope, peak in self.connection.execute(
+                f"SELECT peak_scope, MAX(peak_kb) FROM runs{where} GROUP BY peak_scope", parameters)
+            if peak is not None}
+        return summary
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def filter_clause(since=None, source=None):
+    """
+    実行の記録を絞り込むWHERE句と、そのパラメータのリストを返す。
+    """
+    conditions = []
+    parameters = []
+    if since is not None:
+        conditions.append("runs.time >= ?")
+        parameters.append(since)
+    if source:
+        conditions.append("runs.source LIKE ?")
+        parameters.append(f"%{source}%")
+    return (f" WHERE {' AND '.join(conditions)}" if conditions else ""), parameters
+
+
+def record_run(path, command, source, document_xml, changes, timings, peak_kb=None, peak_scope=PROCESS_PEAK):
+    """
+    1回の実行の記録を履歴に追加する。path が None の場合は何もしない。
+    document_xml (バイト列) から文書の大きさと段落数を求める。
+    peak_kb を省略した場合はプロセス全体の最大メモリ使用量を記録する。
+    """
+    if path is None:
+        return
+    if peak_kb is None:
+        peak_kb, peak_scope = peak_memory_kb(), PROCESS_PEAK
+    with PerfHistory(path) as history:
+        history.record(command, source, len(document_xml), count_paragraphs(document_xml), changes, timings,
+                       peak_kb=peak_kb, peak_scope=peak_scope)
+
+
+def percentile(values, q):
+    """
+    values の q パーセンタイルを線形補間で求める。
+    """
+    values = sorted(values)
+    if not values:
+        return 0.0
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def format_history_report(history, period="day", since=None, source=None):
+    """
+    処理ごとの所要時間のパーセンタイルと、期間ごとの中央値の推移を表示用の文字列にして返す。
+    段落数の異なる文書を比較できるよう、推移は1000段落あたりの所要時間でも表示する。
+    """
+    summary = history.summary(since=since, source=source)
+    if not summary["runs"]:
+        return "性能の記録がありません。"
+
+    samples = history.samples(since=since, source=source)
+    stages = [TOTAL] + sorted(stage for stage in samples if stage != TOTAL)
+    peaks = "、".join(f"{PEAK_LABELS.get(scope, scope)} {peak / 1024:.1f}MB"
+                      for scope, peak in sorted(summary["peak_kb"].items(), key=lambda item: str(item[0])))
+    lines = [f"実行回数 {summary['runs']} 回、document.xml 合計 {summary['xml_bytes'] / 1024 ** 2:.1f}MB、"
+             f"段落数 合計 {summary['paragraphs']}、修正 合計 {summary['changes']} 件、"
+             f"最大メモリ使用量 {peaks or '不明'}",
+             "",
+             "処理ごとの所要時間(秒):"]
+    width = max(len(stage) for stage in stages)
+    for stage in stages:
+        seconds = [value for _, value, _ in samples[stage]]
+        values = ", ".join(f"p{q} {percentile(seconds, q):.3f}" for q in PERCENTILES)
+        lines.append(f"  {stage.ljust(width)}  {len(seconds)}回, {values}, 最大 {max(seconds):.3f}")
+
+    lines.append("")
+    lines.append(f"期間({period})ごとの中央値の推移（秒 / 1000段落あたりの秒、前の期間からの変化）:")
+    time_format = PERIODS[period]
+    for stage in stages:
+        buckets = {}
+        for run_time, seconds, paragraphs in samples[stage]:
+            bucket = buckets.setdefault(time.strftime(time_format, time.localtime(run_time)), ([], []))
+            bucket[0].append(seconds)
+            if paragraphs:
+                bucket[1].append(seconds / paragraphs * 1000)
+        lines.append(f"  {stage}:")
+        previous = None
+        for name, (seconds, per_thousand) in buckets.items():
+            median = percentile(per_thousand, 50) if per_thousand else None
+            trend = ""
+            if previous and median is not None:
+                trend = f" ({(median - previous) / previous:+.1%})"
+            normalized = f"{median:.3f}" if median is not None else "-"
+            lines.append(f"    {name}: {percentile(seconds, 50):.3f}秒 / {normalized}秒{trend}  [{len(seconds)}回]")
+            previous = median if median else previous
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="校閲の性能の記録から、処理ごとの所要時間のパーセンタイルと推移を表示します。")
+    parser.add_argument("--history", default=DEFAULT_HISTORY, help="性能の記録のパス")
+    parser.add_argument("--period", choices=sorted(PERIODS), default="day", help="推移を集計する期間の単位")
+    parser.add_argument("--days", type=float, help="直近の指定した日数の記録だけを集計する")
+    parser.add_argument("--source", help="パスにこの文字列を含む文書の記録だけを集計する")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.history):
+        print(f"{args.history} が見つかりませんでした。")
+    else:
+        with PerfHistory(args.history) as history:
+            since = time.time() - args.days * 86400 if args.days is not None else None
+            print(format_history_report(history, period=args.period, since=since, source=args.source))
@@ -0,0 +1,103 @@
+"""
+このファイルでは校閲の前に document.xml のバイト列を簡易的に走査し、必要な処理を判定します。
+XMLの解析(ツリーの構築)は行わず、正規表現で <w:p>、<w:pPr>、<w:ind>、<w:tbl>、<w:t> のタグだけを読み取ります。
+
+判定は安全側に倒しています。
+- <w:t> のテキストが項目番号やスペース、カッコの誤りになりうる文字で始まる場合は全ての処理が必要とする
+- 項目番号がなければ全ての段落はレベル1のインデントになるため、
+  テキストのある段落の <w:ind> が indent_settings_paragraphs[1] と異なる場合はインデント修正だけが必要とする
+- どちらにも当てはまらなければ修正箇所はないため、展開・各処理・wordファイルの再構築を全て省略できる
+判定できない構造（段落の入れ子、w以外の名前空間プレフィックス）の場合は全ての処理が必要とする。
+表の中の段落は、表の中も校閲する場合(include_nested=True)だけ判定の対象にする。
+"""
+import html
+import re
+from update_indent_level import indent_settings_paragraphs
+
+# 処理の名前（実行順）
+STAGES = ("brackets", "numbering", "indent")
+
+W_NAMESPACE = b'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
+
+# 走査対象のタグと、その直後のテキスト（<w:t> の場合は内容）
+TAG_PATTERN = re.compile(rb"<(/?)w:(p|pPr|ind|tbl|t)([\s/][^>]*)?>([^<]*)")
+
+# 属性の名前と値
+ATTRIBUTE_PATTERN = re.compile(rb"""([\w:.-]+)\s*=\s*(["'])(.*?)\2""")
+
+# 処理の対象になりうるテキストの先頭
+# 空白（先頭スペースの削除）、カッコ、全角アルファベット（レベル6）、
+# 英数字の後にカッコ・ピリオドが続くか英数字だけの断片（レベル1〜5,7〜9、カッコの補完）
+SUSPICIOUS_TEXT = re.compile(r"[\s(ａ-ｚ]|[a-zA-Z\d]+(?:[).]|$)")
+
+# 項目番号がない文書の段落に期待されるインデント
+EXPECTED_INDENT = {attr.encode(): value.encode() for attr, value in indent_settings_paragraphs[1].items()}
+
+
+def count_paragraphs(xml_bytes):
+    """
+    document.xml の内容(バイト列)に含まれる段落の開始タグの数を返す（表の中などの段落も含む）。
+    """
+    return xml_bytes.count(b"<w:p>") + xml_bytes.count(b"<w:p ")
+
+
+def scan_document_xml(xml_bytes, include_nested=False):
+    """
+    document.xml の内容(バイト列)を走査し、必要な処理の名前のタプルを STAGES の順で返す。
+    修正箇所がない場合は空のタプルを返す。
+    include_nested=True の場合は表の中の段落も判定の対象にする。
+    """
+    if W_NAMESPACE not in xml_bytes:
+        return STAGES
+
+    needs_indent = False
+    in_paragraph = False
+    table_depth = 0
+    for match in TAG_PATTERN.finditer(xml_bytes):
+        closing, name, attributes, text = match.groups()
+        self_closing = attributes is not None and attributes.endswith(b"/")
+
+        if name == b"tbl":
+            if in_paragraph:
+                return STAGES  # 段落の中の表（テキストボックス内など）は判定しない
+            if not self_closing:
+                table_depth += -1 if closing else 1
+            continue
+        if table_depth and not include_nested:
+            continue  # 表の中の段落は校閲の対象にしない
+
+        if name == b"p":
+            if closing:
+                in_paragraph = False
+                # テキストのある段落だけがインデント修正の対象になる
+                if has_text and indent != EXPECTED_INDENT:
+                    needs_indent = True
+            elif not self_closing:
+                if in_paragraph:
+                    return STAGES  # 段落の入れ子（テキストボックスなど）は判定しない
+                in_paragraph = True
+                has_text = False
+                indent = None
+                ppr_depth = 0
+                ppr_done = False
+            continue
+
+        if not in_paragraph:
+            continue
+
+        if name == b"pPr" and not ppr_done and not self_closing:
+            # 段落の最初の <w:pPr> の直下にある最初の <w:ind> を段落のインデントとみなす
+            # 変更履歴の <w:pPrChange> の中の <w:pPr> は変更前の書式のため、その中の <w:ind> は読まない
+            ppr_depth += -1 if closing else 1
+            ppr_done = ppr_depth == 0
+        elif name == b"ind" and ppr_depth == 1 and indent is None and not closing:
+            indent = dict((key, value) for key, _, value in ATTRIBUTE_PATTERN.findall(attributes or b""))
+        elif name == b"t" and not closing and not self_closing and text:
+            content = text.decode("utf-8")
+            if "&" in content:
+                content = html.unescape(content)
+            if SUSPICIOUS_TEXT.match(content):
+                return STAGES
+            has_text = True
+
+    return ("indent",) if needs_indent else ()
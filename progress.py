@@ -0,0 +1,91 @@
+"""
+このファイルでは処理の進捗を通知します。
+各処理は一定の段落数ごとに進捗コールバックを (処理名, 処理済み段落数, 全段落数) の形で呼び出します。
+コールバックには引数を3つ受け取る任意の呼び出し可能オブジェクトを指定できるため、
+端末への進捗バー表示のほか、バッチ処理やサービスからの進捗収集にも利用できます。
+progress=None の場合は何も計算しないため、進捗通知を無効にした際のコストはありません。
+コールバックに tick 属性がある場合は、通知しない段落でも段落の区切りごとに tick(処理名) を呼び出します
+（budget.py の期限の確認に使用します）。
+処理ごとの所要時間の計測 (measure) もここで定義します。
+"""
+import contextlib
+import sys
+import time
+
+# 進捗を通知する間隔（段落数）
+PROGRESS_INTERVAL = 100
+
+
+def report_progress(progress, stage, done, total, interval=PROGRESS_INTERVAL):
+    """
+    interval 段落ごと、および最後の段落で進捗コールバックを呼び出す。
+    それ以外の段落では、コールバックに tick 属性があれば tick(stage) を呼び出す。
+    """
+    if progress is None:
+        return
+    if done % interval == 0 or done == total:
+        progress(stage, done, total)
+    elif hasattr(progress, "tick"):
+        progress.tick(stage)
+
+
+@contextlib.contextmanager
+def measure(timings, stage):
+    """
+    with ブロックの所要時間(秒)を timings[stage] に加算する。
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+
+def format_seconds(seconds):
+    """
+    秒数を mm:ss 形式（1時間以上は h:mm:ss 形式）の文字列にする。
+    """
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes:02d}:{seconds:02d}"
+
+
+class TerminalProgressBar:
+    """
+    端末に処理ごとの進捗バーと残り時間の見込み(ETA)を表示する進捗コールバック。
+    標準出力の print() と混ざらないよう、既定では標準エラー出力に書き出す。
+    """
+
+    def __init__(self, stream=None, width=30):
+        self.stream = stream if stream is not None else sys.stderr
+        self.width = width
+        self.stage = None
+        self.started_at = None
+        self.started_done = 0
+
+    def __call__(self, stage, done, total):
+        # 処理が切り替わったら経過時間の計測をやり直す
+        # 最初の通知の時点で既に処理済みの段落は計測した時間に含まれないため、速度の計算から除く
+        if stage != self.stage:
+            self.stage = stage
+            self.started_at = time.monotonic()
+            self.started_done = done
+
+        ratio = done / total if total else 1.0
+        filled = int(self.width * ratio)
+        bar = "#" * filled + "-" * (self.width - filled)
+
+        elapsed = time.monotonic() - self.started_at
+        measured = done - self.started_done
+        if measured > 0:
+            eta = format_seconds(elapsed / measured * (total - done))
+        else:
+            eta = "--:--"
+
+        self.stream.write(f"\r[{stage}] [{bar}] {ratio:6.1%} {done}/{total} ETA {eta}")
+        if done >= total:
+            self.stream.write("\n")
+        self.stream.flush()
@@ -0,0 +1,212 @@
+"""
+このファイルではwordファイルの校閲をメモリ上で行うライブラリAPIを提供します。
+proofread() はwordファイルのバイト列を受け取り、校閲後のバイト列と処理結果のレポートを返します。
+中間ファイルやログファイル、グローバルな状態を一切使用しないため、複数のスレッドから同時に呼び出すことができます。
+各処理の経過も標準出力には出力せず、レポートのトレース(trace_1_to_4, trace_5_to_9)とログに記録します。
+"""
+import io
+from lxml import etree as ET
+from make_xml_from_wordfile import read_document_xml, combine_runs_in_xml
+from retuouch_indent_number import process_brackets_in_tree
+from update_indent_number import number_paragraphs
+from update_indent_level import apply_indent_levels
+from remake_wordfile_from_xml import rebuild_docx_bytes, DEFAULT_LEVEL
+from change_tracker import ChangeTracker
+from preflight import STAGES, scan_document_xml
+from progress import measure
+from scope import fast_forward
+from traversal import body_paragraphs
+from splice import splice_paragraphs
+from budget import BudgetExceeded, REPORT_ONLY, enforce
+
+
+def new_report(stages=STAGES):
+    """
+    空のレポートを作成する。
+    """
+    return {"stages": list(stages), "brackets": [], "numbering": [], "indent": [],
+            "trace_1_to_4": "", "trace_5_to_9": "", "changes": 0, "clean": True, "spliced": False, "budget": None,
+            "timings": {}}
+
+
+def run_stages(xml_content, progress=None, stages=STAGES, scope=None, include_nested=False, base_xml=None,
+               budget=None):
+    """
+    document.xml の内容に対して、項目番号の形式修正・連番修正・インデント修正を順に実行する。
+    XMLの解析は最初に1回だけ行い、全ての処理で同じツリーを使用する。
+    stages には実行する処理の名前を指定できる（scan_document_xml() の判定結果）。
+    scope (Scope) を指定した場合は範囲内の段落だけを校閲し、範囲外の段落は変更しない。
+    include_nested=True の場合は表や図、テキストボックスの中の段落も校閲する。
+    base_xml に元の document.xml (バイト列) を指定した場合は、文書全体を出力し直す代わりに、
+    変更した段落だけを base_xml に差し込んだXMLを返す（splice.py を参照）。差し込めない場合は文書全体を出力する。
+    scope を指定する場合は、範囲外の段落を元のバイト列のまま残すため base_xml も指定する。
+    範囲を指定して差し込めなかった場合は、範囲外の段落を変更しないよう ValueError を送出する。
+    budget (Budget) を指定した場合は、時間またはメモリの上限を超えた時点で処理を打ち切り、
+    budget.action に応じて完了した処理の結果を出力する(partial)か、文書を変更せずに返す(report_only)。
+    処理の途中で中断された場合(MemoryError)は、打ち切った処理の結果を破棄して最後に完了した処理の結果を出力する。
+    そのため partial の場合は、2つ目以降の処理を始める前に、それまでの結果を出力しておく。
+    修正後のXML文字列とレポート(辞書)を返す。
+
+    レポートのキー:
+        stages       -- 実行した処理の名前(リスト)
+        brackets     -- 項目番号の形式修正のログ(リスト)
+        numbering    -- 連番修正のログ(リスト)
+        indent       -- インデント修正のログ(リスト)
+        trace_1_to_4 -- レベル1〜4の処理経過(文字列)
+        trace_5_to_9 -- レベル5〜9の処理経過(文字列)
+        changes      -- 文書に加えた変更の数
+        clean        -- 変更が1つもなかった場合はTrue（XMLは入力のまま返される）
+        spliced      -- 変更した段落だけを base_xml に差し込んだ場合はTrue
+        budget       -- 上限を超えた場合はその内容(辞書)、超えなかった場合は None（budget.py を参照）
+                        処理の途中で中断して結果を戻した場合は、rolled_back_to に最後に完了した処理の名前
+                        （完了した処理がない場合は None）を設定する
+        timings      -- 処理ごとの所要時間(秒)の辞書（parse, brackets, numbering, indent, serialize、
+                        上限を指定した場合は途中の結果の出力 snapshot も含む）
+        scope        -- 校閲した段落の範囲 [開始, 終了]（scope を指定した場合のみ）
+    """
+    report = new_report(stages)
+    timings = report["timings"]
+    with measure(timings, "parse"):
+        root = ET.fromstring(xml_content.encode('utf-8'))
+    tracker = ChangeTracker()
+
+    def serialize():
+        # 変更した段落を差し込めた場合は差し込んだXMLを、それ以外は文書全体を出力する
+        spliced = splice_paragraphs(root, base_xml, tracker, include_nested) if base_xml is not None else None
+        if spliced is not None:
+            return spliced.decode('utf-8'), True
+        if scope is not None and base_xml is not None:
+            raise ValueError("範囲外の段落を元の内容のまま残して出力できませんでした。範囲を指定せずに校閲してください。")
+        return ET.tostring(root, encoding='unicode'), False
+
+    # 上限(予算)が指定された場合は、各処理の開始時と進捗が通知されるたびに確認する
+    watched = budget.watch(progress) if budget is not None else progress
+
+    # 処理の途中で中断された場合に戻す結果 (XML, 差し込んだかどうか, 変更の数) と、その時点で完了していた処理の名前
+    snapshot = (xml_content, False, 0)
+    completed = None
+    running = None
+
+    def checkpoint(stage):
+        nonlocal snapshot, completed, running
+        if budget is None:
+            return
+        budget.check(stage)
+        if budget.action != REPORT_ONLY and tracker.changes != snapshot[2]:
+            with measure(timings, "snapshot"):
+                snapshot = (*serialize(), tracker.changes)
+        completed, running = running, stage
+
+    trace_1_to_4 = io.StringIO()
+    trace_5_to_9 = io.StringIO()
+    try:
+        with enforce(budget):
+            # 範囲が指定された場合は、範囲より前の段落を早送りして処理状態を求める
+            paragraphs = None
+            numbering_state = None
+            indent_state = None
+            if scope is not None:
+                all_paragraphs = body_paragraphs(root, include_nested)
+                start, end = scope.resolve(all_paragraphs)
+                paragraphs = all_paragraphs[start:end]
+                numbering_state, indent_state = fast_forward(all_paragraphs[:start])
+                report["scope"] = [start, end]
+
+            # 項目番号の形式に誤りがあった場合に修正する処理
+            if "brackets" in stages:
+                checkpoint("brackets")
+                with measure(timings, "brackets"):
+                    process_brackets_in_tree(root, report["brackets"], progress=watched, tracker=tracker,
+                                             paragraphs=paragraphs, include_nested=include_nested)
+
+            # 項目番号の連番に誤りがあった場合に修正する処理
+            if "numbering" in stages:
+                checkpoint("numbering")
+                with measure(timings, "numbering"):
+                    number_paragraphs(root, report["numbering"], trace_1_to_4, trace_5_to_9, progress=watched,
+                                      state=numbering_state, tracker=tracker, paragraphs=paragraphs,
+                                      include_nested=include_nested, quiet=True)
+
+            # インデントレベルを修正する処理
+            if "indent" in stages:
+                checkpoint("indent")
+                with measure(timings, "indent"):
+                    apply_indent_levels(root, report["indent"], progress=watched, state=indent_state,
+                                        tracker=tracker, paragraphs=paragraphs, include_nested=include_nested, quiet=True)
+    except BudgetExceeded:
+        # 上限を超えた場合は打ち切った処理以降を省略する
+        report["budget"] = budget.describe()
+    report["trace_1_to_4"] = trace_1_to_4.getvalue()
+    report["trace_5_to_9"] = trace_5_to_9.getvalue()
+
+    report["changes"] = tracker.changes
+    report["clean"] = not tracker.dirty
+
+    # 上限を超えた場合に文書を変更しない指定であれば、修正箇所はレポートにだけ残す
+    if report["budget"] is not None and budget.action == REPORT_ONLY:
+        report["clean"] = True
+
+    # 処理の途中で中断された場合は、ツリーが壊れている可能性があるため最後に完了した処理の結果に戻す
+    # 打ち切った処理で見つかった修正箇所はログにだけ残す
+    if report["budget"] is not None and report["budget"]["interrupted"] and budget.action != REPORT_ONLY:
+        report["budget"]["rolled_back_to"] = completed
+        xml_content, report["spliced"], report["changes"] = snapshot
+        report["clean"] = report["changes"] == 0
+        return xml_content, report
+
+    # 変更がなければ再出力せず、入力をそのまま返す
+    if report["clean"]:
+        return xml_content, report
+    with measure(timings, "serialize"):
+        xml_content, report["spliced"] = serialize()
+    return xml_content, report
+
+
+def proofread(docx_bytes, progress=None, scope=None, include_nested=False, splice=False, budget=None,
+              compress_level=DEFAULT_LEVEL):
+    """
+    wordファイルのバイト列を校閲し、(校閲後のwordファイルのバイト列, レポート) を返す。
+    レポートの内容は run_stages() を参照。
+    scope (Scope) を指定した場合は範囲内の段落だけを校閲する。
+    include_nested=True の場合は表や図、テキストボックスの中の段落も校閲する。
+    splice=True の場合は変更した段落だけを元の document.xml に差し込み、それ以外の段落は元の内容のまま残す。
+    scope を指定した場合は、範囲外の段落を元のバイト列のまま残すため、常に差し込みを行う。
+    修正箇所がない場合はwordファイルを再構築せず、入力のバイト列をそのまま返す。
+    事前の走査で修正箇所がないと判定できた場合は、XMLの解析も行わない。
+    budget (Budget) を指定した場合は、<w:t>要素の結合と各処理に時間とメモリの上限を設ける（run_stages() を参照）。
+    <w:t>要素の結合中に上限を超えた場合は、入力のバイト列をそのまま返す。
+    compress_level には校閲後のwordファイルの圧縮レベル(1〜9)を指定する。0 の場合は圧縮せずに格納する。
+    校閲後のwordファイルは main.py と同じ方法で作成するため、同じ内容からは常に同じバイト列になる。
+    レポートの timings には preflight, combine, rebuild の所要時間も含まれる。
+    """
+    timings = {}
+    if budget is not None:
+        budget.start()
+    with measure(timings, "preflight"):
+        document_xml = read_document_xml(docx_bytes)
+        stages = scan_document_xml(document_xml, include_nested=include_nested)
+    if not stages:
+        report = new_report(stages)
+        report["timings"].update(timings)
+        return docx_bytes, report
+    try:
+        if budget is not None:
+            budget.check("extract")
+        with measure(timings, "combine"), enforce(budget):
+            xml_content = combine_runs_in_xml(document_xml, include_nested=include_nested,
+                                              progress=budget.watch(progress) if budget is not None else progress)
+    except BudgetExceeded:
+        report = new_report(stages)
+        report["budget"] = budget.describe()
+        report["timings"].update(timings)
+        return docx_bytes, report
+    xml_content, report = run_stages(xml_content, progress=progress, stages=stages, scope=scope,
+                                     include_nested=include_nested, base_xml=document_xml if splice or scope is not None else None,
+                                     budget=budget)
+    report["timings"] = {**timings, **report["timings"]}
+    if report["clean"]:
+        return docx_bytes, report
+    with measure(report["timings"], "rebuild"):
+        output = rebuild_docx_bytes(docx_bytes, {"word/document.xml": xml_content.encode("utf-8")},
+                                    level=compress_level)
+    return output, report
@@ -1,28 +1,209 @@
 """
 このファイルではxmlファイルをwordファイルに再構築します。
+
+create_docx() と、メモリ上で作成する rebuild_docx_bytes() は、同じ入力から常に同じバイト列のwordファイルを作成します。
+- メンバーは元のwordファイルと同じ順序で格納し、[Content_Types].xml を必ず先頭にする
+- 更新日時やファイルの属性はディスク上の値を使わず、固定の値にする
+- 各メンバーの圧縮は複数のスレッドで並列に行う（zlibは圧縮中にGILを解放するため、スレッドで並列化できる）
+  wordファイルの大部分は document.xml が占めるため、大きなメンバーは一定の大きさのブロックに分けて並列に圧縮し、
+  deflateのストリームとして連結する（直前のブロックの末尾を辞書に使用するため、圧縮率はほぼ変わらない）
+圧縮の済んだデータを格納するため、ZIPの構造(ローカルヘッダ、セントラルディレクトリ)はここで書き出します。
 """
 # 分解したxmlを.docxに再構築するためのコード
 
+import io
+import struct
 import zipfile
+import zlib
 import os
+from concurrent.futures import ThreadPoolExecutor
 from make_xml_from_wordfile import get_docx_file
 
-# パスの設定
-file_path = get_docx_file("data")
-core_filename = os.path.splitext(os.path.basename(file_path))[0]
-xml_dir = 'xml_new'  # 解凍先のフォルダ
-output_docx = f"【校閲ずみ】{core_filename}.docx"  # 出力するWordファイル
+# 圧縮レベルの既定値（zipfile の既定と同じ）。0 を指定した場合は圧縮せずに格納する
+DEFAULT_LEVEL = 6
+STORED_LEVEL = 0
+
+# 並列に圧縮するブロックの大きさと、辞書として使用する直前のブロックの末尾の大きさ
+# ブロックの大きさはスレッド数によらず一定のため、出力はスレッド数に依存しない
+BLOCK_SIZE = 1024 * 1024
+DICTIONARY_SIZE = 32 * 1024
+
+# wordファイルの先頭に格納するメンバー
+CONTENT_TYPES = "[Content_Types].xml"
+
+# 全てのメンバーに設定する更新日時（ZIPで表現できる最も古い日時 1980-01-01 00:00:00）
+FIXED_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+# ZIPの各構造のシグネチャと形式
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+END_RECORD = struct.Struct("<IHHHHIIH")
+LOCAL_SIGNATURE = 0x04034b50
+CENTRAL_SIGNATURE = 0x02014b50
+END_SIGNATURE = 0x06054b50
+
+# 展開に必要なバージョン（格納は1.0、deflateは2.0）とファイル名がUTF-8であることを示すフラグ
+VERSION_STORED = 10
+VERSION_DEFLATED = 20
+FLAG_UTF8 = 0x800
+
+# ZIP64を使用しない場合の上限
+ZIP_LIMIT = 0xFFFFFFFF
+ZIP_MEMBER_LIMIT = 0xFFFF
+
+
+def dos_date_time(date_time):
+    """
+    (年, 月, 日, 時, 分, 秒) をZIPのヘッダに格納する (日付, 時刻) の値に変換する。
+    """
+    year, month, day, hour, minute, second = date_time
+    return (year - 1980) << 9 | month << 5 | day, hour << 11 | minute << 5 | second // 2
+
+
+def compress_block(data, start, level=DEFAULT_LEVEL):
+    """
+    data の start から BLOCK_SIZE バイトを圧縮したdeflateのデータを返す。
+    最後のブロック以外はストリームを終了せずバイト境界で区切るため、各ブロックの結果を連結すると1つのストリームになる。
+    """
+    end = start + BLOCK_SIZE
+    if start:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                      zdict=data[max(start - DICTIONARY_SIZE, 0):start])
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data[start:end]) + compressor.flush(zlib.Z_FINISH if end >= len(data)
+                                                                    else zlib.Z_SYNC_FLUSH)
+
+
+def compress_members(members, level=DEFAULT_LEVEL, executor=None):
+    """
+    members の各メンバーの内容を圧縮し、[(CRC-32, 圧縮後のデータ), ...] を返す。level が 0 の場合は圧縮しない。
+    executor を指定した場合は、メンバーをブロックに分けて並列に圧縮する。
+    """
+    if level == STORED_LEVEL:
+        return [(zlib.crc32(data), data) for _, data in members]
+
+    # 空のメンバーも1つのブロックとして圧縮する（空のストリームを終了させるため）
+    starts = [range(0, max(len(data), 1), BLOCK_SIZE) for _, data in members]
+    blocks = [(data, start) for (_, data), member_starts in zip(members, starts) for start in member_starts]
+    if executor is not None:
+        payloads = executor.map(lambda block: compress_block(*block, level), blocks)
+    else:
+        payloads = (compress_block(*block, level) for block in blocks)
 
-def create_docx(folder_path, output_docx):
+    compressed = []
+    for (_, data), member_starts in zip(members, starts):
+        payload = b"".join(next(payloads) for _ in member_starts)
+        compressed.append((zlib.crc32(data), payload))
+    return compressed
+
+
+def member_order(names, template=None):
+    """
+    メンバー名を格納する順序に並べたリストを返す。
+    template (元のwordファイルのパスまたはバイト列) を指定した場合はその順序に合わせ、
+    元のwordファイルにないメンバーは名前の順に後ろに追加する。[Content_Types].xml は必ず先頭にする。
+    """
+    remaining = set(names)
+    ordered = []
+    if template is not None:
+        source = io.BytesIO(template) if isinstance(template, bytes) else template
+        with zipfile.ZipFile(source, 'r') as zip_ref:
+            for name in zip_ref.namelist():
+                if name in remaining:
+                    ordered.append(name)
+                    remaining.remove(name)
+    ordered.extend(sorted(remaining))
+    if CONTENT_TYPES in ordered:
+        ordered.remove(CONTENT_TYPES)
+        ordered.insert(0, CONTENT_TYPES)
+    return ordered
+
+
+def write_docx(output, members, level=DEFAULT_LEVEL, threads=None):
+    """
+    members ([(メンバー名, 内容のバイト列), ...]) をその順序でZIP形式にして output (書き込み可能なファイル) に書き出す。
+    各メンバーはブロックに分け、threads 個のスレッドで並列に圧縮する（既定はCPUの数）。
+    更新日時と属性は固定の値にするため、同じ members からは常に同じバイト列になる。
+    """
+    if not 0 <= level <= 9:
+        raise ValueError(f"圧縮レベルには0〜9を指定してください: {level}")
+    if len(members) > ZIP_MEMBER_LIMIT:
+        raise ValueError(f"メンバーの数が多すぎます: {len(members)}")
+    method = zipfile.ZIP_STORED if level == STORED_LEVEL else zipfile.ZIP_DEFLATED
+    version = VERSION_STORED if level == STORED_LEVEL else VERSION_DEFLATED
+    date, time_of_day = dos_date_time(FIXED_DATE_TIME)
+
+    with ThreadPoolExecutor(max_workers=threads or os.cpu_count() or 1) as executor:
+        compressed = compress_members(members, level, executor)
+
+    central = []
+    offset = 0
+    for (name, data), (crc, payload) in zip(members, compressed):
+        encoded = name.encode('utf-8')
+        flags = 0 if encoded.isascii() else FLAG_UTF8
+        if len(data) > ZIP_LIMIT or len(payload) > ZIP_LIMIT or offset > ZIP_LIMIT:
+            raise ValueError(f"{name} が大きすぎるため格納できません")
+        output.write(LOCAL_HEADER.pack(LOCAL_SIGNATURE, version, flags, method, time_of_day, date,
+                                       crc, len(payload), len(data), len(encoded), 0))
+        output.write(encoded)
+        output.write(payload)
+        central.append(CENTRAL_HEADER.pack(CENTRAL_SIGNATURE, version, version, flags, method, time_of_day, date,
+                                           crc, len(payload), len(data), len(encoded), 0, 0, 0, 0, 0, offset)
+                       + encoded)
+        offset += LOCAL_HEADER.size + len(encoded) + len(payload)
+
+    directory = b"".join(central)
+    output.write(directory)
+    output.write(END_RECORD.pack(END_SIGNATURE, 0, 0, len(central), len(central), len(directory), offset, 0))
+
+
+def create_docx(folder_path, output_docx, template=None, level=DEFAULT_LEVEL, threads=None):
     """
     xmlファイルをwordファイルに変換する
+    template に元のwordファイルを指定した場合は、メンバーをその順序で格納する（member_order() を参照）。
+    level には圧縮レベル(1〜9)を指定する。0 の場合は圧縮せずに格納する。
+    圧縮は threads 個のスレッドで並列に行い、同じxmlファイルからは常に同じバイト列のwordファイルを作成する。
+    """
+    paths = {}
+    for foldername, subfolders, filenames in os.walk(folder_path):
+        for filename in filenames:
+            file_path = os.path.join(foldername, filename)
+            arcname = os.path.relpath(file_path, folder_path).replace(os.sep, "/")
+            paths[arcname] = file_path
+
+    members = []
+    for name in member_order(paths, template):
+        with open(paths[name], 'rb') as file:
+            members.append((name, file.read()))
+
+    with open(output_docx, 'wb') as docx:
+        write_docx(docx, members, level=level, threads=threads)
+
+def rebuild_docx_bytes(docx_bytes, replacements, level=DEFAULT_LEVEL, threads=None):
+    """
+    メモリ上のwordファイル(バイト列)を元に、replacements で指定したメンバーだけを差し替えたwordファイルをバイト列で返す。
+    replacements はメンバー名(例: "word/document.xml")と新しい内容(バイト列)の辞書。
+    create_docx() と同じくメンバーを元のwordファイルの順序で格納し（member_order() を参照）、write_docx() で書き出すため、
+    同じ内容からは create_docx() と同じバイト列になる。level と threads は create_docx() と同じ。
     """
-    with zipfile.ZipFile(output_docx, 'w', zipfile.ZIP_DEFLATED) as docx:
-        for foldername, subfolders, filenames in os.walk(folder_path):
-            for filename in filenames:
-                file_path = os.path.join(foldername, filename)
-                arcname = os.path.relpath(file_path, folder_path)
-                docx.write(file_path, arcname)
+    with zipfile.ZipFile(io.BytesIO(docx_bytes), 'r') as source:
+        # ディレクトリの項目は create_docx() と同じく格納しない
+        contents = {name: source.read(name) for name in source.namelist() if not name.endswith("/")}
+    contents.update(replacements)
+    members = [(name, contents[name]) for name in member_order(contents, docx_bytes)]
+
+    output = io.BytesIO()
+    write_docx(output, members, level=level, threads=threads)
+    return output.getvalue()
+
+# このスクリプトが直接実行された場合のみ、以下のコードが動作するようにする
+if __name__ == "__main__":
+    # パスの設定
+    file_path = get_docx_file("data")
+    core_filename = os.path.splitext(os.path.basename(file_path))[0]
+    xml_dir = 'xml_new'  # 解凍先のフォルダ
+    output_docx = f"【校閲ずみ】{core_filename}.docx"  # 出力するWordファイル
 
-# 再度ZIPファイルとしてまとめる
-create_docx(xml_dir, output_docx)
\ No newline at end of file
+    # 再度ZIPファイルとしてまとめる（メンバーは元のwordファイルと同じ順序で格納する）
+    create_docx(xml_dir, output_docx, template=file_path)
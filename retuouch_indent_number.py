@@ -4,6 +4,10 @@
 """
 import re
 from lxml import etree as ET
+from progress import report_progress
+from change_tracker import ChangeTracker, mark_changed
+from text_cache import LRUCache
+from traversal import body_paragraphs, first_child, paragraph_runs, W_T, W_TAB, W_RPR, W_HIGHLIGHT
 
 # WordprocessingMLの名前空間を定義
 ns = {'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'}
@@ -29,221 +33,255 @@ bracket_patterns = {
     9: (r"^\([a-z]-\d+-\d+\)", "(", ")")     # レベル9: 例 "(a-1-1)"
 }
 
-def highlight_text(run):
-    """指定された<w:r>要素にハイライトを追加する。"""
-    rPr = run.find('.//w:rPr', namespaces=ns)
+def highlight_text(run, tracker=None):
+    """指定された<w:r>要素にハイライトを追加する。既に黄色のハイライトがある場合は何もしない。"""
+    rPr = first_child(run, W_RPR)
     if rPr is None:
         rPr = ET.SubElement(run, '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}rPr')
     
-    highlight = rPr.find('.//w:highlight', namespaces=ns)
+    highlight = first_child(rPr, W_HIGHLIGHT)
     if highlight is not None:
+        if highlight.get('{http://schemas.openxmlformats.org/wordprocessingml/2006/main}val') == 'yellow':
+            return
         rPr.remove(highlight)
 
+    mark_changed(tracker, run)
+
     new_highlight = ET.SubElement(rPr, '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}highlight')
     new_highlight.set('{http://schemas.openxmlformats.org/wordprocessingml/2006/main}val', 'yellow')
 
-def adjust_space_level1_4(paragraph, log):
+def space_level1_4(text, run_info):
     """
     レベル1〜4の項目番号の後に全角スペースを1つだけ挿入する。
     既に全角スペースがある場合は何もしない。
     スペースが連続して入っている場合、それらを削除する。
     """
-    runs = paragraph.findall(".//w:r", namespaces=ns)
-
-    for run_index, run in enumerate(runs):
-        # <w:t>要素を取得
-        w_t = run.find(".//w:t", namespaces=ns)
-        if w_t is None or not w_t.text:
-            continue
-
-        # この<w:t>の前に<w:tab/>があるか確認
-        skip = False
-        for previous_run in runs[:run_index]:  # 現在のrunの前にあるrunを確認
-            if previous_run.find(".//w:tab", namespaces=ns) is not None:
-                skip = True
-                break
-
-        if skip:
-            continue  # <w:tab/>が見つかった場合、項目番号ではないためこの<w:t>の処理をスキップ
-
-        original_text = w_t.text.strip()
-
-        # レベル1〜4の処理
-        for level, pattern in level_patterns.items():
-            if level in [1, 2, 3, 4]:
-                match = re.match(pattern, original_text)
-                if match:
-                    item_number = match.group(0)
-                    after_item_number = original_text[len(item_number):]
-
-                    # 全角スペースまたは半角スペースが2つ以上ある場合は削除して全角スペース1つにする
-                    after_item_number = re.sub(r"^[ 　]+", "", after_item_number)
-                    new_text = item_number + "　" + after_item_number
-                    if new_text != w_t.text:
-                        w_t.text = new_text
-                        log_entry = f"レベル{level}: 元のテキスト: '{original_text}' -> 補完後のテキスト: '{new_text}'"
-                        log.append(log_entry)
-                        highlight_text(run)
-
-def adjust_level6(paragraph, log):
+    # この<w:t>の前に<w:tab/>がある場合は項目番号ではないため処理をスキップ
+    if run_info["tab_before"]:
+        return []
+
+    changes = []
+    original_text = text.strip()
+
+    # レベル1〜4の処理
+    for level, pattern in level_patterns.items():
+        if level in [1, 2, 3, 4]:
+            match = re.match(pattern, original_text)
+            if match:
+                item_number = match.group(0)
+                after_item_number = original_text[len(item_number):]
+
+                # 全角スペースまたは半角スペースが2つ以上ある場合は削除して全角スペース1つにする
+                after_item_number = re.sub(r"^[ 　]+", "", after_item_number)
+                new_text = item_number + "　" + after_item_number
+                if new_text != text:
+                    changes.append((new_text, f"レベル{level}: 元のテキスト: '{original_text}' -> 補完後のテキスト: '{new_text}'"))
+                    text = new_text
+    return changes
+
+def period_level6(text, run_info):
     """
     レベル6の場合の処理
     全角アルファベットの直後のピリオドやスペースを修正します。
-
     """
-    runs = paragraph.findall(".//w:r", namespaces=ns)
-    # テキストを取得する
-    for run in runs:
-        w_t = run.find(".//w:t", namespaces=ns)
-        if w_t is None or not w_t.text:
+    original_text = text
+
+    # 全角小文字アルファベットの後にピリオドが続くかどうかのパターンを検出
+    match = re.match(r"([ａ-ｚ])(.*)", original_text)  # 全角小文字アルファベットにマッチ
+    if not match:
+        return []
+    letter = match.group(1)  # 全角小文字アルファベット
+    after_letter = match.group(2)  # アルファベットの後の文字列
+
+    # ピリオドがない場合
+    if not after_letter.startswith("．") and not after_letter.startswith("."):
+        # 全角ピリオドを追加
+        new_text = f"{letter}．{after_letter.strip()}"
+        message = "全角ピリオド追加"
+    # 半角ピリオドがある場合、全角に変換
+    elif after_letter.startswith("."):
+        new_text = f"{letter}．{after_letter[1:].strip()}"  # 半角ピリオドを全角にし、スペースを削除
+        message = "半角ピリオド修正"
+    # 全角ピリオドがあり、その後に余分なスペースがある場合
+    else:
+        # 余分なスペースを削除して正しいフォーマットに修正
+        after_period = after_letter[1:].lstrip()  # 全角ピリオド後の余分なスペースを削除
+        new_text = f"{letter}．{after_period}"
+        message = "全角ピリオド後のスペース削除"
+
+    if new_text == original_text:
+        return []
+    return [(new_text, f"{message}: '{original_text}' -> '{new_text}'")]
+
+def brackets_level5_9(text, run_info):
+    """
+    レベル5,7,8,9のカッコを補完する処理。項目番号がある場合のみ片方のカッコを補完
+    """
+    # <w:tab/>があれば補完処理をスキップ
+    if run_info["has_tab"]:
+        return []
+
+    changes = []
+    original_text = text.strip()
+
+    # カッコが片方欠けている項目番号の検出
+    item_number_match = re.match(r"^(\()?([a-zA-Z0-9]+)(\))?", original_text)
+
+    # 項目番号が見つからなかった場合はスキップ
+    if not item_number_match:
+        return changes
+
+    # 項目番号部分を抽出
+    open_bracket = item_number_match.group(1)  # 開始カッコ
+    number = item_number_match.group(2)        # 項目番号
+    close_bracket = item_number_match.group(3) # 終了カッコ
+
+    # 欠けているカッコを補完するロジック
+    new_text = original_text
+    if open_bracket is None and close_bracket is not None:
+        # 開始カッコを補完する
+        new_text = f"({number}{original_text[len(number):]}"
+    elif open_bracket is not None and close_bracket is None:
+        # 終了カッコを補完する
+        new_text = f"{original_text[:len(number)+1]}){original_text[len(number)+1:]}"
+
+    # 元のカッコを保持しつつ、欠けた方のみ補完する
+    if new_text != original_text:
+        changes.append((new_text, f"カッコ補完: 元のテキスト: '{original_text}' -> 補完後のテキスト: '{new_text}'"))
+        text = new_text
+
+    # スペース処理
+    # カッコ補完が行われた項目番号に一致するものだけ処理
+    item_number_match = re.match(r"^\([a-zA-Z0-9]+\)|^\([a-z]\)|^[a-z]\)", new_text)  # b)の場合、(b)として欠けている括弧を補完する
+
+    if item_number_match:
+        # 項目番号の後の文字列を取得（スペースや文字列をそのまま取得）
+        after_item_number = new_text[len(item_number_match.group(0)):]  # 項目番号の後ろをそのまま取得
+
+        # 正しく半角スペースが置かれている場合は何もしない
+        if after_item_number.startswith(" "):
+            return changes  # 半角スペースが1つだけの場合はスキップ
+
+        # 項目番号の後ろに全角または複数のスペースがある場合
+        if re.match(r"[ 　]{2,}", after_item_number) or re.match(r"^[　]+", after_item_number):
+            # 全角スペースや複数のスペースを削除し、半角スペース1つだけにする
+            after_item_number = re.sub(r"[ 　]+", " ", after_item_number).lstrip()
+            new_text = f"{item_number_match.group(0)} {after_item_number}"
+            message = "スペース修正"
+
+        # 項目番号の後ろにスペースが全くない場合（日本語や英数字が直接続いている場合）
+        else:
+            new_text = f"{item_number_match.group(0)} {after_item_number}"  # 半角スペースを追加
+            message = "スペース追加"
+
+        if new_text != text:  # テキストが変更された場合のみ実行
+            changes.append((new_text, f"{message}: '{original_text}' -> '{new_text}'"))
+    return changes
+
+def leading_spaces(text, run_info):
+    """
+    <w:t>要素の先頭に全角・半角スペースがある場合、それを削除する処理
+    """
+    new_text = text.lstrip(" 　")  # 先頭の全角・半角スペースを削除
+    if new_text == text:
+        return []
+    return [(new_text, f"先頭スペース削除: 元のテキスト: '{text}' -> 修正後のテキスト: '{new_text}'")]
+
+# 項目番号の補完ルール（この順に適用する）
+# 各ルールは (<w:t>のテキスト, ランの情報) を受け取り、(修正後のテキスト, ログ) のリストを返す
+# 新しいルールはこのリストに追加する
+bracket_rules = [
+    brackets_level5_9,  # レベル5,7,8,9のカッコ補完とスペース処理
+    space_level1_4,     # レベル1〜4の処理
+    period_level6,      # レベル6の処理
+    leading_spaces,     # 先頭スペースの削除
+]
+
+# (<w:t>のテキスト, ランの情報) -> bracket_rules の適用結果 のキャッシュ
+repair_cache = LRUCache("bracket_repair")
+
+def apply_rules(text, run_info, rules):
+    """
+    テキストに rules を順に適用し、(ルールの番号, 修正後のテキスト, ログ) のタプルを返す。
+    """
+    steps = []
+    for rule_index, rule in enumerate(rules):
+        if not text:
             continue
+        for new_text, log_entry in rule(text, run_info):
+            text = new_text
+            steps.append((rule_index, new_text, log_entry))
+    return tuple(steps)
 
-        original_text = w_t.text
-
-        # 全角小文字アルファベットの後にピリオドが続くかどうかのパターンを検出
-        match = re.match(r"([ａ-ｚ])(.*)", original_text)  # 全角小文字アルファベットにマッチ
-        if match:
-            letter = match.group(1)  # 全角小文字アルファベット
-            after_letter = match.group(2)  # アルファベットの後の文字列
-
-            # ピリオドがない場合
-            if not after_letter.startswith("．") and not after_letter.startswith("."):
-                # 全角ピリオドを追加
-                new_text = f"{letter}．{after_letter.strip()}"
-
-                if new_text != original_text:
-                    w_t.text = new_text
-                    log_entry = f"全角ピリオド追加: '{original_text}' -> '{new_text}'"
-                    log.append(log_entry)
-                    highlight_text(run)
-                continue
-
-            # 半角ピリオドがある場合、全角に変換
-            if after_letter.startswith("."):
-                new_text = f"{letter}．{after_letter[1:].strip()}"  # 半角ピリオドを全角にし、スペースを削除
-
-                if new_text != original_text:
-                    w_t.text = new_text
-                    log_entry = f"半角ピリオド修正: '{original_text}' -> '{new_text}'"
-                    log.append(log_entry)
-                    highlight_text(run)
-                continue
-
-            # 全角ピリオドがあり、その後に余分なスペースがある場合
-            if after_letter.startswith("．"):
-                # 余分なスペースを削除して正しいフォーマットに修正
-                after_period = after_letter[1:].lstrip()  # 全角ピリオド後の余分なスペースを削除
-                new_text = f"{letter}．{after_period}"
-
-                if new_text != original_text:
-                    w_t.text = new_text
-                    log_entry = f"全角ピリオド後のスペース削除: '{original_text}' -> '{new_text}'"
-                    log.append(log_entry)
-                    highlight_text(run)
-
-def adjust_brackets_level5_9(paragraph, log):
+def visit_paragraph(paragraph, log, rules=bracket_rules, tracker=None):
     """
-    レベル5,7,8,9のカッコを補完する処理。項目番号がある場合のみ片方のカッコを補完
+    段落内の<w:r>と<w:t>を1回だけ取得し、各<w:t>のテキストに rules を順に適用する。
+    テキストは全てのルールを適用した後に1回だけ書き戻し、変更のあったランにはハイライトを追加する。
+    ログは修正ごとに1件とし、ルールの順にまとめて log に追加する。
+    既定のルールの適用結果はテキストとランの情報ごとにキャッシュする。
     """
-    runs = paragraph.findall(".//w:r", namespaces=ns)
-    
+    runs = paragraph_runs(paragraph)
+    logs = [[] for _ in rules]
+    tab_before = False
+
     for run in runs:
-        # <w:tab/>の存在をチェック
-        tab_before_wt = run.find(".//w:tab", namespaces=ns)
-        if tab_before_wt is not None:
-            continue  # <w:tab/>があれば補完処理をスキップ
+        has_tab = first_child(run, W_TAB) is not None
+        run_info = {"has_tab": has_tab, "tab_before": tab_before}
+        tab_before = tab_before or has_tab
 
-        w_t = run.find(".//w:t", namespaces=ns)
-        if w_t is None or not w_t.text:
+        # <w:t>要素を取得
+        w_t = first_child(run, W_T)
+        if w_t is None:
             continue
 
-        original_text = w_t.text.strip()
+        text = w_t.text
+        if rules is bracket_rules:
+            key = (text, has_tab, run_info["tab_before"])
+            steps = repair_cache.get_or_compute(key, lambda: apply_rules(text, run_info, rules))
+        else:
+            steps = apply_rules(text, run_info, rules)
 
-        # カッコが片方欠けている項目番号の検出
-        item_number_match = re.match(r"^(\()?([a-zA-Z0-9]+)(\))?", original_text)
+        for rule_index, new_text, log_entry in steps:
+            mark_changed(tracker, w_t)
+            logs[rule_index].append(log_entry)
 
-        # 項目番号が見つからなかった場合はスキップ
-        if not item_number_match:
-            continue
+        if steps:
+            w_t.text = steps[-1][1]
+            highlight_text(run, tracker)
+
+    for rule_log in logs:
+        log.extend(rule_log)
 
-        # 項目番号部分を抽出
-        open_bracket = item_number_match.group(1)  # 開始カッコ
-        number = item_number_match.group(2)        # 項目番号
-        close_bracket = item_number_match.group(3) # 終了カッコ
-
-        # 欠けているカッコを補完するロジック
-        new_text = original_text
-        if open_bracket is None and close_bracket is not None:
-            # 開始カッコを補完する
-            new_text = f"({number}{original_text[len(number):]}"
-        elif open_bracket is not None and close_bracket is None:
-            # 終了カッコを補完する
-            new_text = f"{original_text[:len(number)+1]}){original_text[len(number)+1:]}"
-
-        # 元のカッコを保持しつつ、欠けた方のみ補完する
-        if new_text != original_text:
-            w_t.text = new_text
-            log_entry = f"カッコ補完: 元のテキスト: '{original_text}' -> 補完後のテキスト: '{new_text}'"
-            log.append(log_entry)
-            highlight_text(run)  # ハイライトを適用
-
-        # スペース処理
-        # カッコ補完が行われた項目番号に一致するものだけ処理
-        item_number_match = re.match(r"^\([a-zA-Z0-9]+\)|^\([a-z]\)|^[a-z]\)", new_text)  # b)の場合、(b)として欠けている括弧を補完する
-
-        if item_number_match:
-            # 項目番号の後の文字列を取得（スペースや文字列をそのまま取得）
-            after_item_number = new_text[len(item_number_match.group(0)):]  # 項目番号の後ろをそのまま取得
-
-            # 正しく半角スペースが置かれている場合は何もしない
-            if after_item_number.startswith(" "):
-                continue  # 半角スペースが1つだけの場合はスキップ
-
-            # 項目番号の後ろに全角または複数のスペースがある場合
-            if re.match(r"[ 　]{2,}", after_item_number) or re.match(r"^[　]+", after_item_number):  
-                # 全角スペースや複数のスペースを削除し、半角スペース1つだけにする
-                after_item_number = re.sub(r"[ 　]+", " ", after_item_number).lstrip()
-                new_text = f"{item_number_match.group(0)} {after_item_number}"
-
-                if new_text != w_t.text:  # テキストが変更された場合のみ実行
-                    w_t.text = new_text
-                    log_entry = f"スペース修正: '{original_text}' -> '{new_text}'"
-                    log.append(log_entry)
-                    highlight_text(run)  # ハイライト適用
-
-            # 項目番号の後ろにスペースが全くない場合（日本語や英数字が直接続いている場合）
-            else:
-                new_text = f"{item_number_match.group(0)} {after_item_number}"  # 半角スペースを追加
-
-                if new_text != w_t.text:  # テキストが変更された場合のみ実行
-                    w_t.text = new_text
-                    log_entry = f"スペース追加: '{original_text}' -> '{new_text}'"
-                    log.append(log_entry)
-                    highlight_text(run)  # ハイライト適用
-
-def remove_leading_spaces(paragraph, log):
+def adjust_brackets_level5_9(paragraph, log, tracker=None):
     """
-    <w:t>要素の先頭に全角・半角スペースがある場合、それを削除する処理
+    レベル5,7,8,9のカッコ補完とスペース処理だけを段落に適用する。
     """
-    runs = paragraph.findall(".//w:r", namespaces=ns)
-    
-    for run in runs:
-        w_t = run.find(".//w:t", namespaces=ns)
-        if w_t is None or not w_t.text:
-            continue
+    visit_paragraph(paragraph, log, [brackets_level5_9], tracker)
 
-        original_text = w_t.text
-        new_text = original_text.lstrip(" 　")  # 先頭の全角・半角スペースを削除
+def adjust_space_level1_4(paragraph, log, tracker=None):
+    """
+    レベル1〜4の項目番号の後のスペース処理だけを段落に適用する。
+    """
+    visit_paragraph(paragraph, log, [space_level1_4], tracker)
 
-        if new_text != original_text:
-            w_t.text = new_text
-            log_entry = f"先頭スペース削除: 元のテキスト: '{original_text}' -> 修正後のテキスト: '{new_text}'"
-            log.append(log_entry)
-            highlight_text(run)
+def adjust_level6(paragraph, log, tracker=None):
+    """
+    レベル6のピリオドとスペースの修正だけを段落に適用する。
+    """
+    visit_paragraph(paragraph, log, [period_level6], tracker)
+
+def remove_leading_spaces(paragraph, log, tracker=None):
+    """
+    <w:t>要素の先頭スペースの削除だけを段落に適用する。
+    """
+    visit_paragraph(paragraph, log, [leading_spaces], tracker)
 
-def process_brackets_in_xml(xml_content):
+def process_brackets_in_xml(xml_content, progress=None, tracker=None, include_nested=False):
     """
     XML文書を解析し、全体の補完処理を実行
+    progress を指定した場合は一定の段落数ごとに進捗を通知する
+    tracker を指定した場合は文書に加えた変更の数を記録する
+    include_nested=True の場合は表や図、テキストボックスの中の段落も処理する
     """
     try:
         parser = ET.XMLParser(remove_blank_text=True)
@@ -252,14 +290,30 @@ def process_brackets_in_xml(xml_content):
         raise ValueError(f"XMLの解析中にエラーが発生しました: {e}")
 
     log = []
+    stage_tracker = ChangeTracker()
+    process_brackets_in_tree(tree, log, progress=progress, tracker=stage_tracker, include_nested=include_nested)
+    if tracker is not None:
+        tracker.changes += stage_tracker.changes
+
+    # 変更がなければ再出力せず、入力をそのまま返す
+    if not stage_tracker.dirty:
+        return xml_content, log
 
-    for paragraph in tree.findall(".//w:p", namespaces=ns):
-        adjust_brackets_level5_9(paragraph, log)  # レベル5,7,8,9のカッコ補完とスペース処理
-        adjust_space_level1_4(paragraph, log)  # レベル1〜4の処理（変更なし）
-        adjust_level6(paragraph, log)  # レベル6の処理
-        remove_leading_spaces(paragraph, log)
+    return ET.tostring(tree, encoding='unicode'), log
 
-    return ET.tostring(tree, encoding='unicode', pretty_print=True), log
+def process_brackets_in_tree(root, log, progress=None, tracker=None, paragraphs=None, include_nested=False):
+    """
+    解析済みのXMLの全ての段落に対して補完処理を実行する
+    tracker を指定した場合は文書に加えた変更を記録する
+    paragraphs を指定した場合はその段落だけを処理する
+    include_nested=True の場合は表や図、テキストボックスの中の段落も処理する
+    """
+    if paragraphs is None:
+        paragraphs = body_paragraphs(root, include_nested)
+    total = len(paragraphs)
+    for index, paragraph in enumerate(paragraphs, 1):
+        report_progress(progress, "brackets", index, total)
+        visit_paragraph(paragraph, log, tracker=tracker)  # 全ての補完ルールを1回の走査で適用
 
 # このスクリプトが直接実行された場合のみ、以下のコードが動作するようにする
 if __name__ == "__main__":
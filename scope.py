@@ -0,0 +1,99 @@
+"""
+このファイルでは校閲の対象範囲(スコープ)を扱います。
+範囲はレベル1・レベル2の項目番号(例: "7"、"7.2"、"7:9")または段落の番号(例: "120:340")で指定します。
+範囲より前の段落は文書を変更せずに読み進め(早送り)、連番とインデントの処理状態だけを求めます。
+その状態を引き継いで範囲内の段落だけを校閲するため、範囲外の段落は変更されません。
+範囲より前の段落は項目番号の形式修正を行わず、文書のままのテキストで処理状態を求めます。
+"""
+import io
+import re
+from update_indent_number import parse_paragraph, extract_number, NumberingState, number_paragraphs
+from update_indent_level import new_indent_state, apply_indent_levels
+
+# 範囲の指定に使用できる項目番号（レベル1: "7"、レベル2: "7.2"）
+HEADING_PATTERN = re.compile(r"^\d+(\.\d+)?$")
+
+
+def parse_heading(value):
+    """
+    "7" や "7.2" のような項目番号を (レベル, 番号のリスト) に変換する。
+    """
+    value = value.strip().rstrip(".")
+    if not HEADING_PATTERN.match(value):
+        raise ValueError(f"範囲にはレベル1またはレベル2の項目番号を指定してください: '{value}'")
+    numbers = [int(number) for number in value.split(".")]
+    return len(numbers), numbers
+
+
+def find_heading(paragraphs, heading, start=0):
+    """
+    start 以降の段落から、指定された項目番号の段落の番号を返す。
+    """
+    level, numbers = heading
+    for index in range(start, len(paragraphs)):
+        paragraph_level, text = parse_paragraph(paragraphs[index])
+        if paragraph_level == level and extract_number(text, level)[:level] == numbers:
+            return index
+    raise ValueError(f"項目番号 {'.'.join(map(str, numbers))} の段落が見つかりませんでした。")
+
+
+def section_end(paragraphs, index, level):
+    """
+    index の段落から始まる項目の終わり（同じかより上位のレベルの次の項目番号の段落の番号）を返す。
+    """
+    for next_index in range(index + 1, len(paragraphs)):
+        paragraph_level, _ = parse_paragraph(paragraphs[next_index])
+        if paragraph_level is not None and paragraph_level <= level:
+            return next_index
+    return len(paragraphs)
+
+
+class Scope:
+    """
+    校閲の対象範囲。
+    section    -- 項目番号による範囲。"7" は7章全体、"7:9" は7章から9章まで、"7.2" は7.2節全体
+    paragraphs -- 段落の番号(0から数える)による範囲。"120:340" は120番目から339番目まで
+    """
+
+    def __init__(self, section=None, paragraphs=None):
+        if (section is None) == (paragraphs is None):
+            raise ValueError("範囲は項目番号か段落の番号のどちらか一方で指定してください。")
+        self.section = None
+        self.paragraphs = None
+        if section is not None:
+            first, _, last = section.partition(":")
+            self.section = (parse_heading(first), parse_heading(last or first))
+        else:
+            start, separator, end = paragraphs.partition(":")
+            if not separator:
+                raise ValueError(f"段落の範囲は '開始:終了' の形式で指定してください: '{paragraphs}'")
+            self.paragraphs = (int(start) if start else None, int(end) if end else None)
+
+    def resolve(self, paragraphs):
+        """
+        文書の全段落のリストに対する範囲を (開始, 終了) の段落の番号で返す（終了の段落は含まない）。
+        """
+        if self.paragraphs is not None:
+            return slice(*self.paragraphs).indices(len(paragraphs))[:2]
+
+        first, last = self.section
+        start = find_heading(paragraphs, first)
+        last_index = find_heading(paragraphs, last, start)
+        return start, section_end(paragraphs, last_index, last[0])
+
+
+def fast_forward(paragraphs, numbering_state=None, indent_state=None):
+    """
+    段落を文書を変更せずに読み進め、連番とインデントの処理状態を求める。
+    (連番の処理状態, インデントの処理状態) を返す。
+    """
+    if numbering_state is None:
+        numbering_state = NumberingState()
+    if indent_state is None:
+        indent_state = new_indent_state()
+    # 範囲外の段落の処理経過は出力しない
+    # 標準出力を差し替えると、同時に実行している他のスレッドの出力まで失われるため、quiet で抑止する
+    number_paragraphs(None, [], io.StringIO(), io.StringIO(), state=numbering_state, apply=False,
+                      paragraphs=paragraphs, quiet=True)
+    apply_indent_levels(None, [], state=indent_state, apply=False, paragraphs=paragraphs, quiet=True)
+    return numbering_state, indent_state
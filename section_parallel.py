@@ -0,0 +1,282 @@
+"""
+このファイルでは1つの大きなwordファイルを区間に分割し、複数のプロセスで並列に校閲します。
+レベル1の項目番号の段落で区切った区間を、段落数がほぼ均等になるようにまとめて処理単位とします。
+
+項目番号の連番やインデントの処理は前の段落の状態に依存するため、処理は次の3段階で行います。
+1. 項目番号の形式修正（段落ごとに独立した処理）を各区間で並列に実行する
+2. 親プロセスで区間を順に読み進めて各区間の開始時点の連番の処理状態を求め、連番修正を各区間で並列に実行する
+   親プロセスでは項目番号の判定と番号の計算だけを行い、文書の変更は行わない
+   （連番の処理状態は段落のテキストの変更に影響されないため、変更前のテキストから求めた状態と一致する）
+3. インデント修正を各区間で並列に実行する
+   インデントの処理状態は連番修正後のテキストに依存するため、2段階目の各ワーカーが区間を通した状態の変化を求めて返し、
+   親プロセスはそれを順に適用して各区間の開始時点の状態を求め、連番修正の結果が届いた区間から順にインデント修正を送り出す
+最後に各区間の結果を元の順序で文書に戻します。
+"""
+import copy
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from lxml import etree as ET
+from make_xml_from_wordfile import read_document_xml, combine_runs_in_xml
+from retuouch_indent_number import process_brackets_in_xml
+from update_indent_number import ns, parse_paragraph, NumberingState, number_paragraphs, advance_numbering_state
+from update_indent_level import new_indent_state, apply_indent_levels, has_previous_paragraph_drawing
+from traversal import body_paragraphs
+from remake_wordfile_from_xml import rebuild_docx_bytes, DEFAULT_LEVEL
+from proofread import run_stages, new_report
+from preflight import STAGES, scan_document_xml
+from progress import report_progress, measure
+from change_tracker import ChangeTracker
+
+# 1ワーカーあたりの区間数の目安（区間ごとの処理量のばらつきを吸収する）
+SHARDS_PER_WORKER = 4
+
+W_P = f"{{{ns['w']}}}p"
+
+
+def split_sections(body):
+    """
+    <w:body>直下の要素を、レベル1の項目番号の段落の直前で区切ったリストのリストにして返す。
+    """
+    sections = [[]]
+    for child in body:
+        if child.tag == W_P and sections[-1] and parse_paragraph(child)[0] == 1:
+            sections.append([])
+        sections[-1].append(child)
+    return sections
+
+
+def group_sections(sections, shard_count):
+    """
+    連続する区間を、段落数がほぼ均等な shard_count 個以下のまとまりに結合する。
+    """
+    sizes = [sum(1 for child in section for _ in child.iter(W_P)) for section in sections]
+    target = max(1, sum(sizes) / shard_count)
+
+    shards = [[]]
+    shard_size = 0
+    for section, size in zip(sections, sizes):
+        if shards[-1] and shard_size + size > target and len(shards) < shard_count:
+            shards.append([])
+            shard_size = 0
+        shards[-1].extend(section)
+        shard_size += size
+    return shards
+
+
+def shard_to_xml(root, body, children):
+    """
+    元の文書のルート要素と<w:body>の属性・名前空間を引き継いだ、区間だけを含むXML文字列を作成する。
+    children は元の文書から取り外される。
+    """
+    shard_root = ET.Element(root.tag, attrib=dict(root.attrib), nsmap=root.nsmap)
+    shard_body = ET.SubElement(shard_root, body.tag, attrib=dict(body.attrib))
+    shard_body.extend(children)
+    return ET.tostring(shard_root, encoding='unicode')
+
+
+def repair_shard(args):
+    """
+    区間に対して項目番号の形式修正を行う（ワーカープロセスで実行）。
+    (修正後のXML文字列, ログ, 変更の数) を返す。
+    """
+    xml_content, include_nested = args
+    tracker = ChangeTracker()
+    xml_content, log = process_brackets_in_xml(xml_content, tracker=tracker, include_nested=include_nested)
+    return xml_content, log, tracker.changes
+
+
+def number_shard(args):
+    """
+    区間の開始時点の連番の処理状態を引き継いで連番修正を行う（ワーカープロセスで実行）。
+    (修正後のXML文字列, レポート, インデントの処理状態の変化) を返す。
+    """
+    xml_content, stages, include_nested, numbering_state = args
+    root = ET.fromstring(xml_content.encode('utf-8'))
+    report = {"numbering": [], "trace_1_to_4": "", "trace_5_to_9": "", "changes": 0}
+    if "numbering" in stages:
+        tracker = ChangeTracker()
+        trace_1_to_4 = io.StringIO()
+        trace_5_to_9 = io.StringIO()
+        number_paragraphs(root, report["numbering"], trace_1_to_4, trace_5_to_9, state=numbering_state, tracker=tracker,
+                          include_nested=include_nested, quiet=True)
+        report["trace_1_to_4"] = trace_1_to_4.getvalue()
+        report["trace_5_to_9"] = trace_5_to_9.getvalue()
+        report["changes"] = tracker.changes
+        if tracker.dirty:
+            xml_content = ET.tostring(root, encoding='unicode')
+    transfer = indent_transfer(root, include_nested) if "indent" in stages else None
+    return xml_content, report, transfer
+
+
+def indent_shard(args):
+    """
+    区間の開始時点のインデントの処理状態を引き継いでインデント修正を行う（ワーカープロセスで実行）。
+    (修正後のXML文字列, レポート) を返す。
+    """
+    xml_content, include_nested, indent_state = args
+    root = ET.fromstring(xml_content.encode('utf-8'))
+    report = {"indent": [], "changes": 0}
+    tracker = ChangeTracker()
+    apply_indent_levels(root, report["indent"], state=indent_state, tracker=tracker, include_nested=include_nested,
+                        quiet=True)
+    report["changes"] = tracker.changes
+    if tracker.dirty:
+        xml_content = ET.tostring(root, encoding='unicode')
+    return xml_content, report
+
+
+def indent_transfer(root, include_nested):
+    """
+    区間を文書を変更せずに読み進め、インデントの処理状態の変化を求める。
+    状態は最後の項目番号のレベル、レベルごとの最後の項目番号、最後の段落の図の有無だけで決まるため、
+    開始時点の状態によらず区間の中で決まる。ただし区間の最初の段落が図の説明文かどうかは直前の段落に依存するため、
+    直前の段落に図がある場合とない場合の {図の有無: 区間の終了時点の状態} を返す。
+    区間の中に項目番号がない場合の current_level と、現れなかったレベルの current_numbers は None になる。
+    """
+    paragraphs = body_paragraphs(root, include_nested)
+    # 最初の段落が図の説明文になりえない場合は、直前の段落の図の有無によらず結果は同じ
+    depends_on_entry = not paragraphs or has_previous_paragraph_drawing(paragraphs[0], True, quiet=True)
+    transfer = {}
+    for previous_has_drawing in ((False, True) if depends_on_entry else (False,)):
+        state = {"current_level": None, "current_numbers": {i: None for i in range(1, 10)},
+                 "previous_has_drawing": previous_has_drawing}
+        apply_indent_levels(None, [], state=state, apply=False, paragraphs=paragraphs, quiet=True)
+        transfer[previous_has_drawing] = state
+    transfer.setdefault(True, transfer[False])
+    return transfer
+
+
+def apply_indent_transfer(state, transfer):
+    """
+    indent_transfer() で求めた区間の状態の変化を state に適用し、区間の終了時点の状態にする。
+    """
+    result = transfer[state["previous_has_drawing"]]
+    if result["current_level"] is not None:
+        state["current_level"] = result["current_level"]
+    for level, number in result["current_numbers"].items():
+        if number is not None:
+            state["current_numbers"][level] = number
+    state["previous_has_drawing"] = result["previous_has_drawing"]
+
+
+def fast_forward_numbering(xml_content, include_nested, numbering_state):
+    """
+    区間を文書を変更せずに読み進め、連番の処理状態を区間の終了時点まで進める。
+    項目番号の判定と番号の計算だけを行い、処理の経過も出力しない。
+    """
+    root = ET.fromstring(xml_content.encode('utf-8'))
+    advance_numbering_state(body_paragraphs(root, include_nested), numbering_state)
+
+
+def run_stages_in_sections(xml_content, workers=None, progress=None, stages=STAGES, scope=None,
+                           include_nested=False, base_xml=None):
+    """
+    run_stages() と同じ処理を、文書を区間に分割して並列に実行する。
+    stages には実行する処理の名前を指定できる（scan_document_xml() の判定結果）。
+    scope (Scope) を指定した場合は範囲内だけを校閲するため、分割せずに処理する。
+    base_xml は分割せずに処理する場合だけ使用する（run_stages() を参照）。区間に分割した場合は文書全体を出力する。
+    修正後のXML文字列とレポート(辞書)を返す。レポートの内容は run_stages() と同じ。
+    ただし timings の連番修正は区間の早送りを含めて sections_numbering に、インデント修正は sections_indent に計上する。
+    """
+    workers = workers or os.cpu_count() or 1
+    timings = {}
+    with measure(timings, "parse"):
+        root = ET.fromstring(xml_content.encode('utf-8'))
+    body = root.find("w:body", namespaces=ns)
+    sections = split_sections(body) if body is not None else []
+
+    # 区間が1つしかない場合や範囲が指定された場合は分割せずに処理する
+    if workers <= 1 or len(sections) <= 1 or scope is not None:
+        return run_stages(xml_content, progress=progress, stages=stages, scope=scope, include_nested=include_nested,
+                          base_xml=base_xml)
+
+    shards = group_sections(sections, workers * SHARDS_PER_WORKER)
+    shard_xmls = [shard_to_xml(root, body, children) for children in shards]
+    total = len(shard_xmls)
+
+    report = new_report(stages)
+    report["timings"] = timings
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # 1段階目: 項目番号の形式修正
+        repaired = shard_xmls
+        if "brackets" in stages:
+            repaired = []
+            with measure(timings, "brackets"):
+                for done, (shard_xml, log, changes) in enumerate(pool.map(repair_shard, [(shard_xml, include_nested) for shard_xml in shard_xmls]), 1):
+                    report_progress(progress, "sections_brackets", done, total, interval=1)
+                    repaired.append(shard_xml)
+                    report["brackets"].extend(log)
+                    report["changes"] += changes
+
+        # 2段階目: 各区間の開始時点の連番の処理状態を求め、連番修正を並列に実行する
+        with measure(timings, "sections_numbering"):
+            numbering_jobs = []
+            if "numbering" in stages:
+                numbering_state = NumberingState()
+                for shard_xml in repaired:
+                    numbering_jobs.append((shard_xml, stages, include_nested, copy.deepcopy(numbering_state)))
+                    fast_forward_numbering(shard_xml, include_nested, numbering_state)
+            else:
+                numbering_jobs = [(shard_xml, stages, include_nested, None) for shard_xml in repaired]
+            numbered = pool.map(number_shard, numbering_jobs)
+
+            # 3段階目: 区間の結果が届いた順に開始時点のインデントの処理状態を求め、インデント修正を送り出す
+            indent_state = new_indent_state()
+            finished = []
+            for done, (shard_xml, shard_report, transfer) in enumerate(numbered, 1):
+                report_progress(progress, "sections_numbering", done, total, interval=1)
+                for key, value in shard_report.items():
+                    report[key] += value
+                if transfer is None:
+                    finished.append(shard_xml)
+                    continue
+                finished.append(pool.submit(indent_shard, (shard_xml, include_nested, copy.deepcopy(indent_state))))
+                apply_indent_transfer(indent_state, transfer)
+
+        with measure(timings, "sections_indent"):
+            for done, result in enumerate(finished, 1):
+                if not isinstance(result, str):
+                    result, shard_report = result.result()
+                    report_progress(progress, "sections_indent", done, total, interval=1)
+                    for key, value in shard_report.items():
+                        report[key] += value
+                shard_body = ET.fromstring(result.encode('utf-8')).find("w:body", namespaces=ns)
+                body.extend(list(shard_body))
+
+    # 変更がなければ再出力せず、入力をそのまま返す
+    report["clean"] = report["changes"] == 0
+    if report["clean"]:
+        return xml_content, report
+
+    with measure(timings, "serialize"):
+        xml_content = ET.tostring(root, encoding='unicode')
+    return xml_content, report
+
+
+def proofread_sections(docx_bytes, workers=None, progress=None, include_nested=False, compress_level=DEFAULT_LEVEL):
+    """
+    proofread() と同じ処理を、文書を区間に分割して並列に実行する。
+    compress_level には校閲後のwordファイルの圧縮レベルを指定する（proofread() を参照）。
+    (校閲後のwordファイルのバイト列, レポート) を返す。
+    """
+    timings = {}
+    with measure(timings, "preflight"):
+        document_xml = read_document_xml(docx_bytes)
+        stages = scan_document_xml(document_xml, include_nested=include_nested)
+    if not stages:
+        report = new_report(stages)
+        report["timings"].update(timings)
+        return docx_bytes, report
+    with measure(timings, "combine"):
+        xml_content = combine_runs_in_xml(document_xml, progress=progress, include_nested=include_nested)
+    xml_content, report = run_stages_in_sections(xml_content, workers=workers, progress=progress, stages=stages,
+                                                 include_nested=include_nested)
+    report["timings"] = {**timings, **report["timings"]}
+    if report["clean"]:
+        return docx_bytes, report
+    with measure(report["timings"], "rebuild"):
+        output = rebuild_docx_bytes(docx_bytes, {"word/document.xml": xml_content.encode("utf-8")},
+                                    level=compress_level)
+    return output, report
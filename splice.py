@@ -0,0 +1,147 @@
+"""
+このファイルでは修正後のツリーのうち、変更した段落だけを元の document.xml に差し込みます。
+各処理の修正は段落の中で完結する（項目番号のテキスト、ハイライト、インデント）ため、
+元の document.xml (バイト列) から<w:body>直下の段落の位置(開始・終了のオフセット)を求め、
+変更のない範囲は元のバイト列をそのまま写し、変更した段落だけを出力し直して差し込みます。
+変更のない段落は、<w:t>要素の結合(make_xml_from_wordfile.py)も含めて元の内容のまま残ります。
+
+表や図、テキストボックスの中の段落も校閲する場合(include_nested=True)は、それらの中の段落も位置を求めます。
+変更した段落が別の変更した段落の中にある場合は、外側の段落だけを出力し直します。
+段落の位置を確実に対応づけられない場合（走査した段落の数がツリーと一致しない場合、段落の外が変更された場合）は
+None を返します。呼び出し側では文書全体を出力し直してください。
+"""
+import re
+from lxml import etree as ET
+from traversal import body_paragraphs
+
+# 段落の位置を求めるために走査するタグ（本文、段落、表、テキストボックス）
+TAG_PATTERN = re.compile(rb"<(/?)w:(p|tbl|txbxContent|body)(?=[\s/>])[^>]*?(/?)>")
+
+
+def paragraph_offsets(xml_bytes, include_nested=False):
+    """
+    document.xml の内容(バイト列)のうち、校閲の対象となる段落の (開始, 終了) のオフセットを文書の順に並べたリストを返す。
+    traversal.body_paragraphs() と同じく、表とテキストボックスの中の段落と、段落の中の段落は含めない。
+    include_nested=True の場合は、それらを含む全ての段落を開始タグの順に返す。
+    """
+    if include_nested:
+        return all_paragraph_offsets(xml_bytes)
+    offsets = []
+    in_body = False
+    paragraph_depth = 0
+    skipped_depth = 0
+    start = None
+    for match in TAG_PATTERN.finditer(xml_bytes):
+        closing, name, self_closing = match.groups()
+        if name == b"body":
+            in_body = not closing
+            continue
+        if not in_body:
+            continue
+
+        if name == b"p":
+            if self_closing:
+                if paragraph_depth == 0 and skipped_depth == 0:
+                    offsets.append((match.start(), match.end()))
+            elif closing:
+                paragraph_depth -= 1
+                if paragraph_depth == 0 and start is not None:
+                    offsets.append((start, match.end()))
+                    start = None
+            else:
+                if paragraph_depth == 0 and skipped_depth == 0:
+                    start = match.start()
+                paragraph_depth += 1
+        elif paragraph_depth == 0 and not self_closing:
+            # 段落の外にある表の中の段落は対象にしない（段落の中の表やテキストボックスは段落ごと扱う）
+            skipped_depth += -1 if closing else 1
+    return offsets
+
+
+def all_paragraph_offsets(xml_bytes):
+    """
+    document.xml の内容(バイト列)の全ての段落の (開始, 終了) のオフセットを、開始タグの順に並べたリストを返す。
+    段落の中の段落(テキストボックスなど)の範囲は、外側の段落の範囲に含まれる。
+    """
+    offsets = []
+    open_paragraphs = []  # 終了タグを待っている段落の offsets 内の番号
+    for match in TAG_PATTERN.finditer(xml_bytes):
+        closing, name, self_closing = match.groups()
+        if name != b"p":
+            continue
+        if self_closing:
+            offsets.append((match.start(), match.end()))
+        elif closing:
+            if not open_paragraphs:
+                return []
+            index = open_paragraphs.pop()
+            offsets[index] = (offsets[index][0], match.end())
+        else:
+            open_paragraphs.append(len(offsets))
+            offsets.append((match.start(), None))
+    return offsets if not open_paragraphs else []
+
+
+def inherited_declarations(element):
+    """
+    element で有効な名前空間の宣言を、lxmlが出力する形式のバイト列のリストにして返す。
+    """
+    if element is None:
+        return []
+    return [(f' xmlns:{prefix}="{uri}"' if prefix else f' xmlns="{uri}"').encode('utf-8')
+            for prefix, uri in element.nsmap.items()]
+
+
+def paragraph_fragment(paragraph, declarations):
+    """
+    段落を単独でXML(バイト列)にする。
+    lxmlが開始タグに付加する名前空間の宣言のうち、親要素で宣言済みのもの(declarations)は取り除く。
+    """
+    fragment = ET.tostring(paragraph, encoding='utf-8', with_tail=False)
+    end = fragment.index(b">")
+    start_tag = fragment[:end]
+    for declaration in declarations:
+        start_tag = start_tag.replace(declaration, b"", 1)
+    return start_tag + fragment[end:]
+
+
+def splice_paragraphs(root, base_xml, tracker, include_nested=False):
+    """
+    tracker に記録された変更のある段落だけを出力し直し、base_xml (元の document.xml のバイト列) に差し込んだバイト列を返す。
+    base_xml の段落は root の段落と同じ順序で対応している必要がある。
+    段落の位置を対応づけられない場合は None を返す。
+    """
+    if len(tracker.elements) != tracker.changes:
+        return None
+
+    paragraphs = body_paragraphs(root, include_nested)
+    offsets = paragraph_offsets(base_xml, include_nested)
+    if len(paragraphs) != len(offsets):
+        return None
+
+    # 変更された要素を、それを含む段落の番号に対応づける
+    index = {paragraph: number for number, paragraph in enumerate(paragraphs)}
+    changed = set()
+    for element in tracker.elements:
+        while element is not None and element not in index:
+            element = element.getparent()
+        if element is None:
+            return None  # 段落の外が変更された
+        changed.add(index[element])
+
+    pieces = []
+    position = 0
+    declarations = {}  # 親要素ごとの宣言済みの名前空間
+    for number in sorted(changed):
+        start, end = offsets[number]
+        if start < position:
+            continue  # 出力し直した外側の段落に含まれている
+        paragraph = paragraphs[number]
+        parent = paragraph.getparent()
+        if parent not in declarations:
+            declarations[parent] = inherited_declarations(parent)
+        pieces.append(base_xml[position:start])
+        pieces.append(paragraph_fragment(paragraph, declarations[parent]))
+        position = end
+    pieces.append(base_xml[position:])
+    return b"".join(pieces)
@@ -0,0 +1,140 @@
+"""
+このファイルでは標準入力からwordファイルを読み込み、校閲後のwordファイルを標準出力に書き出します。
+処理は全てメモリ上で行い、中間ファイルやログファイルは作成しません。
+レポート(JSON)は標準エラー出力、または --report-fd で指定したファイルディスクリプタに書き出します。
+シェルのパイプラインで変換ツールやアップロード処理と組み合わせて使用できます。
+
+    python stream.py < input.docx > output.docx 2> report.json
+    python stream.py --report-fd 3 < input.docx 3> report.json | upload ...
+
+各処理の途中経過はレポートのトレースに記録され、標準出力に書き出すwordファイルとは混ざりません。
+--verbose を指定した場合は、途中経過を標準エラー出力にも書き出します。
+レポートと混ざらないよう、--verbose は --report-fd で標準エラー出力以外を指定した場合にだけ使用できます。
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import zipfile
+from proofread import proofread
+from scope import Scope
+from perf_history import record_run
+from make_xml_from_wordfile import read_document_xml
+from budget import Budget, PARTIAL, ACTIONS
+from remake_wordfile_from_xml import DEFAULT_LEVEL
+
+# 終了コード
+EXIT_OK = 0
+EXIT_FAILED = 1  # wordファイルとして読み込めない場合など
+EXIT_USAGE = 2  # 範囲の指定が誤っている場合など
+
+
+def read_input(fd):
+    """
+    ファイルディスクリプタから入力を全て読み込む。
+    """
+    with os.fdopen(fd, "rb", closefd=False) as stream:
+        return stream.read()
+
+
+def write_output(fd, data):
+    """
+    ファイルディスクリプタにバイト列を全て書き出す。
+    """
+    with os.fdopen(fd, "wb", closefd=False) as stream:
+        stream.write(data)
+        stream.flush()
+
+
+def stream_proofread(input_fd=0, output_fd=1, report_fd=2, scope=None, include_nested=False, splice=False,
+                     verbose=False, history=None, budget=None, compress_level=DEFAULT_LEVEL):
+    """
+    input_fd からwordファイルを読み込んで校閲し、校閲後のwordファイルを output_fd に、レポート(JSON)を report_fd に書き出す。
+    修正箇所がない場合は入力をそのまま書き出す。終了コードを返す。
+    失敗した場合は output_fd には何も書き出さず、レポートの error にエラーの内容を設定する。
+    budget (Budget) を指定した場合に上限を超えたときは、レポートの budget に内容を設定する（終了コードは0）。
+    compress_level には校閲後のwordファイルの圧縮レベルを指定する（proofread() を参照）。
+    verbose=True の場合は途中経過を標準エラー出力に書き出すため、report_fd に標準エラー出力(2)は指定できない。
+    """
+    if verbose and report_fd == 2:
+        raise ValueError("途中経過とレポートが混ざるため、verbose=True の場合は report_fd に2以外を指定してください")
+    data = read_input(input_fd)
+    report = {"source": f"fd:{input_fd}", "input_bytes": len(data)}
+    start = time.perf_counter()
+    try:
+        output, proofread_report = proofread(data, scope=scope, include_nested=include_nested, splice=splice,
+                                             budget=budget, compress_level=compress_level)
+    except (zipfile.BadZipFile, KeyError) as e:
+        report["error"] = f"wordファイルとして読み込めませんでした: {e}"
+        status = EXIT_FAILED
+    except ValueError as e:
+        # 指定された範囲が文書内に見つからない場合
+        report["error"] = str(e)
+        status = EXIT_USAGE
+    except Exception as e:
+        report["error"] = f"{type(e).__name__}: {e}"
+        status = EXIT_FAILED
+    else:
+        write_output(output_fd, output)
+        report.update(proofread_report)
+        report["output_bytes"] = len(output)
+        if verbose:
+            sys.stderr.write(proofread_report["trace_1_to_4"] + proofread_report["trace_5_to_9"])
+        status = EXIT_OK
+        if history is not None:
+            record_run(history, "stream", report["source"], read_document_xml(data), report["changes"],
+                       report["timings"])
+    report["elapsed"] = time.perf_counter() - start
+
+    write_output(report_fd, (json.dumps(report, ensure_ascii=False, indent=2) + "\n").encode("utf-8"))
+    return status
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="標準入力のwordファイルを校閲し、校閲後のwordファイルを標準出力に書き出します。")
+    parser.add_argument("--input-fd", type=int, default=0, help="wordファイルを読み込むファイルディスクリプタ（既定は標準入力）")
+    parser.add_argument("--output-fd", type=int, default=1, help="校閲後のwordファイルを書き出すファイルディスクリプタ（既定は標準出力）")
+    parser.add_argument("--report-fd", type=int, default=2, help="レポート(JSON)を書き出すファイルディスクリプタ（既定は標準エラー出力）")
+    parser.add_argument("--include-nested", action="store_true", help="表や図、テキストボックスの中の段落も校閲する")
+    parser.add_argument("--splice", action="store_true",
+                        help="変更した段落だけを元の document.xml に差し込み、それ以外の段落は元の内容のまま残す")
+    parser.add_argument("--verbose", action="store_true",
+                        help="各処理の途中経過を標準エラー出力に書き出す（--report-fd で標準エラー出力以外を指定した場合のみ）")
+    parser.add_argument("--deadline", type=float, help="校閲にかける時間の上限(秒)")
+    parser.add_argument("--max-memory-mb", type=float, help="校閲中に増えた使用メモリの上限(MB)")
+    parser.add_argument("--on-budget", choices=ACTIONS, default=PARTIAL,
+                        help="上限を超えた場合に、完了した処理の結果を出力する(partial)か、入力をそのまま出力する(report_only)か")
+    parser.add_argument("--compress-level", type=int, choices=range(10), default=DEFAULT_LEVEL, metavar="0-9",
+                        help="校閲後のwordファイルの圧縮レベル（0は圧縮せずに格納する）")
+    parser.add_argument("--history", help="処理ごとの所要時間などを記録する性能の記録(SQLite)のパス（既定は記録しない）")
+    scope_group = parser.add_mutually_exclusive_group()
+    scope_group.add_argument("--section", help="校閲する範囲を項目番号で指定する（例: 7、7.2、7:9）")
+    scope_group.add_argument("--paragraphs", help="校閲する範囲を段落の番号(0から数える)で指定する（例: 120:340）")
+    args = parser.parse_args()
+
+    scope = None
+    if args.section or args.paragraphs:
+        try:
+            scope = Scope(section=args.section, paragraphs=args.paragraphs)
+        except ValueError as e:
+            parser.error(str(e))
+
+    # 途中経過とレポートが同じ出力先に混ざるとレポートを読み取れなくなる
+    if args.verbose and args.report_fd == 2:
+        parser.error("--verbose を指定する場合は --report-fd で標準エラー出力以外の出力先を指定してください"
+                     "（例: --report-fd 3 3> report.json）")
+
+    budget = None
+    if args.deadline is not None or args.max_memory_mb is not None:
+        budget = Budget(seconds=args.deadline, memory_mb=args.max_memory_mb, action=args.on_budget)
+
+    if sys.stdin.isatty() and args.input_fd == 0:
+        parser.error("wordファイルを標準入力から渡してください（例: python stream.py < input.docx > output.docx）")
+    if sys.stdout.isatty() and args.output_fd == 1:
+        parser.error("校閲後のwordファイルの出力先をリダイレクトしてください（例: > output.docx）")
+
+    sys.exit(stream_proofread(args.input_fd, args.output_fd, args.report_fd, scope=scope,
+                              include_nested=args.include_nested, splice=args.splice, verbose=args.verbose,
+                              history=args.history, budget=budget, compress_level=args.compress_level))
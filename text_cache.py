@@ -0,0 +1,117 @@
+"""
+このファイルでは段落のテキストをキーとして処理結果を保持するキャッシュ(LRU)を提供します。
+定型文や見出し、注記など多くの文書に繰り返し現れる段落について、項目番号の分類や補完の結果を再利用します。
+キャッシュはプロセス内で共有されるため、同じプロセスで処理する複数の文書の間で再利用されます。
+複数のスレッドから同時に使用できます。
+サイズの調整のため、ヒット数・ミス数を cache_stats() で確認できます。
+"""
+import threading
+from collections import OrderedDict
+
+# キャッシュごとの既定の最大件数
+DEFAULT_CACHE_SIZE = 65536
+
+# 作成されたキャッシュ（名前 -> LRUCache）
+caches = {}
+
+
+class LRUCache:
+    """
+    最大件数を超えた場合に、最後に使用した時刻が古いものから削除するキャッシュ。
+    maxsize に0を指定するとキャッシュしない。
+    """
+
+    def __init__(self, name, maxsize=DEFAULT_CACHE_SIZE):
+        self.name = name
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        caches[name] = self
+
+    def get_or_compute(self, key, compute):
+        """
+        key に対応する値を返す。キャッシュにない場合は compute() で求めて保持する。
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+
+        value = compute()
+        with self.lock:
+            if self.maxsize > 0:
+                self.entries[key] = value
+                self.entries.move_to_end(key)
+                self.evict()
+        return value
+
+    def evict(self):
+        """
+        最大件数を超えている分を古いものから削除する（lock を取得した状態で呼び出す）。
+        """
+        while len(self.entries) > max(self.maxsize, 0):
+            self.entries.popitem(last=False)
+
+    def resize(self, maxsize):
+        """
+        最大件数を変更する。
+        """
+        with self.lock:
+            self.maxsize = maxsize
+            self.evict()
+
+    def clear(self):
+        """
+        保持している値とヒット数・ミス数を消去する。
+        """
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        件数、最大件数、ヒット数、ミス数を返す。
+        """
+        with self.lock:
+            return {"size": len(self.entries), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+
+def cache_stats():
+    """
+    全てのキャッシュの統計を {名前: 統計} の形式で返す。
+    """
+    return {name: cache.stats() for name, cache in caches.items()}
+
+
+def format_cache_stats():
+    """
+    全てのキャッシュの統計を表示用の文字列にして返す。
+    """
+    lines = []
+    for name, stats in cache_stats().items():
+        lookups = stats["hits"] + stats["misses"]
+        rate = stats["hits"] / lookups * 100 if lookups else 0.0
+        lines.append(f"{name}: ヒット {stats['hits']} / ミス {stats['misses']} (ヒット率 {rate:.1f}%), "
+                     f"件数 {stats['size']} / {stats['maxsize']}")
+    return "\n".join(lines)
+
+
+def set_cache_size(maxsize):
+    """
+    全てのキャッシュの最大件数を変更する。
+    """
+    for cache in caches.values():
+        cache.resize(maxsize)
+
+
+def clear_caches():
+    """
+    全てのキャッシュを消去する。
+    """
+    for cache in caches.values():
+        cache.clear()
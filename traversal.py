@@ -0,0 +1,146 @@
+"""
+このファイルでは校閲の対象となる段落の取り出し方を定義します。
+項目番号は表や図、テキストボックスの中には現れないため、既定では<w:body>の直下をたどり、
+表(<w:tbl>)の中の段落と、段落の中にある図やテキストボックスの段落は処理の対象にしません。
+include_nested=True を指定した場合は、従来どおり文書内の全ての段落を対象にします。
+
+段落の中のラン(<w:r>)や<w:t>、<w:rPr>などの取得もここにまとめています。
+子孫の検索(".//w:t" など)は呼び出しのたびにパスを解釈して部分木全体を走査し、
+図やテキストボックスの中の段落のテキストまで拾ってしまうため、
+タグ名を解決済みの定数で子要素だけをたどり、条件付きの検索は事前にコンパイルしたXPathで行います。
+"""
+from lxml import etree as ET
+
+# WordprocessingMLの名前空間を定義
+ns = {'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'}
+
+# 図(<mc:AlternateContent>)の検索に使用する名前空間
+drawing_ns = {**ns, 'mc': 'http://schemas.openxmlformats.org/markup-compatibility/2006'}
+
+
+def w_tag(local_name):
+    """
+    "p" のようなローカル名を、lxmlのタグ名の形式 "{名前空間}p" に変換する。
+    """
+    return f"{{{ns['w']}}}{local_name}"
+
+
+W_BODY = w_tag("body")
+W_P = w_tag("p")
+W_R = w_tag("r")
+W_T = w_tag("t")
+W_TAB = w_tag("tab")
+W_PPR = w_tag("pPr")
+W_RPR = w_tag("rPr")
+W_IND = w_tag("ind")
+W_HIGHLIGHT = w_tag("highlight")
+MC_ALTERNATE_CONTENT = f"{{{drawing_ns['mc']}}}AlternateContent"
+
+# 図を表す要素（図の説明文の判定では、従来どおり<w:drawing>だけを図として扱う）
+W_DRAWING = w_tag("drawing")
+
+# 中の段落を処理の対象にしない要素（表、テキストボックス）
+SKIPPED_TAGS = {w_tag("tbl"), w_tag("txbxContent")}
+
+# 段落の中でランを囲む要素（ハイパーリンク、変更履歴の挿入、スマートタグ、フィールド、コンテンツコントロールなど）
+# 削除された変更履歴(<w:del>)の中のランは<w:t>を持たないため含めない
+RUN_CONTAINERS = {w_tag(name) for name in ("hyperlink", "ins", "moveTo", "smartTag", "fldSimple", "customXml",
+                                           "sdt", "sdtContent", "dir", "bdo")}
+
+# ランが図を含むかどうか（<mc:AlternateContent>で代替の表現と併記された図を含む）
+run_has_drawing = ET.XPath("boolean(w:drawing | w:pict | mc:AlternateContent/*/w:drawing"
+                           " | mc:AlternateContent/*/w:pict)", namespaces=drawing_ns)
+
+# <mc:AlternateContent>の中に<w:drawing>があるかどうか（VMLの図<w:pict>は含めない）
+alternate_content_has_drawing = ET.XPath("boolean(mc:AlternateContent/*/w:drawing)", namespaces=drawing_ns)
+
+# ランが改ページ(<w:br w:type="page">)を含むかどうか
+run_has_page_break = ET.XPath('boolean(w:br[@w:type="page"])', namespaces=ns)
+
+
+def body_paragraphs(root, include_nested=False):
+    """
+    校閲の対象となる段落(<w:p>)を文書の順に並べたリストを返す。
+    既定では表の中の段落と、段落の中に入れ子になった段落（図やテキストボックスの中の段落）を除く。
+    include_nested=True の場合は文書内の全ての段落を返す。
+    """
+    if include_nested:
+        return list(root.iter(W_P))
+
+    body = root if root.tag == W_BODY else root.find("w:body", namespaces=ns)
+    paragraphs = []
+    collect_paragraphs(root if body is None else body, paragraphs)
+    return paragraphs
+
+
+def collect_paragraphs(element, paragraphs):
+    """
+    element の子要素をたどって段落を paragraphs に追加する。
+    段落の中と、表・テキストボックスの中はたどらない。
+    """
+    for child in element:
+        if child.tag == W_P:
+            paragraphs.append(child)
+        elif child.tag not in SKIPPED_TAGS:
+            # <w:sdt>(コンテンツコントロール)などの中の段落は対象にする
+            collect_paragraphs(child, paragraphs)
+
+
+def first_child(element, tag):
+    """
+    element の子要素のうち、最初の tag の要素を返す。ない場合は None を返す。
+    ランや<w:rPr>の子要素は数個しかないため、検索するより子要素を順に比較する方が速い。
+    """
+    for child in element:
+        if child.tag == tag:
+            return child
+    return None
+
+
+def paragraph_runs(paragraph):
+    """
+    段落の中のラン(<w:r>)を文書の順に並べたリストを返す。
+    ハイパーリンクなどランを囲む要素の中のランは含め、図やテキストボックスの中の段落のランは含めない。
+    """
+    runs = []
+    collect_runs(paragraph, runs)
+    return runs
+
+
+def collect_runs(element, runs):
+    """
+    element の子要素をたどってランを runs に追加する。ランを囲む要素の中だけをたどる。
+    """
+    for child in element:
+        if child.tag == W_R:
+            runs.append(child)
+        elif child.tag in RUN_CONTAINERS:
+            collect_runs(child, runs)
+
+
+def paragraph_texts(paragraph):
+    """
+    段落の中の<w:t>要素を文書の順に並べたリストを返す。
+    """
+    return [child for run in paragraph_runs(paragraph) for child in run if child.tag == W_T]
+
+
+def paragraph_text(paragraph):
+    """
+    段落の中の<w:t>要素のテキストを全て結合して返す。
+    """
+    return "".join([child.text for run in paragraph_runs(paragraph) for child in run
+                    if child.tag == W_T and child.text])
+
+
+def paragraph_has_drawing(paragraph):
+    """
+    段落の中に<w:drawing>を含むランがあればTrueを返す（図の説明文の判定に使用）。
+    VMLの図(<w:pict>)は、従来の判定と同じく図として扱わない。
+    <mc:AlternateContent>を含むランだけ alternate_content_has_drawing() で中を確認する。
+    """
+    for run in paragraph_runs(paragraph):
+        for child in run:
+            if child.tag == W_DRAWING or (child.tag == MC_ALTERNATE_CONTENT and alternate_content_has_drawing(run)):
+                return True
+    return False
@@ -5,11 +5,15 @@
 """
 
 import re
-import xml.etree.ElementTree as ET
+from lxml import etree as ET
+from progress import report_progress
+from change_tracker import ChangeTracker, mark_changed
+from text_cache import LRUCache
+from traversal import body_paragraphs, first_child, paragraph_has_drawing, paragraph_text, paragraph_texts, W_PPR, W_IND
 
 # WordprocessingMLの名前空間を定義
+# lxmlは元文書のプレフィックスをそのまま保持するため、グローバルな名前空間の登録は行わない
 ns = {'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'}
-ET.register_namespace('w', ns['w'])  # 'w' 名前空間を再登録
 
 # 正規表現パターン
 patterns = {
@@ -45,28 +49,28 @@ indent_settings_paragraphs = {
     8: {"w:leftChars": "400", "w:left": "960", "w:firstLineChars": "100", "w:firstLine": "240"},
     9: {"w:leftChars": "500", "w:left": "1200", "w:firstLineChars": "100", "w:firstLine": "240"}
 }
-def has_previous_paragraph_drawing(paragraph, root):
+
+# 段落のテキスト -> 項目番号のレベル のキャッシュ
+classification_cache = LRUCache("indent_classification")
+
+def has_drawing(paragraph):
+    """
+    段落内に<w:drawing>タグがあればTrueを返す。
+    """
+    return paragraph_has_drawing(paragraph)
+
+def has_previous_paragraph_drawing(paragraph, previous_has_drawing, quiet=False):
     """
     現在の段落の一つ前の段落に<w:drawing>タグがあり、その段落に「図」または「表」のキーワードが
     含まれている場合にTrueを返す。含まれていない場合はFalseを返す。
+    previous_has_drawing には一つ前の段落に<w:drawing>タグがあるかどうかを指定する。
+    （最初の段落の場合はFalse）
+    quiet=True の場合は該当した段落のテキストを標準出力に出力しない。
     """
-    # 現在の段落 (w:p) の前の段落を取得
-    paragraphs = list(root.findall(".//w:p", namespaces=ns))
-    current_index = paragraphs.index(paragraph)
-
-    # 最初の段落の場合、前の段落は存在しないのでFalseを返す
-    if current_index == 0:
-        return False
-
-    # 一つ前の段落を取得
-    previous_paragraph = paragraphs[current_index - 1]
     current_paragraph = paragraph
 
-    # その段落内に<w:drawing>タグがあるかを確認
-    drawing = previous_paragraph.find(".//w:drawing", namespaces=ns)
-    
     # <w:drawing>がなければFalseを返す
-    if drawing is None:
+    if not previous_has_drawing:
         return False
 
     # <w:t>のテキストをすべて取得して結合
@@ -74,7 +78,7 @@ def has_previous_paragraph_drawing(paragraph, root):
 
     # 「図」または「表」が含まれていればTrueを返す
     if "図" in current_paragraph_text or "表" in current_paragraph_text:
-        if drawing is not None:
+        if not quiet:
             print(current_paragraph_text)
         return True
 
@@ -84,7 +88,7 @@ def extract_text_from_paragraph(paragraph):
     """
     段落 (w:p) の中にある<w:t>要素のテキストをすべて結合して返す。
     """
-    return "".join([t.text for t in paragraph.findall(".//w:t", namespaces=ns) if t.text])
+    return paragraph_text(paragraph)
 
 
 
@@ -94,66 +98,134 @@ def parse_paragraph(paragraph):
     項目番号がない場合は、Noneを返す。
     """
     # paragraph内の<w:t>のテキストを全て結合し、前後の空白を削除
-    text = "".join([t.text for t in paragraph.findall(".//w:t", namespaces=ns)]).strip()
+    text = paragraph_text(paragraph).strip()
+    return classification_cache.get_or_compute(text, lambda: classify_text(text)), text
 
-    # テキスト全体をチェックして、項目番号のパターンが一致するか確認
+def classify_text(text):
+    """
+    テキスト全体をチェックして、項目番号のパターンが一致するレベルを返す。一致しない場合はNoneを返す。
+    """
     for level, pattern in patterns.items():
         if re.match(pattern, text):
-            return level, text
+            return level
+    return None
 
-    return None, text
+def qualify_attribute(attr):
+    """
+    "w:leftChars" のようなプレフィックス付きの属性名を、lxmlで扱える "{名前空間}leftChars" の形式に変換する。
+    """
+    prefix, _, local_name = attr.partition(":")
+    return f"{{{ns[prefix]}}}{local_name}"
 
-def update_indent(paragraph, level, is_number):
+def update_indent(paragraph, level, is_number, tracker=None):
     """
     段落のインデントを更新する。
     is_numberがTrueの場合は項目番号、Falseの場合は通常段落のインデントを適用する。
     ただし、<w:t>が存在しない、または空の場合はインデントを適用しない。
+    既に設定どおりのインデントになっている場合は変更しない。
     """
     # <w:t> 要素を確認し、空や存在しない場合はインデントを適用しない
-    texts = paragraph.findall(".//w:t", namespaces=ns)
+    texts = paragraph_texts(paragraph)
     if not texts or all(t.text.strip() == "" for t in texts if t.text):
         return  # <w:t> がないか、空であれば何もしない
 
-    pPr = paragraph.find(".//w:pPr", namespaces=ns)
+    # is_number に基づいてインデント設定を取得
+    settings = indent_settings_numbers.get(level) if is_number else indent_settings_paragraphs.get(level)
+
+    pPr = first_child(paragraph, W_PPR)
+    ind = first_child(pPr, W_IND) if pPr is not None else None
+
+    # 既存の <w:ind> が設定と完全に一致する（設定がなく <w:ind> もない場合を含む）なら何もしない
+    expected = {qualify_attribute(attr): value for attr, value in settings.items()} if settings else None
+    current = dict(ind.attrib) if ind is not None else None
+    if current == expected:
+        return
+    mark_changed(tracker, paragraph)
+
     if pPr is None:
         pPr = ET.SubElement(paragraph, "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}pPr")
     
     # 既存の <w:ind> を削除
-    ind = pPr.find(".//w:ind", namespaces=ns)
     if ind is not None:
         pPr.remove(ind)
 
-    # is_number に基づいてインデント設定を取得
-    settings = indent_settings_numbers.get(level) if is_number else indent_settings_paragraphs.get(level)
-
     # 新しいインデント設定を追加
     if settings:
         new_ind = ET.SubElement(pPr, "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}ind")
         for attr, value in settings.items():
-            new_ind.set(attr, value)
+            new_ind.set(qualify_attribute(attr), value)
 
-def update_indent_level(xml_content):
+def new_indent_state():
+    """
+    インデント処理の状態を初期化して返す。
+    """
+    return {
+        "current_level": 1,
+        "current_numbers": {i: None for i in range(1, 10)},
+        "previous_has_drawing": False,
+    }
+
+def update_indent_level(xml_content, progress=None, state=None, tracker=None):
     """
     XML文書を解析し、各段落に対して項目番号やインデントを適用する。
     処理結果をXMLとして返し、処理ログも返す。
+    progress を指定した場合は一定の段落数ごとに進捗を通知する
+    state には前の区間から引き継ぐ処理状態を指定できる（apply_indent_levels を参照）
+    tracker を指定した場合は文書に加えた変更の数を記録する
     """
     # XMLの読み込み
-    tree = ET.ElementTree(ET.fromstring(xml_content))
+    tree = ET.ElementTree(ET.fromstring(xml_content.encode('utf-8')))
     root = tree.getroot()
-
-    current_level = 1
-    current_numbers = {i: None for i in range(1, 10)}
     log = []
 
-    for paragraph in root.findall(".//w:p", namespaces=ns):
-        if has_previous_paragraph_drawing(paragraph, root):
+    stage_tracker = ChangeTracker()
+    apply_indent_levels(root, log, progress=progress, state=state, tracker=stage_tracker)
+    if tracker is not None:
+        tracker.changes += stage_tracker.changes
+
+    # 変更がなければ再出力せず、入力をそのまま返す
+    if not stage_tracker.dirty:
+        return xml_content, log
+
+    # 修正済みのXMLを返す
+    return ET.tostring(root, encoding='unicode'), log
+
+def apply_indent_levels(root, log, progress=None, state=None, apply=True, tracker=None, paragraphs=None,
+                        include_nested=False, quiet=False):
+    """
+    解析済みのXMLの各段落に対して項目番号やインデントを適用する。
+    state を指定した場合はその状態から処理を始め、処理後の状態で state を更新する。
+    apply=False の場合は文書を変更せず、処理状態だけを進める（区間の早送りに使用）。
+    tracker を指定した場合は文書に加えた変更を記録する。
+    paragraphs を指定した場合はその段落だけを処理する。
+    include_nested=True の場合は表や図、テキストボックスの中の段落も処理する。
+    quiet=True の場合は処理の経過を標準出力に出力せず、図の説明文と判定した段落を log に記録する
+    （ライブラリAPIや範囲外の段落の早送りで使用。標準出力は複数のスレッドで共有されるため）。
+    """
+    if state is None:
+        state = new_indent_state()
+    current_level = state["current_level"]
+    current_numbers = state["current_numbers"]
+    previous_has_drawing = state["previous_has_drawing"]
+
+    if paragraphs is None:
+        paragraphs = body_paragraphs(root, include_nested)
+    total = len(paragraphs)
+    for index, paragraph in enumerate(paragraphs, 1):
+        report_progress(progress, "indent", index, total)
+        is_caption = has_previous_paragraph_drawing(paragraph, previous_has_drawing, quiet)
+        previous_has_drawing = has_drawing(paragraph)
+        if is_caption:
             # 今の段落に含まれる<w:t>タグのテキストを取得してログに追加
+            if quiet:
+                log.append(f"図の説明文: インデント処理を行いません. 内容: '{extract_text_from_paragraph(paragraph)}'")
             continue #インデント処理を行わない
         level, item_number = parse_paragraph(paragraph)
 
         if level is not None:
             # 項目番号に対するインデントの更新
-            update_indent(paragraph, level, is_number=True)
+            if apply:
+                update_indent(paragraph, level, is_number=True, tracker=tracker)
 
             # 順序のチェック
             if current_numbers.get(level):
@@ -168,11 +240,13 @@ def update_indent_level(xml_content):
         else:
             # 通常段落の場合は現在のレベルのインデントを適用
             text = item_number  # ここではitem_numberが通常段落のテキスト
-            update_indent(paragraph, current_level, is_number=False)
+            if apply:
+                update_indent(paragraph, current_level, is_number=False, tracker=tracker)
             log.append(f"レベル{current_level}: 通常段落 - インデント適用. 内容: '{text}'")
 
-    # 修正済みのXMLを返す
-    return ET.tostring(root, encoding='unicode'), log
+    # 次の区間へ引き継ぐ処理状態を保存
+    state["current_level"] = current_level
+    state["previous_has_drawing"] = previous_has_drawing
 
 # このスクリプトが直接実行された場合のみ、以下のコードが動作するようにする
 if __name__ == "__main__":
@@ -3,12 +3,18 @@
 正規表現ルールで項目番号の値を取得します。
 各項目番号レベルにおいて現在の値が、前回のものを1だけ進めた値と異なってれば連番ではないとして修正します。
 """
+import io
 import re
-import xml.etree.ElementTree as ET
+from contextlib import nullcontext
+from lxml import etree as ET
+from progress import report_progress
+from change_tracker import ChangeTracker, mark_changed
+from text_cache import LRUCache
+from traversal import body_paragraphs, first_child, paragraph_runs, paragraph_text, paragraph_texts, W_RPR, W_HIGHLIGHT
 
 # WordprocessingMLの名前空間を定義
+# lxmlは元文書のプレフィックスをそのまま保持するため、グローバルな名前空間の登録は行わない
 ns = {'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'}
-ET.register_namespace('w', ns['w'])  # 'w' 名前空間を再登録
 
 # 正規表現パターン
 patterns = {
@@ -45,34 +51,62 @@ indent_settings_paragraphs = {
     9: {"w:leftChars": "500", "w:left": "1200", "w:firstLineChars": "100", "w:firstLine": "240"}
 }
 
+# 段落のテキスト -> (項目番号のレベル, 項目番号) のキャッシュ
+classification_cache = LRUCache("numbering_classification")
+
 def check_tab_before_t(paragraph):
     """
     <w:tab />が<w:t>要素の前にあるかどうかを確認する。
     存在する場合、それは項目番号ではないので処理をスキップする
     """
-    runs = paragraph.findall(".//w:r", namespaces=ns)
-    return len(runs) > 1
+    return len(paragraph_runs(paragraph)) > 1
 
 
-def highlight_text(run):
+def highlight_text(run, tracker=None):
     """
     指定された<w:r>要素にハイライトを追加する。
+    既に黄色のハイライトがある場合は何もしない。
     """
-    rPr = run.find('.//w:rPr', namespaces=ns)
+    rPr = first_child(run, W_RPR)
     if rPr is None:
         rPr = ET.SubElement(run, '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}rPr')
     
-    highlight = rPr.find('.//w:highlight', namespaces=ns)
+    highlight = first_child(rPr, W_HIGHLIGHT)
     if highlight is not None:
+        if highlight.get('{http://schemas.openxmlformats.org/wordprocessingml/2006/main}val') == 'yellow':
+            return
         rPr.remove(highlight)
 
+    mark_changed(tracker, run)
+
     new_highlight = ET.SubElement(rPr, '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}highlight')
     new_highlight.set('{http://schemas.openxmlformats.org/wordprocessingml/2006/main}val', 'yellow')
 
+def classify_text(text):
+    """
+    段落のテキストから項目番号のレベルと項目番号(タプル)を求める。
+    項目番号がない場合は (None, ()) を返す。結果はテキストごとにキャッシュする。
+    """
+    def compute():
+        for level, pattern in patterns.items():
+            if re.match(pattern, text):
+                return level, tuple(parse_number(text, level))
+        return None, ()
+    return classification_cache.get_or_compute(text, compute)
+
 def extract_number(text, level):
     """
     テキストから項目番号を抽出し、リストとして返す。
     """
+    classified_level, number = classify_text(text)
+    if classified_level == level:
+        return list(number)
+    return parse_number(text, level)
+
+def parse_number(text, level):
+    """
+    テキストを指定されたレベルの項目番号のパターンで解析し、項目番号をリストとして返す。
+    """
     match = re.match(patterns.get(level, ''), text)
     if not match:
         return []
@@ -94,36 +128,49 @@ def extract_number(text, level):
 
     return []
 
-def update_text(paragraph, new_number):
+def update_text(paragraph, new_number, tracker=None):
     """
     段落内のテキストを新しい項目番号に置き換える。
+    テキストが変わらない<w:t>要素は変更しない。
     """
-    for t in paragraph.findall(".//w:t", namespaces=ns):
+    for t in paragraph_texts(paragraph):
         text = t.text.strip()
         new_text = re.sub(r"^\d+(\.\d+)*", new_number, text, 1)
-        t.text = new_text
+        if new_text != t.text:
+            t.text = new_text
+            mark_changed(tracker, t)
 
 def parse_paragraph(paragraph):
     """
     段落から項目番号を抽出し、適切なレベルを返す。
     項目番号がない場合は、Noneを返す。
     """
-    text = "".join([t.text for t in paragraph.findall(".//w:t", namespaces=ns)]).strip()
+    text = paragraph_text(paragraph).strip()
+    level, _ = classify_text(text)
+    return level, text
 
-    for level, pattern in patterns.items():
-        if re.match(pattern, text):
-            return level, text
-
-    return None, text
+def write_trace(message, quiet, trace):
+    """
+    処理の経過を出力する。quiet=False の場合は標準出力に、quiet=True の場合は trace（指定した場合のみ）に書き出す。
+    """
+    if not quiet:
+        print(message)
+    elif trace is not None:
+        trace.write(message + "\n")
 
-def increment_number(number, level, previous_numbers, current_text, is_first_item):
+def increment_number(number, level, previous_numbers, current_text, is_first_item, quiet=False, trace=None):
     """
     項目番号をインクリメント(連番処理)して、次の番号に修正する。
     最初の項目は文書内の番号をそのまま使用し、インクリメントしない。
+    quiet=True の場合は処理の経過を標準出力に出力せず、trace を指定した場合はそこに書き出す。
     """
-    existing_sub_level_number = extract_lowest_sub_number(current_text, level)
+    existing_sub_level_number = extract_lowest_sub_number(current_text, level, quiet, trace)
+    # 出力先がない場合は経過の文字列を作らない（早送りでの無駄を避ける）
+    traced = not quiet or trace is not None
 
-    print(f"Before incrementing - Level: {level}, Previous numbers: {previous_numbers}, Extracted sub level number: {existing_sub_level_number}")
+    if traced:
+        write_trace(f"Before incrementing - Level: {level}, Previous numbers: {previous_numbers}, Extracted sub level number: {existing_sub_level_number}",
+                    quiet, trace)
 
     # 上位レベルの番号は直前の番号をそのまま引き継ぐ
     for i in range(level - 1):
@@ -139,98 +186,29 @@ def increment_number(number, level, previous_numbers, current_text, is_first_ite
             # 通常時はインクリメント
             number[level - 1] += 1
 
-    print(f"After incrementing - New numbers: {number}")
+    if traced:
+        write_trace(f"After incrementing - New numbers: {number}", quiet, trace)
 
     return number
 
-def extract_lowest_sub_number(text, level):
+def extract_lowest_sub_number(text, level, quiet=False, trace=None):
     """
     項目番号の数字をリスト形式で保持。
     その中で最も内側にある数字を取得し、必要な場合その数字で初期化する。
     取得できない場合は1で初期化する。
     ※今回の文書が9.1や9.2がなく、9.3から始まっていたためこの関数を作成
+    quiet=True の場合は処理の経過を標準出力に出力せず、trace を指定した場合はそこに書き出す。
     """
     matches = re.findall(r"\d+", text)
-    print(f"Extracted numbers from text '{text}': {matches}")
+    if not quiet or trace is not None:
+        write_trace(f"Extracted numbers from text '{text}': {matches}", quiet, trace)
     
     if matches and len(matches) >= level:
         return int(matches[level - 1])
     else:
-        print(f"Could not find a valid number for level {level} in text: '{text}'")
+        write_trace(f"Could not find a valid number for level {level} in text: '{text}'", quiet, trace)
         return 1
 
-def process_xml_level_1_to_4(xml_content):
-    """
-    レベル1〜4の処理を行う。
-    項目番号が連番かチェックし、そうでない場合は修正
-    """
-    # XMLコンテンツをElementTree形式に変換し、ルート要素を取得
-    tree = ET.ElementTree(ET.fromstring(xml_content))
-    root = tree.getroot()
-
-    # base_numbersは階層ごとの項目番号を保持する配列。初期値は全て0
-    base_numbers = [0, 0, 0, 0]
-    log = []
-    is_first_item = True
-
-    # ログファイルを作成し、処理の結果を追跡
-    with open("indentation_log_level_1_to_4.txt", "w", encoding="utf-8") as log_file:
-
-        # すべての段落 (<w:p> 要素) を精査
-        for paragraph in root.findall(".//w:p", namespaces=ns):
-            # <w:tab />が <w:t> の前に存在する場合、その段落の処理をスキップ
-            if check_tab_before_t(paragraph):
-                continue
-            
-             # 段落から項目番号のレベルとテキストを取得
-            level, text = parse_paragraph(paragraph)
-
-            # 項目番号ではない場合（正規表現にマッチしない場合）は処理をスキップ
-            if level is None:
-                continue
-            # レベル1〜4の項目番号のみ処理を行う
-            if level is not None and level <= 4:
-                number = extract_number(text, level)
-                current_text = "".join([t.text for t in paragraph.findall(".//w:t", namespaces=ns)]).strip()
-                # レベル1の場合、base_numbersの最初の要素に項目番号を設定し、初期化
-                if level == 1:
-                    base_numbers[0] = number[0]
-                # 上位レベルがまだ初期化（設定）されていない場合、現在のレベルの項目番号の処理を行わない
-                else:
-                    if base_numbers[level - 2] == 0:
-                        continue
-                    # document_number で取得した現在の項目番号を previous_numbers として保持し、変更前の状態を保存
-                    document_number = extract_number(current_text, level)
-                    previous_numbers = document_number.copy()
-                    # base_numbersはドキュメント全体における現在の項目番号の状態を保持するリスト。項目番号の階層（レベル1〜4）の状態を追跡している。
-                    # ここで項目番号をインクリメント
-                    base_numbers = increment_number(base_numbers, level, base_numbers, text, is_first_item)
-
-                    # インクリメント前後の番号を比較して、変更があるか確認
-                    previous_list = previous_numbers[:level]
-                    current_list = base_numbers[:level]
-
-                    log_file.write(f"Comparing: previous_list={previous_list} with current_list={current_list}\n")
-
-                    # 番号が異なる場合、変更があったと判断してハイライトを追加
-                    if previous_list != current_list:
-                        log_file.write(f"Highlighting change: {previous_list} -> {current_list}\n")
-                        for run in paragraph.findall(".//w:r", namespaces=ns):
-                            highlight_text(run)
-                    else:
-                        log_file.write(f"No change detected: {previous_list} == {current_list}\n")
-
-            # 番号をフォーマットし、現在の段落に対して更新
-            formatted_number = format_number(base_numbers, level, add_period=(level == 1))
-            update_text(paragraph, formatted_number)
-
-            if level != None:
-                log.append(f"レベル{level}で項目番号の修正: {text} -> {formatted_number}")
-
-            is_first_item = False
-
-    return ET.tostring(root, encoding='unicode'), log
-
 def format_number(number, level, add_period=True):
     """
     数字リストを整形して、項目番号形式にする関数。
@@ -247,121 +225,269 @@ def format_number(number, level, add_period=True):
         return f"({number[0]}-{number[1]}-{number[2]})"  # 例: (a-1-1)
     else:
         return ".".join(map(str, number[:level])) + ("." if add_period and level > 1 else "")
-    
-def increment_level_number(current_number, level):
+
+# レベル5〜9の項目番号は整数のタプルで保持する。アルファベットは基準文字からのオフセット(ａ/a -> 0)とする
+# 各レベルで英字を含む位置とその基準文字
+letter_bases = {6: ord('ａ'), 7: ord('a'), 8: ord('a'), 9: ord('a')}
+
+# レベル5〜9の初期値（この値が現れたら連番をリセットする）
+initial_numbers = {
+    5: (1,),        # (1)
+    6: (0,),        # ａ．
+    7: (0,),        # (a)
+    8: (0, 1),      # (a-1)
+    9: (0, 1, 1),   # (a-1-1)
+}
+
+def encode_number(number, level):
     """
-    レベルに応じたインクリメントを定義する関数。
+    extract_number() で取得したレベル5〜9の項目番号を整数のタプルに変換する。
     """
-    if level == 5:
-        # レベル5は数字をインクリメント
-        return [current_number[0] + 1]
-    elif level == 6:
-        # レベル6は全角アルファベットをインクリメント（例：ａ -> ｂ）
-        next_char = chr(ord(current_number[0]) + 1)
-        return [next_char]
-    elif level == 7:
-        # レベル7は半角アルファベットをインクリメント
-        next_char = chr(ord(current_number[0]) + 1)
-        return [next_char]
-    elif level == 8:
-        # レベル8はレベル7の値を参照しつつ、最後の数字部分をインクリメント
-        return [current_number[0], current_number[1] + 1]
-    elif level == 9:
-        # レベル9はレベル8の値を参照しつつ、最後の数字部分をインクリメント
-        return [current_number[0], current_number[1], current_number[2] + 1]
+    if level in letter_bases:
+        return (ord(number[0]) - letter_bases[level],) + tuple(number[1:])
+    return tuple(number)
 
-def process_xml_level_5_to_9(xml_content):
+def decode_number(number, level):
     """
-    レベル5〜9の処理を行い、番号が連番かどうかをチェックする。
-    番号が非連番の場合は連番となるように修正し、ハイライトを追加する。
+    整数のタプルで保持しているレベル5〜9の項目番号を、文字を含むリストに戻す。
+    """
+    if level in letter_bases:
+        return [chr(letter_bases[level] + number[0])] + list(number[1:])
+    return list(number)
+
+def increment_level_number(number, level):
+    """
+    レベル5〜9の項目番号をインクリメントする。
+    いずれのレベルも最も内側の値（数字またはアルファベットのオフセット）を1つ進める。
+    """
+    return number[:-1] + (number[-1] + 1,)
+
+class NumberingState:
+    """
+    レベル1〜9の連番処理の状態。
+    base_numbers  -- レベル1〜4の階層ごとの項目番号。初期値は全て0
+    is_first_item -- 最初の項目番号をまだ処理していない場合はTrue
+    previous      -- レベル5〜9の各レベルの前回の番号（整数のタプル）
+    """
+    __slots__ = ("base_numbers", "is_first_item", "previous")
+
+    def __init__(self):
+        self.base_numbers = [0, 0, 0, 0]
+        self.is_first_item = True
+        self.previous = {}
+
+def process_xml_numbering(xml_content, progress=None, log_file_1_to_4=None, log_file_5_to_9=None,
+                          state=None, tracker=None):
+    """
+    レベル1〜9の項目番号が連番かチェックし、そうでない場合は修正する。
+    progress を指定した場合は一定の段落数ごとに進捗を通知する
+    log_file_1_to_4, log_file_5_to_9 に書き込み可能なファイルオブジェクトを指定した場合は処理の経過を書き出す
+    state には前の区間から引き継ぐ処理状態(NumberingState)を指定できる
+    tracker を指定した場合は文書に加えた変更の数を記録する
     """
     # XMLコンテンツをElementTree形式に変換し、ルート要素を取得
-    tree = ET.ElementTree(ET.fromstring(xml_content))
+    tree = ET.ElementTree(ET.fromstring(xml_content.encode('utf-8')))
     root = tree.getroot()
-
-    previous_numbers_for_levels_5_to_9 = {}  # 各レベルの前回の番号を保持する辞書
     log = []
 
-    with open("indentation_log_level_5_to_9.txt", "w", encoding="utf-8") as log_file:
+    stage_tracker = ChangeTracker()
+    # 処理の結果を追跡する。ログファイルの指定がない場合はメモリ上に書き出して破棄する
+    with nullcontext(log_file_1_to_4 if log_file_1_to_4 is not None else io.StringIO()) as log_file_1_to_4, \
+         nullcontext(log_file_5_to_9 if log_file_5_to_9 is not None else io.StringIO()) as log_file_5_to_9:
+        number_paragraphs(root, log, log_file_1_to_4, log_file_5_to_9,
+                          progress=progress, state=state, tracker=stage_tracker)
+    if tracker is not None:
+        tracker.changes += stage_tracker.changes
 
-        for paragraph in root.findall(".//w:p", namespaces=ns):
-            # <w:tab />が <w:t> の前に存在する場合、その段落の処理をスキップ
-            if check_tab_before_t(paragraph):
-                continue 
-            level, text = parse_paragraph(paragraph)
+    # 変更がなければ再出力せず、入力をそのまま返す
+    if not stage_tracker.dirty:
+        return xml_content, log
 
-            # 項目番号ではない場合は処理をスキップ
-            if level is None:
+    return ET.tostring(root, encoding='unicode'), log
+
+def number_paragraphs(root, log, log_file_1_to_4, log_file_5_to_9, progress=None, state=None, apply=True, tracker=None,
+                      paragraphs=None, include_nested=False, quiet=False):
+    """
+    解析済みのXMLの段落を1回だけ走査し、レベル1〜9の連番処理をまとめて行う。
+    state を指定した場合はその状態から処理を始め、処理後の状態で state を更新する。
+    apply=False の場合は文書を変更せず、処理状態だけを進める（区間の早送りに使用）。
+    tracker を指定した場合は文書に加えた変更を記録する。
+    paragraphs を指定した場合はその段落だけを処理する。
+    include_nested=True の場合は表や図、テキストボックスの中の段落も処理する。
+    quiet=True の場合は処理の経過を標準出力に出力せず、log_file_1_to_4 に書き出す
+    （ライブラリAPIや範囲外の段落の早送りで使用。標準出力は複数のスレッドで共有されるため）。
+    """
+    if state is None:
+        state = NumberingState()
+
+    # すべての段落 (<w:p> 要素) を精査
+    if paragraphs is None:
+        paragraphs = body_paragraphs(root, include_nested)
+    total = len(paragraphs)
+    for index, paragraph in enumerate(paragraphs, 1):
+        report_progress(progress, "numbering", index, total)
+        # <w:tab />が <w:t> の前に存在する場合、その段落の処理をスキップ
+        if check_tab_before_t(paragraph):
+            continue
+
+        # 段落から項目番号のレベルとテキストを取得
+        level, text = parse_paragraph(paragraph)
+
+        # 項目番号ではない場合（正規表現にマッチしない場合）は処理をスキップ
+        if level is None:
+            continue
+
+        changes = tracker.changes if tracker is not None else 0
+        if not number_level_1_to_4(paragraph, level, text, state, log, log_file_1_to_4, apply, tracker, quiet):
+            continue
+
+        if level >= 5:
+            # レベル1〜4の処理でテキストが変わった場合は、変更後のテキストで項目番号を判定し直す
+            if tracker is None or tracker.changes != changes:
+                level, text = parse_paragraph(paragraph)
+            if level is not None and level >= 5:
+                number_level_5_to_9(paragraph, level, text, state, log_file_5_to_9, apply, tracker)
+
+def advance_numbering_state(paragraphs, state):
+    """
+    number_paragraphs() と同じ規則で段落の項目番号を判定し、連番の処理状態(NumberingState)だけを進める。
+    文書の変更やログの作成は行わない（区間の開始時点の状態を求める早送りに使用）。
+    段落のテキストの変更は処理状態に影響しないため、変更前の段落から求めた状態は number_paragraphs() の処理後の状態と一致する。
+    """
+    for paragraph in paragraphs:
+        if check_tab_before_t(paragraph):
+            continue
+        level, text = parse_paragraph(paragraph)
+        if level is None:
+            continue
+        _, number = classify_text(text)
+        if level == 1:
+            state.base_numbers[0] = number[0]
+        elif level <= 4:
+            if state.base_numbers[level - 2] == 0:
                 continue
+            state.base_numbers = increment_number(state.base_numbers, level, state.base_numbers, text,
+                                                  state.is_first_item, quiet=True)
+        else:
+            current_number = encode_number(number, level)
+            if current_number == initial_numbers[level]:
+                state.previous[level] = current_number
+            else:
+                state.previous[level] = increment_level_number(state.previous.get(level, initial_numbers[level]), level)
+        state.is_first_item = False
 
-            # レベル1〜4はスキップする
-            if level is None or level < 5:
-                continue 
-            
-            # 前回の段落の項目番号を辞書から取得。初期値は[1]、['ａ']などを使用
-            previous_number = previous_numbers_for_levels_5_to_9.get(
-                level, 
-                [1] if level == 5 else 
-                ['ａ'] if level == 6 else 
-                ['a'] if level == 7 else 
-                ['a', 1] if level == 8 else 
-                ['a', 1, 1]
-            )
-
-            # 現在の段落の項目番号を抽出する（例: (1), (a-1) など）
-            current_number = extract_number(text, level)
-
-            # 初期値と一致するかどうかを確認
-            initial_value = [1] if level == 5 else ['ａ'] if level == 6 else ['a'] if level == 7 else ['a', 1] if level == 8 else ['a', 1, 1]
-
-            # current_number がリセットされ、初期値である場合はインクリメントを行わない
-            # 次回以降は順にインクリメントする
-            if current_number == initial_value:
-                next_expected_number = current_number  # 初期値でリセット
-                log_file.write(f"Initial value detected at level {level}. Resetting sequence to {current_number}\n")
+def number_level_1_to_4(paragraph, level, text, state, log, log_file, apply, tracker, quiet=False):
+    """
+    1つの段落に対してレベル1〜4の処理を行う。
+    上位レベルがまだ設定されていないため処理を行わなかった場合はFalseを返す。
+    """
+    # レベル1〜4の項目番号のみ処理を行う
+    if level <= 4:
+        number = extract_number(text, level)
+        current_text = paragraph_text(paragraph).strip()
+        # レベル1の場合、base_numbersの最初の要素に項目番号を設定し、初期化
+        if level == 1:
+            state.base_numbers[0] = number[0]
+        # 上位レベルがまだ初期化（設定）されていない場合、現在のレベルの項目番号の処理を行わない
+        else:
+            if state.base_numbers[level - 2] == 0:
+                return False
+            # document_number で取得した現在の項目番号を previous_numbers として保持し、変更前の状態を保存
+            document_number = extract_number(current_text, level)
+            previous_numbers = document_number.copy()
+            # base_numbersはドキュメント全体における現在の項目番号の状態を保持するリスト。項目番号の階層（レベル1〜4）の状態を追跡している。
+            # ここで項目番号をインクリメント
+            state.base_numbers = increment_number(state.base_numbers, level, state.base_numbers, text, state.is_first_item,
+                                                 quiet, log_file)
+
+            # インクリメント前後の番号を比較して、変更があるか確認
+            previous_list = previous_numbers[:level]
+            current_list = state.base_numbers[:level]
+
+            log_file.write(f"Comparing: previous_list={previous_list} with current_list={current_list}\n")
+
+            # 番号が異なる場合、変更があったと判断してハイライトを追加
+            if previous_list != current_list:
+                log_file.write(f"Highlighting change: {previous_list} -> {current_list}\n")
+                if apply:
+                    for run in paragraph_runs(paragraph):
+                        highlight_text(run, tracker)
             else:
-                # 初期値でなければ、インクリメントして次の連番を設定
-                next_expected_number = increment_level_number(previous_number, level)
-
-            # 前回の番号をインクリメントしたものと現在の番号を比較
-            # 一致していなければ連番でないと判断
-            if current_number != next_expected_number:
-                log_file.write(f"Non-sequential detected: expected {next_expected_number} but got {current_number}\n")
-                
-                # インクリメントされた番号に修正
-                formatted_number = format_number(next_expected_number, level, add_period=False)
-                for t in paragraph.findall(".//w:t", namespaces=ns):
-                    original_text = t.text.strip()
-                    if level == 5:
-                        new_text = re.sub(r"\(\d+\)", formatted_number, original_text, count=1)
-                    elif level == 6:
-                        new_text = re.sub(r"^[ａ-ｚ]．", formatted_number, original_text, count=1)
-                    elif level == 7:
-                        new_text = re.sub(r"\([a-z]\)", formatted_number, original_text, count=1)
-                    elif level == 8:
-                        new_text = re.sub(r"\([a-z]-\d+\)", formatted_number, original_text, count=1)
-                    elif level == 9:
-                        new_text = re.sub(r"\([a-z]-\d+-\d+\)", formatted_number, original_text, count=1)
-
-                    if new_text != original_text:
-                        t.text = new_text
-                        log_file.write(f"Updated <w:t> from {original_text} to {new_text}\n")
-                    else:
-                        log_file.write(f"No update: {original_text} remains unchanged\n")
-
-                # ハイライトを追加
-                for run in paragraph.findall(".//w:r", namespaces=ns):
-                    highlight_text(run)
+                log_file.write(f"No change detected: {previous_list} == {current_list}\n")
+
+    # 番号をフォーマットし、現在の段落に対して更新
+    formatted_number = format_number(state.base_numbers, level, add_period=(level == 1))
+    if apply:
+        update_text(paragraph, formatted_number, tracker)
+
+    log.append(f"レベル{level}で項目番号の修正: {text} -> {formatted_number}")
+
+    state.is_first_item = False
+    return True
+
+# レベル5〜9で項目番号部分を置き換える正規表現
+replace_patterns = {
+    5: r"\(\d+\)",
+    6: r"^[ａ-ｚ]．",
+    7: r"\([a-z]\)",
+    8: r"\([a-z]-\d+\)",
+    9: r"\([a-z]-\d+-\d+\)",
+}
+
+def number_level_5_to_9(paragraph, level, text, state, log_file, apply, tracker):
+    """
+    1つの段落に対してレベル5〜9の処理を行い、番号が連番かどうかをチェックする。
+    番号が非連番の場合は連番となるように修正し、ハイライトを追加する。
+    """
+    initial_value = initial_numbers[level]
+
+    # 前回の段落の項目番号を取得。まだ現れていないレベルは初期値を使用
+    previous_number = state.previous.get(level, initial_value)
+
+    # 現在の段落の項目番号を抽出する（例: (1), (a-1) など）
+    current_number = encode_number(extract_number(text, level), level)
+
+    # current_number がリセットされ、初期値である場合はインクリメントを行わない
+    # 次回以降は順にインクリメントする
+    if current_number == initial_value:
+        next_expected_number = current_number  # 初期値でリセット
+        log_file.write(f"Initial value detected at level {level}. Resetting sequence to {decode_number(current_number, level)}\n")
+    else:
+        # 初期値でなければ、インクリメントして次の連番を設定
+        next_expected_number = increment_level_number(previous_number, level)
+
+    # 前回の番号をインクリメントしたものと現在の番号を比較
+    # 一致していなければ連番でないと判断
+    if current_number != next_expected_number:
+        expected_list = decode_number(next_expected_number, level)
+        log_file.write(f"Non-sequential detected: expected {expected_list} but got {decode_number(current_number, level)}\n")
+
+        # インクリメントされた番号に修正
+        formatted_number = format_number(expected_list, level, add_period=False)
+        for t in paragraph_texts(paragraph):
+            original_text = t.text.strip()
+            new_text = re.sub(replace_patterns[level], formatted_number, original_text, count=1)
+
+            if new_text != original_text:
+                if apply and new_text != t.text:
+                    t.text = new_text
+                    mark_changed(tracker, t)
+                log_file.write(f"Updated <w:t> from {original_text} to {new_text}\n")
             else:
-                log_file.write(f"Sequential order confirmed for level {level}: {next_expected_number} == {current_number}\n")
+                log_file.write(f"No update: {original_text} remains unchanged\n")
 
-            # 今回の番号を辞書に保存し、次回の比較に使用
-            previous_numbers_for_levels_5_to_9[level] = next_expected_number
-            next_expected_number = increment_level_number(next_expected_number, level)  # 次の番号をインクリメント
-            log_file.write(f"Next expected_number for level {level}: {next_expected_number}\n")
-            log_file.write(f"-"*50+"\n")
+        # ハイライトを追加
+        if apply:
+            for run in paragraph_runs(paragraph):
+                highlight_text(run, tracker)
+    else:
+        log_file.write(f"Sequential order confirmed for level {level}: {decode_number(next_expected_number, level)} == {decode_number(current_number, level)}\n")
 
-    return ET.tostring(root, encoding='unicode'), log
+    # 今回の番号を保存し、次回の比較に使用
+    state.previous[level] = next_expected_number
+    next_expected_number = increment_level_number(next_expected_number, level)  # 次の番号をインクリメント
+    log_file.write(f"Next expected_number for level {level}: {decode_number(next_expected_number, level)}\n")
+    log_file.write(f"-"*50+"\n")
 
 # このスクリプトが直接実行された場合のみ、以下のコードが動作するようにする
 if __name__ == "__main__":
@@ -370,12 +496,12 @@ if __name__ == "__main__":
     with open(xml_file_path, "r", encoding="utf-8") as file:
         xml_content = file.read()
 
-    # レベル1〜4のXML解析の実行
-    updated_xml_1_to_4, log_1_to_4 = process_xml_level_1_to_4(xml_content)
-
-    # レベル5〜9のXML解析の実行
-    updated_xml_5_to_9, log_5_to_9 = process_xml_level_5_to_9(updated_xml_1_to_4)
+    # レベル1〜9のXML解析の実行
+    with open("indentation_log_level_1_to_4.txt", "w", encoding="utf-8") as log_file_1_to_4, \
+         open("indentation_log_level_5_to_9.txt", "w", encoding="utf-8") as log_file_5_to_9:
+        updated_xml, log = process_xml_numbering(xml_content, log_file_1_to_4=log_file_1_to_4,
+                                                 log_file_5_to_9=log_file_5_to_9)
 
     # 修正されたXMLを保存
     with open(xml_file_path, "w", encoding="utf-8") as file:
-        file.write(updated_xml_5_to_9)
\ No newline at end of file
+        file.write(updated_xml)
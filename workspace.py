@@ -0,0 +1,172 @@
+"""
+このファイルではジョブごとの作業ディレクトリ(ワークスペース)を管理します。
+各ジョブは <ルート>/<ジョブID>/ の下に展開したXML、ログ、校閲後のwordファイルを作成し、
+作成したパスを manifest.json に記録します。
+削除時は manifest.json に記録されたものだけを削除するため、dataディレクトリの入力ファイルなどには触れません。
+ルートに tmpfs 上のディレクトリ(例: /dev/shm)を指定すると、ディスクへの書き込みを避けられます。
+保持するジョブ数や合計サイズの上限を超えた場合は、最後に使用した時刻が古いジョブから削除します(LRU)。
+"""
+import json
+import os
+import shutil
+import time
+import uuid
+from datetime import datetime
+
+# ワークスペースの既定のルートディレクトリ
+DEFAULT_ROOT = "jobs"
+
+# tmpfs を使用する場合のルートディレクトリ
+TMPFS_ROOT = "/dev/shm/indent_check/jobs"
+
+MANIFEST = "manifest.json"
+
+
+class JobWorkspace:
+    """
+    1つのジョブの作業ディレクトリ。
+    path() で取得したパスは作成物として manifest.json に記録される。
+    """
+
+    def __init__(self, directory, manifest):
+        self.directory = directory
+        self.manifest = manifest
+
+    @classmethod
+    def create(cls, root=DEFAULT_ROOT, source=None):
+        """
+        新しいジョブの作業ディレクトリを作成する。
+        """
+        job_id = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        directory = os.path.join(root, job_id)
+        os.makedirs(directory)
+        now = time.time()
+        manifest = {
+            "job_id": job_id,
+            "source": source,
+            "created": now,
+            "last_used": now,
+            "paths": [],
+        }
+        workspace = cls(directory, manifest)
+        workspace.save()
+        return workspace
+
+    @classmethod
+    def open(cls, directory):
+        """
+        既存のジョブの作業ディレクトリを開く。manifest.json がない場合は None を返す。
+        """
+        manifest_path = os.path.join(directory, MANIFEST)
+        if not os.path.isfile(manifest_path):
+            return None
+        with open(manifest_path, "r", encoding="utf-8") as file:
+            return cls(directory, json.load(file))
+
+    @property
+    def job_id(self):
+        return self.manifest["job_id"]
+
+    def path(self, name):
+        """
+        作業ディレクトリ内のパスを返し、作成物として記録する。
+        manifest.json は新しいパスを記録したときだけ書き出す。最後に使用した時刻は touch() で更新する。
+        """
+        if name not in self.manifest["paths"]:
+            self.manifest["paths"].append(name)
+            self.save()
+        return os.path.join(self.directory, name)
+
+    def save(self):
+        """
+        manifest.json を書き出す。
+        """
+        with open(os.path.join(self.directory, MANIFEST), "w", encoding="utf-8") as file:
+            json.dump(self.manifest, file, ensure_ascii=False, indent=2)
+
+    def touch(self):
+        """
+        最後に使用した時刻を更新する。
+        ジョブの処理を終えたときや、既存のジョブを開いて作成物を再利用したときに1回だけ呼び出す。
+        最後に使用した時刻が新しいジョブほど、保持の上限による削除(LRU)の対象として後回しになる。
+        """
+        self.manifest["last_used"] = time.time()
+        self.save()
+
+    def size(self):
+        """
+        記録された作成物の合計サイズ(バイト)を返す。
+        """
+        total = 0
+        for name in self.manifest["paths"]:
+            path = os.path.join(self.directory, name)
+            if os.path.isfile(path):
+                total += os.path.getsize(path)
+            for foldername, subfolders, filenames in os.walk(path):
+                for filename in filenames:
+                    total += os.path.getsize(os.path.join(foldername, filename))
+        return total
+
+    def cleanup(self):
+        """
+        このジョブが作成したものだけを削除する。
+        記録されていないファイルが残っている場合、作業ディレクトリ自体は削除しない。
+        """
+        for name in self.manifest["paths"]:
+            path = os.path.join(self.directory, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+        os.remove(os.path.join(self.directory, MANIFEST))
+        try:
+            os.rmdir(self.directory)
+        except OSError:
+            print(f"ディレクトリ '{self.directory}' に記録されていないファイルがあるため、残しました。")
+
+
+def list_workspaces(root=DEFAULT_ROOT):
+    """
+    ルートディレクトリ内のジョブを、最後に使用した時刻が古い順に返す。
+    """
+    if not os.path.isdir(root):
+        return []
+    workspaces = []
+    for name in os.listdir(root):
+        workspace = JobWorkspace.open(os.path.join(root, name))
+        if workspace is not None:
+            workspaces.append(workspace)
+    return sorted(workspaces, key=lambda workspace: workspace.manifest["last_used"])
+
+
+def enforce_retention(root=DEFAULT_ROOT, max_jobs=None, max_bytes=None, keep=()):
+    """
+    ジョブ数が max_jobs、合計サイズが max_bytes を超えている間、最後に使用した時刻が古いジョブから削除する。
+    keep に指定したジョブIDは削除しない。削除したジョブIDのリストを返す。
+    """
+    workspaces = list_workspaces(root)
+    sizes = {workspace.job_id: workspace.size() for workspace in workspaces}
+    total = sum(sizes.values())
+
+    evicted = []
+    for workspace in workspaces:
+        over_jobs = max_jobs is not None and len(workspaces) - len(evicted) > max_jobs
+        over_bytes = max_bytes is not None and total > max_bytes
+        if not (over_jobs or over_bytes):
+            break
+        if workspace.job_id in keep:
+            continue
+        workspace.cleanup()
+        total -= sizes[workspace.job_id]
+        evicted.append(workspace.job_id)
+        print(f"ジョブ '{workspace.job_id}' を削除しました。")
+    return evicted
+
+
+def cleanup_all(root=DEFAULT_ROOT):
+    """
+    ルートディレクトリ内の全てのジョブが作成したものを削除する。
+    """
+    for workspace in list_workspaces(root):
+        workspace.cleanup()
+        print(f"ジョブ '{workspace.job_id}' を削除しました。")